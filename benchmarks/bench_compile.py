@@ -0,0 +1,168 @@
+"""Benchmark how compile_to_c scales with program size.
+
+Generates synthetic programs built from the constructs used in
+examples/InTheZone (pragma config blocks, long if/elif chains, classes with
+annotated fields and chains of imports), compiles each one and records the
+time spent parsing, transforming, preparing, optimizing and emitting, plus
+peak memory.
+
+    python benchmarks/bench_compile.py [--sizes 1 2 4 8] [--output results.json]
+    python benchmarks/bench_compile.py --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyRobotC
+
+PHASES = ['discover', 'parse', 'transform', 'prepare', 'optimize', 'emit']
+
+def generate_program(directory, size):
+  """Write a synthetic program of the given size to directory and return the
+  path of its main module. Size scales every construct linearly."""
+  depth = 2 * size
+  for level in range(depth):
+    lines = []
+    if level + 1 < depth:
+      lines.append('import chain{}'.format(level + 1))
+    lines += generate_classes('Link{}_'.format(level), 2)
+    lines += generate_chain('step{}'.format(level), 20)
+    write_module(directory, 'chain{}'.format(level), lines)
+  lines = ['import chain0'] if depth else []
+  lines += generate_pragmas(10 * size)
+  lines += generate_classes('Waypoint', 4 * size)
+  for function in range(4 * size):
+    lines += generate_chain('follow{}'.format(function), 40)
+  lines += generate_task(4 * size)
+  return write_module(directory, 'main', lines)
+
+def generate_pragmas(count):
+  lines = []
+  for port in range(count):
+    lines.append('vex.pragma("config", Motor, port{0}, motor{0}, tmotorVex393_MC29, openLoop)'.format(port))
+  return lines
+
+def generate_classes(prefix, count):
+  lines = []
+  for index in range(count):
+    lines += [
+      '',
+      'class {}{}:'.format(prefix, index),
+      '  """Synthetic class {}"""'.format(index),
+      '  def __init__(self, x: int, y: int, heading: int) -> void:',
+      '    self.x: int = x',
+      '    self.y: int = y',
+      '    self.heading: int = heading',
+      '    self.speed: int = 0',
+      '',
+      '  def distance(self, other: int) -> int:',
+      '    return abs(self.x - other) + abs(self.y - other)',
+    ]
+  return lines
+
+def generate_chain(name, length):
+  lines = ['', 'def {}(step: int) -> int:'.format(name), '  speed: int = 0']
+  for index in range(length):
+    lines += [
+      '  {} step == {}:'.format('if' if index == 0 else 'elif', index),
+      '    speed = ({} * 3 + step) % 127'.format(index),
+      '    motor[port1] = motor[port2] = speed',
+    ]
+  lines += ['  else:', '    speed = 0', '  return speed']
+  return lines
+
+def generate_task(functions):
+  lines = ['', 'def main() -> task:', '  step: int = 0', '  while True:']
+  for function in range(functions):
+    lines.append('    motor[port3] = follow{}(step)'.format(function))
+  lines.append('    step += 1')
+  return lines
+
+def write_module(directory, name, lines):
+  path = os.path.join(directory, name + '.py')
+  with open(path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return path
+
+def compile_program(mainPath):
+  """Compile mainPath and its imports. Returns (timings, modules, output bytes)."""
+  pyRobotC.compiled.clear()
+  pyRobotC.userFunctions.clear()
+  pyRobotC.classNames[:] = []
+  pyRobotC.mainFile = mainPath
+  pyRobotC.cacheDir = None
+  timings = {}
+  started = time.perf_counter()
+  discovered, order = pyRobotC.discover_modules(mainPath)
+  timings['discover'] = time.perf_counter() - started
+  outputBytes = 0
+  for path in order:
+    entry = pyRobotC.lower_module(discovered[path]['source'], followImports=False, timings=timings)
+    outputBytes += len(entry['c'])
+  return timings, len(order), outputBytes
+
+def run(sizes, repeat):
+  results = []
+  for size in sizes:
+    with tempfile.TemporaryDirectory() as directory:
+      mainPath = generate_program(directory, size)
+      lines = 0
+      for name in os.listdir(directory):
+        with open(os.path.join(directory, name)) as f:
+          lines += sum(1 for line in f)
+      best = None
+      for attempt in range(repeat):
+        timings, modules, outputBytes = compile_program(mainPath)
+        if best is None or sum(timings.values()) < sum(best.values()):
+          best = timings
+      tracemalloc.start()
+      compile_program(mainPath)
+      peakMemory = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    result = {'size': size, 'lines': lines, 'modules': modules, 'output_bytes': outputBytes, 'peak_memory': peakMemory}
+    result.update({phase: best.get(phase, 0) for phase in PHASES})
+    result['total'] = sum(best.get(phase, 0) for phase in PHASES)
+    results.append(result)
+    print_result(result)
+  return results
+
+def print_result(result, baseline=None):
+  text = 'size {size:>4}  {lines:>7} lines  {modules:>3} modules'.format(**result)
+  for phase in PHASES + ['total']:
+    text += '  {}={:.1f}ms'.format(phase, result[phase] * 1000)
+    if baseline and baseline.get(phase):
+      text += ' ({:+.0%})'.format(result[phase] / baseline[phase] - 1)
+  text += '  peak={:.1f}MB'.format(result['peak_memory'] / 1e6)
+  print(text)
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the PyRobotC compiler.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+  parser.add_argument('--repeat', type=int, default=3, help='keep the fastest of this many runs')
+  parser.add_argument('--output', help='write results to this JSON file')
+  parser.add_argument('--compare', help='compare against results saved by an earlier --output')
+  args = parser.parse_args()
+  results = run(args.sizes, args.repeat)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = {result['size']: result for result in json.load(f)['results']}
+    print('Compared with {}:'.format(args.compare))
+    for result in results:
+      print_result(result, baseline.get(result['size']))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({
+        'version': pyRobotC.__version__,
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+      }, f, indent=2)
+
+if __name__ == '__main__':
+  main()
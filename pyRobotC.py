@@ -2,14 +2,64 @@ import ast
 import traceback
 import os
 import sys
+import argparse
+import hashlib
+import json
+import tempfile
+import time
+import concurrent.futures
+import collections
+import re
+import copy
+import math
+import contextlib
+import threading
+
+__version__ = '0.2.0'
 
 userFunctions = {}
-renames = ['vex.pragma','vex.motor','vex.slaveMotors','vex.motorReversed']
+renames = ['vex.pragma','vex.motor','vex.slaveMotors','vex.motorReversed','vex.sleep','vex.start','vex.stop']
+blockingCalls = ['vex.sleep', 'wait1Msec', 'wait10Msec'] # The calls that can be awaited
 classNames = []
+globalNames = [] # Module-level variables of the modules compiled so far, which functions assign rather than declare
 indent = '  '
 sameLineBraces = True
+foldConstants = True # Evaluate constant expressions at compile time
+eliminateDeadFunctions = True # Drop functions no task can reach
+inlineThreshold = 16 # Inline pure single-expression functions up to this many nodes (0 disables)
+useTemporaries = True # Evaluate shared subexpressions of chains once, into temporaries
+hoistLoopInvariants = True # Evaluate range() bounds and invariant expressions once, before a loop
+reduceStrength = True # Multiply, divide and take modulo by powers of two with shifts and masks
+packStructs = True # Order struct fields largest alignment first, so they need no padding
+hardwareArrays = {'motor': 'int', 'SensorValue': 'int', 'vexRT': 'int', 'nMotorEncoder': 'int'}
+pureFunctions = ['abs', 'sgn', 'sqrt', 'sin', 'cos', 'tan', 'atan', 'exp', 'log', 'round', 'floor', 'ceil']
+builtinTypes = {'joystick': 'int', 'joy1Btn': 'int', 'joy2Btn': 'int', 'nSysTime': 'int', 'nPgmTime': 'int'} # RobotC values, fields and results
+intMin, intMax = -32768, 32767 # RobotC's int is 16 bits
+estimateCosts = False # Record each function's operation counts for format_cost_report
+operationCosts = {'int': 2, 'float': 30, 'call': 10, 'array': 3, 'branch': 2, 'assign': 1, 'wait': 1000} # Rough microseconds each (wait is per ms)
+loopBudget = 20 # Milliseconds a task loop iteration should take at most
+amalgamateOutput = False # Write every module into one .c file instead of one file each
+sourceMaps = False # Write a .map of the Python line behind each line of C next to every output file
+profile = False # Count calls, iterations and time in every function and loop (see ProfileInstrumentation)
+profileInterval = 1000 # Milliseconds between the profileReport task's dumps
+typeSizes = {'bool': 1, 'char': 1, 'byte': 1, 'ubyte': 1, 'short': 2, 'word': 2, 'int': 2, 'long': 4, 'float': 4} # In bytes
+integerPromotions = {'char': 'int', 'byte': 'int', 'ubyte': 'int', 'short': 'int', 'word': 'int'} # Narrow ints do arithmetic as int
 
 compiled = {}
+moduleFunctions = {} # Where each compiled module's functions are in its C, and what they reference
+moduleMemory = {} # The structs and globals each compiled module declares, see C_Module.emit
+moduleMarks = {} # [position, Python line] where each statement of a compiled module's C starts
+mainFile = None # The file given on the command line, used to resolve imports
+cacheDir = None # Directory for the on-disk compile cache, or None to disable it
+buildStats = None # Per-module timings and node counts (see new_build_stats), or None
+sources = None # Source by absolute path, read instead of files when set (see Compiler)
+warningLog = None # If a list, warnings are added to it instead of printed
+memoryCache = None # If a dict, cache entries are also kept in it, by key (see serve)
+memoryCacheSize = 256 # Entries kept in memoryCache, oldest dropped first
+pathCache = None # If a dict, resolve_path remembers what it found in it
+localReturns = {} # Return types inferred for the unannotated functions of the module being lowered
+localArrays = {} # Element types of the lookup tables of the module being lowered
+diagnostics = [] # Warnings about the module being lowered
 
 def module_rename(aNode):
   if aNode.func.print_c() == 'vex.pragma':
@@ -42,6 +92,16 @@ def module_rename(aNode):
     asC = 'bMotorReflected[' + aNode.args[0].print_c()
     asC += '] = ' + aNode.args[1].print_c()
     return asC
+  elif aNode.func.print_c() == 'vex.sleep':
+    return 'wait1Msec(' + aNode.args[0].print_c() + ')'
+  elif aNode.func.print_c() in ('vex.start', 'vex.stop'):
+    taskNode = aNode.args[0]
+    if isinstance(taskNode, C_Call) and not taskNode.args:
+      taskNode = taskNode.func # vex.start(poll()) starts the task poll
+    asC = ('startTask(' if aNode.func.print_c() == 'vex.start' else 'stopTask(') + taskNode.print_c()
+    for arg in aNode.args[1:] + [keyword.value for keyword in aNode.keywords if keyword.arg == 'priority']:
+      asC += ', ' + arg.print_c()
+    return asC + ')'
   return 'Unknown function. This should not happen'
 
 def escape_string(s, unicode = False, max_length = 200):
@@ -90,21 +150,139 @@ def escape_string(s, unicode = False, max_length = 200):
   ret.append('"')
 
   return "".join(ret)
+
+class CEmitter(object):
+  """Streams generated C into a list buffer (or a file), tracking indentation.
+
+  Block statements write their children through the emitter instead of
+  building and re-indenting strings, so emission is linear in program size."""
+
+  def __init__(self, stream=None):
+    self.stream = stream
+    self.parts = []
+    self.position = 0
+    self.level = 0
+    self.lastChar = ''
+    self.atLineStart = True
+    self.functions = [] # Top-level functions written, see C_FunctionDef.emit
+    self.structs = {} # Fields of the structs written, in order, see C_ClassDef.emit
+    self.globals = [] # [name, type] of the module-level variables declared
+    self.marks = [] # [position, Python line] of each statement, see mark()
+
+  def _put(self, text):
+    self.position += len(text)
+    if self.stream is not None:
+      self.stream.write(text)
+    else:
+      self.parts.append(text)
+
+  def write(self, text):
+    """Write text, prefixing every non-empty line with the current indent."""
+    if not text:
+      return
+    prefix = indent * self.level
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+      if i:
+        self._put('\n')
+        self.atLineStart = True
+      if line:
+        if self.atLineStart and prefix:
+          self._put(prefix)
+        self._put(line)
+        self.atLineStart = False
+    self.lastChar = text[-1]
+
+  def mark(self, aNode):
+    """Note that what is written next comes from aNode's line."""
+    lineno = getattr(aNode, 'lineno', None)
+    if lineno and (not self.marks or self.marks[-1][1] != lineno):
+      self.marks.append([self.position, lineno])
+
+  def open_block(self):
+    if sameLineBraces:
+      self.write(' {\n')
+    else:
+      self.write('\n{\n')
+    self.level += 1
+
+  def close_block(self):
+    self.level -= 1
+    self.write('}')
+
+  def body(self, nodes):
+    """Write a list of statements, one per line, each terminated with ';'
+    unless it ends in a closing brace."""
+    for childNode in nodes:
+      state = self.checkpoint()
+      self.mark(childNode)
+      if isinstance(childNode, C_MotorGroup):
+        childNode.emit(self) # Writes nothing unless slaved at link time
+        continue
+      try:
+        emit_node(childNode, self)
+        if self.lastChar != '}':
+          self.write(';')
+        self.write('\n')
+      except Exception as e:
+        self.restore(state)
+        emit_failed(childNode, e)
+
+  def checkpoint(self):
+    """The state to restore() if what is written next has to be taken back."""
+    return (len(self.parts), self.position, self.level, self.lastChar, self.atLineStart, len(self.functions),
+            len(self.globals), len(self.marks))
+
+  def restore(self, state):
+    parts, self.position, self.level, self.lastChar, self.atLineStart, functions, globals, marks = state
+    del self.parts[parts:], self.functions[functions:], self.globals[globals:], self.marks[marks:]
+
+  def getvalue(self):
+    return ''.join(self.parts)
+
+def emit_failed(aNode, e):
+  """Report a statement that couldn't be written. Whatever was written of
+  it has been taken back, and the statements after it are still written."""
+  print(traceback.format_exc())
+  print("Current node:")
+  print(ast.dump(aNode))
+  name = type(aNode).__name__
+  if name.startswith('C_'):
+    name = name[2:]
+  warn(aNode, 'could not write {}: {}: {}; it is left out'.format(name, type(e).__name__, e))
+
+def emit_node(aNode, out):
+  """Write aNode to the emitter, streaming block statements."""
+  if hasattr(aNode, 'emit'):
+    aNode.emit(out)
+  else:
+    out.write(aNode.print_c())
+
+def emit_to_string(aNode):
+  out = CEmitter()
+  aNode.emit(out)
+  return out.getvalue()
     
 class C_Module(ast.Module):
   def prepare(self):
     pass
   
   def print_c(self):
-    asC = ''
+    return emit_to_string(self)
+
+  def emit(self, out):
     for node in self.body:
+      state = out.checkpoint()
       try:
-        asC += node.print_c()
+        if isinstance(node, C_AnnAssign) and isinstance(node.target, C_Name):
+          out.globals.append([node.target.id, node.annotation.print_c()])
+        out.mark(node)
+        emit_node(node, out)
+        if out.lastChar not in '\n}':
+          out.write(';\n') # A global declaration or other statement
       except Exception as e:
-        print(traceback.format_exc())
-        print("Current code:")
-        print(asC)
-    return asC
+        out.restore(state)
+        emit_failed(node, e)
     
 class C_Bytes(ast.Bytes):
   def prepare(self):
@@ -127,6 +305,23 @@ class C_Num(ast.Num):
   def print_c(self):
     return str(self.n)
 
+class C_Constant(ast.Constant):
+  def prepare(self):
+    pass
+  
+  def print_c(self):
+    if self.value is True:
+      return 'true'
+    elif self.value is False:
+      return 'false'
+    elif self.value is None:
+      return '0'
+    elif isinstance(self.value, str):
+      return escape_string(self.value)
+    elif isinstance(self.value, bytes):
+      return escape_string(self.value.decode('utf-8'),True)
+    return str(self.value)
+
 class C_FunctionDef(ast.FunctionDef):
   def prepare(self):
     """Prepare for writing. Take note of return types, class names, etc..."""
@@ -134,7 +329,34 @@ class C_FunctionDef(ast.FunctionDef):
       userFunctions[self.name] = self.returns.print_c()
 
   def print_c(self):
+    return emit_to_string(self)
+
+  def references(self):
+    """Every name this function could call or construct."""
+    names = set()
+    for node in ast.walk(self):
+      if isinstance(node, ast.Name):
+        names.add(node.id)
+      elif isinstance(node, ast.Attribute):
+        names.add(node.attr)
+    names.discard(self.name)
+    return sorted(names)
+
+  def emit(self, out):
+    if out.level == 0:
+      out.functions.append({'name': self.name, 'task': self.returns.print_c() == 'task',
+                            'references': self.references(), 'start': out.position})
+      if estimateCosts:
+        estimator = CostEstimator(self)
+        out.functions[-1].update(cost=dict(estimator.estimate()), loops=estimator.loops)
+      if hasattr(self, 'profile'):
+        out.functions[-1]['profile'] = self.profile
     asC = '\n'
+    if hasattr(self, 'profile'):
+      counters = [self.profile['calls'], self.profile['time']]
+      for loop in self.profile['loops']:
+        counters += [loop['iterations'], loop['time']]
+      asC += ''.join('long {} = 0;\n'.format(counter) for counter in counters)
     if ast.get_docstring(self):
       asC += '/*\n'
       asC += ast.get_docstring(self)
@@ -155,25 +377,20 @@ class C_FunctionDef(ast.FunctionDef):
       asC += argType + ' ' + arg
       if i >= self.args.minArgs:
         asC += ' = ' + (self.args.defaults[i - self.args.minArgs]).print_c()
-    if sameLineBraces:
-      asC += ') {\n'
-    else:
-      asC += ')\n{\n'
-    for childNode in self.body:
-      try:
-        unindented = childNode.print_c()
-        unindented = '\n'.join([indent + x for x in unindented.split('\n')])
-        if not unindented.endswith('}'):
-          unindented += ';'
-        unindented += '\n'
-        asC += unindented
-      except Exception as e:
-        print(traceback.format_exc())
-        print(ast.dump(childNode))
-        return asC
-    asC += '}\n'
-    return asC
+    out.write(asC + ')')
+    out.open_block()
+    out.body(self.body)
+    out.close_block()
+    out.write('\n')
+    if out.level == 0:
+      out.functions[-1]['end'] = out.position
     
+class C_AsyncFunctionDef(ast.AsyncFunctionDef):
+  """An async def is a RobotC task. CNodeTransformer turns it into a
+  C_FunctionDef returning task, so only prepare() is ever called here."""
+  def prepare(self):
+    C_FunctionDef.prepare(self)
+
 class C_arguments(ast.arguments):
   def prepare(self):
     self.minArgs = len(self.args) - len(self.defaults)
@@ -348,8 +565,8 @@ class C_BoolOp(ast.BoolOp):
     pass
     
   def print_c(self):
-    asC = '(' + self.values.pop(0).print_c()
-    for value in self.values:
+    asC = '(' + self.values[0].print_c()
+    for value in self.values[1:]:
       asC += ' ' + self.op.print_c() + ' '
       asC += value.print_c()
     return asC + ')'
@@ -377,16 +594,19 @@ class C_Compare(ast.Compare):
     
   def print_c(self):
     asC = ''
-    self.comparators.insert(0,self.left)
+    operands = [self.left] + self.comparators
     addAnd = False
     for i,op in enumerate(self.ops):
       if addAnd:
         asC += ' && '
       else:
         addAnd = True
-      asC += '(' + self.comparators[i].print_c() + ' '
+      left = operands[i]
+      if isinstance(left, C_TempAssign):
+        left = left.target # Already evaluated by the previous comparison
+      asC += '(' + left.print_c() + ' '
       asC += op.print_c()
-      asC += ' ' + self.comparators[i + 1].print_c() + ')'
+      asC += ' ' + operands[i + 1].print_c() + ')'
     return asC
   
 
@@ -468,6 +688,14 @@ class C_Call(ast.Call):
     return asC
   
 
+class C_Await(ast.Await):
+  def prepare(self):
+    pass
+
+  def print_c(self):
+    return self.value.print_c()
+
+
 class C_IfExp(ast.IfExp):
   def prepare(self):
     pass
@@ -514,6 +742,76 @@ class C_Assign(ast.Assign):
     asC += self.value.print_c()
     return asC
   
+class C_TempAssign(ast.expr):
+  """Stores value in the temporary target and evaluates to it. Only created
+  by TemporaryLowering."""
+  _fields = ('target', 'value')
+
+  def prepare(self):
+    pass
+
+  def print_c(self):
+    return '(' + self.target.print_c() + ' = ' + self.value.print_c() + ')'
+
+class C_MotorGroup(ast.stmt):
+  """Where a motor group that may be slaved is declared. Writes nothing,
+  but notes the slaveMotor calls in slaved for slave_motor_groups() to
+  write here. Only created by MotorGroupLowering."""
+  _fields = ('slaved',)
+
+  def prepare(self):
+    pass
+
+  def print_c(self):
+    return emit_to_string(self)
+
+  def emit(self, out):
+    alone = CEmitter()
+    alone.level = out.level
+    alone.body(self.slaved)
+    motor_group(out, self)['declaration'] = [out.position, self.line, alone.getvalue()]
+
+class C_SetGroup(ast.stmt):
+  """vex.setGroup of a motor group that may be slaved. Writes body, which
+  sets every port, and notes where, with slaved (which only sets the first)
+  for slave_motor_groups() to write instead. Only created by
+  MotorGroupLowering."""
+  _fields = ('body', 'slaved')
+
+  def prepare(self):
+    pass
+
+  def print_c(self):
+    return emit_to_string(self)
+
+  def emit(self, out):
+    start = out.position
+    write_statements(self.body, out)
+    alone = CEmitter()
+    alone.level = out.level
+    write_statements(self.slaved, alone)
+    motor_group(out, self)['sets'].append([start, out.position, alone.getvalue()])
+
+def write_statements(statements, out):
+  """Write statements like CEmitter.body, but leave the last unterminated,
+  as it stands for a single statement of the caller's."""
+  for i, statement in enumerate(statements):
+    if i:
+      if out.lastChar != '}':
+        out.write(';')
+      out.write('\n')
+    emit_node(statement, out)
+
+def motor_group(out, aNode):
+  """The record of aNode's motor group, kept with the function being
+  written: its ports, its declaration and its setGroup writes."""
+  groups = out.functions[-1].setdefault('motorGroups', []) if out.functions else []
+  for group in groups:
+    if group['id'] == aNode.group:
+      return group
+  groups.append({'id': aNode.group, 'ports': aNode.ports, 'declaration': None, 'sets': []})
+  return groups[-1]
+
 if "AnnAssign" in ast.__dict__:
   class C_AnnAssign(ast.AnnAssign):
     def prepare(self):
@@ -574,44 +872,21 @@ class C_If(ast.If):
     pass
     
   def print_c(self):
-    asC = 'if ('
-    asC += self.test.print_c()
-    if sameLineBraces:
-      asC += ') {\n'
-    else:
-      asC += ')\n{\n'
-    for childNode in self.body:
-      try:
-        unindented = childNode.print_c()
-        unindented = '\n'.join([indent + x for x in unindented.split('\n')])
-        if not unindented.endswith('}'):
-          unindented += ';'
-        unindented += '\n'
-        asC += unindented
-      except Exception as e:
-        print(traceback.format_exc())
-        print(ast.dump(childNode))
-        return asC
-    asC += '}'
+    return emit_to_string(self)
+
+  def emit(self, out):
+    out.write('if (' + self.test.print_c() + ')')
+    out.open_block()
+    out.body(self.body)
+    out.close_block()
     if self.orelse:
       if sameLineBraces:
-        asC += ' else {\n'
+        out.write(' else')
       else:
-        asC += '\nelse\n{\n'
-      for childNode in self.orelse:
-        try:
-          unindented = childNode.print_c()
-          unindented = '\n'.join([indent + x for x in unindented.split('\n')])
-          if not unindented.endswith('}'):
-            unindented += ';'
-          unindented += '\n'
-          asC += unindented
-        except Exception as e:
-          print(traceback.format_exc())
-          print(ast.dump(childNode))
-          return asC
-      asC += '}'
-    return asC
+        out.write('\nelse')
+      out.open_block()
+      out.body(self.orelse)
+      out.close_block()
   
 
 class C_For(ast.For):
@@ -619,62 +894,50 @@ class C_For(ast.For):
     pass
     
   def print_c(self):
+    return emit_to_string(self)
+
+  def emit(self, out):
     # Only supports for _ in range() for now
-    asC = ''
     var = self.target.print_c()
     low = '0'
-    step = '1'
+    stepValue = 1
     if len(self.iter.args) > 1:
       low = self.iter.args[0].print_c()
       high = self.iter.args[1].print_c()
       if len(self.iter.args) > 2:
-        step = self.iter.args[2].print_c()
+        isConstant, stepValue = constant_value(self.iter.args[2])
+        if not isConstant:
+          stepValue = None
     else:
       high = self.iter.args[0].print_c()
-    asC += 'for (' + var + ' = '
-    asC += low
-    asC += '; ' + var + ' < ' + high + '; ' + var + ' += ' + step
-    if sameLineBraces:
-      asC += ') {\n'
+    if stepValue is None:
+      # The direction is only known at runtime
+      step = self.iter.args[2].print_c()
+      condition = '(({0} > 0) ? ({1} < {2}) : ({1} > {2}))'.format(step, var, high)
+      increment = var + ' += ' + step
+    elif stepValue > 0:
+      condition = var + ' < ' + high
+      increment = var + '++' if stepValue == 1 else var + ' += ' + str(stepValue)
     else:
-      asC += ')\n{\n'
-    for childNode in self.body:
-      try:
-        unindented = childNode.print_c()
-        unindented = '\n'.join([indent + x for x in unindented.split('\n')])
-        if not unindented.endswith('}'):
-          unindented += ';'
-          unindented += '\n'
-          asC += unindented
-      except Exception as e:
-        print(traceback.format_exc())
-        print(ast.dump(childNode))
-        return asC
-    return asC + '}'
+      condition = var + ' > ' + high
+      increment = var + '--' if stepValue == -1 else var + ' -= ' + str(-stepValue)
+    out.write('for (' + var + ' = ' + low + '; ' + condition + '; ' + increment + ')')
+    out.open_block()
+    out.body(self.body)
+    out.close_block()
 
 class C_While(ast.While):
   def prepare(self):
     pass
     
   def print_c(self):
-    asC = 'while (' + self.test.print_c()
-    if sameLineBraces:
-      asC += ') {\n'
-    else:
-      asC += ')\n{\n'
-    for childNode in self.body:
-      try:
-        unindented = childNode.print_c()
-        unindented = '\n'.join([indent + x for x in unindented.split('\n')])
-        if not unindented.endswith('}'):
-          unindented += ';'
-          unindented += '\n'
-          asC += unindented
-      except Exception as e:
-        print(traceback.format_exc())
-        print(ast.dump(childNode))
-        return asC
-    return asC + '}'
+    return emit_to_string(self)
+
+  def emit(self, out):
+    out.write('while (' + self.test.print_c() + ')')
+    out.open_block()
+    out.body(self.body)
+    out.close_block()
   
 
 class C_Break(ast.Break):
@@ -697,6 +960,8 @@ class C_Return(ast.Return):
     pass
   
   def print_c(self):
+    if self.value is None:
+      return 'return'
     return 'return ' + self.value.print_c()
 
 class C_ClassDef(ast.ClassDef):
@@ -704,30 +969,61 @@ class C_ClassDef(ast.ClassDef):
     classNames.append(self.name)
   
   def print_c(self):
-    asC = '/*** Class: ' + self.name + ' ***/\n'
+    return emit_to_string(self)
+
+  def emit(self, out):
+    out.write('/*** Class: ' + self.name + ' ***/\n')
     varNames = ClassVariables.scanIn(self)
     if ast.get_docstring(self):
-      asC += '/*\n'
-      asC += ast.get_docstring(self)
+      out.write('/*\n' + ast.get_docstring(self) + '\n*/\n')
       self.body.pop(0)
-      asC += '\n*/\n'
-    asC += 'typedef struct'
-    if sameLineBraces:
-      asC += ' {\n'
-    else:
-      asC += '\n{\n'
-    for var,type in varNames.items():
-      asC += indent + type + ' ' + var + ';\n'
-    asC += '} ' + self.name + ';\n'
+    fields = [[var, type] for var, type in varNames.items()]
+    out.structs[self.name] = {'fields': pack_fields(fields, out.structs) if packStructs else fields,
+                              'sourceOrder': list(varNames)}
+    out.write('typedef struct')
+    out.open_block()
+    for var,type in out.structs[self.name]['fields']:
+      out.write(type + ' ' + var + ';\n')
+    out.close_block()
+    out.write(' ' + self.name + ';\n')
     for node in self.body:
+      state = out.checkpoint()
+      out.mark(node)
       try:
-        asC += node.print_c()
+        emit_node(node, out)
       except Exception as e:
-        print(traceback.format_exc())
-        print("Current code:")
-        print(asC)
-    asC += '\n/*** End Class: ' + self.name + ' ***/\n'
-    return asC
+        out.restore(state)
+        emit_failed(node, e)
+    out.write('\n/*** End Class: ' + self.name + ' ***/\n')
+
+def type_layout(cType, structs):
+  """The (size, alignment) in bytes of a C type, given the fields of the
+  structs that are known. The size of any other type is None, and it is
+  taken to need the largest alignment, 4."""
+  if cType in typeSizes:
+    return typeSizes[cType], typeSizes[cType]
+  if cType in structs:
+    return struct_layout(structs[cType]['fields'], structs)
+  return None, 4
+
+def struct_layout(fields, structs):
+  """The (size, alignment) of a struct whose [name, type] fields are in
+  the given order, each aligned to its size and the whole padded to its
+  largest alignment. The size is None if a field's size isn't known."""
+  offset = 0
+  alignment = 1
+  for name, cType in fields:
+    size, fieldAlignment = type_layout(cType, structs)
+    if size is None:
+      return None, 4
+    offset += -offset % fieldAlignment + size
+    alignment = max(alignment, fieldAlignment)
+  return offset + -offset % alignment, alignment
+
+def pack_fields(fields, structs):
+  """Order fields by alignment, largest first and otherwise as written,
+  so none of them needs padding before it."""
+  return sorted(fields, key=lambda field: -type_layout(field[1], structs)[1])
 
 class ClassVariables(ast.NodeVisitor):
 
@@ -754,15 +1050,31 @@ class ClassVariables(ast.NodeVisitor):
     return walker.varNames
 
 class CNodeTransformer(ast.NodeVisitor):
-  def __init__(self, *args, **kwargs):
+  def __init__(self, followImports=True, *args, **kwargs):
     self.toPrepare = []
+    self.imports = []
+    self.importTime = 0 # Time spent compiling imports, not this module
+    self.followImports = followImports
     self.currentClass = None
+    self.motorGroups = False # Whether the module mentions vex.motorGroup or vex.setGroup
+    self.tasks = set() # Tasks the module defines
     super(CNodeTransformer,self).__init__(*args,**kwargs)
+
+  def visit_C_Module(self, aNode):
+    for node in aNode.body:
+      if (isinstance(node, ast.AsyncFunctionDef) or isinstance(node, ast.FunctionDef)
+          and isinstance(node.returns, ast.Name) and node.returns.id == 'task'):
+        self.tasks.add(node.name)
+    self.generic_visit(aNode)
     
   def visit_C_Import(self, aNode):
     # Make sure that we've compiled this file.
     filePath = '/'.join(aNode.names[0].name.split('.')) + '.py'
-    compile_to_c(filePath)
+    self.imports.append(filePath)
+    if self.followImports:
+      started = time.perf_counter()
+      compile_to_c(filePath)
+      self.importTime += time.perf_counter() - started
 
   def visit_C_ClassDef(self, aNode):
     previousClass = self.currentClass
@@ -778,32 +1090,2201 @@ class CNodeTransformer(ast.NodeVisitor):
       aNode.args.args[0].annotation = self.currentClass.name # Force use of class
     self.generic_visit(aNode)
 
+  def visit_C_Attribute(self, aNode):
+    if aNode.attr in ('motorGroup', 'setGroup'):
+      self.motorGroups = True
+    self.generic_visit(aNode)
+
+  def visit_C_Await(self, aNode):
+    # Only waiting has a RobotC equivalent; a task can only be started
+    self.generic_visit(aNode)
+    name = aNode.value.func.print_c() if isinstance(aNode.value, C_Call) and isinstance(aNode.value.func, (C_Name, C_Attribute)) else None
+    if name in blockingCalls:
+      return
+    if name in self.tasks or userFunctions.get(name) == 'task':
+      warn(aNode, 'a task cannot be awaited; {0} is started with startTask({0}) and runs alongside'.format(name))
+      start = C_Attribute(value=C_Name(id='vex', ctx=ast.Load()), attr='start', ctx=ast.Load())
+      aNode.value = ast.copy_location(C_Call(func=start, args=[C_Name(id=name, ctx=ast.Load())], keywords=[]), aNode.value)
+    else:
+      warn(aNode, 'only vex.sleep, wait1Msec and wait10Msec can be awaited; {} does not wait'.format(name or 'this'))
+
+  def visit_C_AsyncFunctionDef(self, aNode):
+    if aNode.args.args:
+      warn(aNode, 'task {} cannot take parameters; they are left out'.format(aNode.name))
+      aNode.args.args, aNode.args.defaults = [], []
+    aNode.__class__ = C_FunctionDef
+    aNode.returns = ast.copy_location(C_Name(id='task', ctx=ast.Load()), aNode)
+    self.generic_visit(aNode)
+
   def visit(self, node):
     """Visit a node."""
-    if 'C_' + node.__class__.__name__ in globals():
-      node.__class__ = globals()['C_' + node.__class__.__name__]
-      self.toPrepare.append(node)
-    method = 'visit_' + node.__class__.__name__
-    visitor = getattr(self, method, self.generic_visit)
-    visitor(node) # Recursively replace classes
+    cClass = nodeClasses.get(node.__class__)
+    if cClass is not None:
+      node.__class__ = cClass
+      if cClass in preparedClasses:
+        self.toPrepare.append(node)
+    visitor = transformerVisitors.get(node.__class__)
+    if visitor is None:
+      self.generic_visit(node) # Recursively replace classes
+    else:
+      visitor(self, node)
+
+  def generic_visit(self, node):
+    for field in node._fields:
+      value = getattr(node, field, None)
+      if isinstance(value, list):
+        for item in value:
+          if isinstance(item, ast.AST):
+            self.visit(item)
+      elif isinstance(value, ast.AST):
+        self.visit(value)
+
+# Built once, so the transformer never looks up C_ classes or visit_ methods by name
+nodeClasses = {cClass.__bases__[0]: cClass for name, cClass in list(globals().items())
+               if name.startswith('C_') and isinstance(cClass, type) and issubclass(cClass, ast.AST)}
+preparedClasses = {C_FunctionDef, C_AsyncFunctionDef, C_ClassDef, C_arguments} # The only ones whose prepare() does anything
+transformerVisitors = {cClass: getattr(CNodeTransformer, 'visit_' + cClass.__name__)
+                       for cClass in nodeClasses.values() if hasattr(CNodeTransformer, 'visit_' + cClass.__name__)}
+
+def make_constant(value, like):
+  """A C_ literal node for value, placed at like's position."""
+  if sys.version_info >= (3, 8):
+    node = C_Constant(value=value)
+  elif isinstance(value, bool) or value is None:
+    node = C_NameConstant(value=value)
+  else:
+    node = C_Num(n=value)
+  return ast.copy_location(node, like)
+
+def constant_value(aNode):
+  """Return (True, value) if aNode is a numeric or boolean literal."""
+  if isinstance(aNode, C_Num):
+    value = aNode.n
+  elif isinstance(aNode, (C_Constant, ast.NameConstant)):
+    value = aNode.value
+  else:
+    return False, None
+  if isinstance(value, (bool, int, float)):
+    return True, value
+  return False, None
+
+def c_int_op(op, left, right):
+  """Apply a binary operator to two ints the way RobotC would, or return
+  None if the result is undefined or does not fit in an int."""
+  if isinstance(op, C_Add):
+    result = left + right
+  elif isinstance(op, C_Sub):
+    result = left - right
+  elif isinstance(op, C_Mult):
+    result = left * right
+  elif isinstance(op, (C_Div, C_Mod)):
+    if right == 0:
+      return None
+    quotient = abs(left) // abs(right) # C truncates towards zero
+    if (left < 0) != (right < 0):
+      quotient = -quotient
+    result = quotient if isinstance(op, C_Div) else left - right * quotient
+  elif isinstance(op, C_LShift):
+    if left < 0 or not 0 <= right < 16:
+      return None
+    result = left << right
+  elif isinstance(op, C_RShift):
+    if left < 0 or not 0 <= right < 16:
+      return None
+    result = left >> right
+  elif isinstance(op, C_BitOr):
+    result = left | right
+  elif isinstance(op, C_BitXor):
+    result = left ^ right
+  elif isinstance(op, C_BitAnd):
+    result = left & right
+  else:
+    return None
+  if not intMin <= result <= intMax:
+    return None
+  return result
+
+compareOps = {
+  C_Eq: lambda a, b: a == b,
+  C_NotEq: lambda a, b: a != b,
+  C_Lt: lambda a, b: a < b,
+  C_LtE: lambda a, b: a <= b,
+  C_Gt: lambda a, b: a > b,
+  C_GtE: lambda a, b: a >= b,
+}
+
+class ConstantFolder(ast.NodeTransformer):
+  """Evaluates constant expressions with RobotC semantics, and drops the
+  branches of if/while statements whose test is constant.
+
+  Only integer arithmetic is folded, since RobotC floats are single
+  precision and folding them here would change results."""
+
+  def visit_C_BinOp(self, aNode):
+    self.generic_visit(aNode)
+    isLeft, left = constant_value(aNode.left)
+    isRight, right = constant_value(aNode.right)
+    if isLeft and isRight and not isinstance(left, float) and not isinstance(right, float):
+      result = c_int_op(aNode.op, int(left), int(right))
+      if result is not None:
+        return make_constant(result, aNode)
+    return aNode
+
+  def visit_C_UnaryOp(self, aNode):
+    self.generic_visit(aNode)
+    isConstant, value = constant_value(aNode.operand)
+    if not isConstant:
+      return aNode
+    if isinstance(aNode.op, C_Not):
+      return make_constant(not value, aNode)
+    if isinstance(aNode.op, C_UAdd):
+      return make_constant(+value, aNode)
+    if isinstance(aNode.op, C_USub) and intMin <= -value <= intMax:
+      return make_constant(-value, aNode)
+    if isinstance(aNode.op, C_Invert) and not isinstance(value, float):
+      return make_constant(~int(value), aNode)
+    return aNode
+
+  def visit_C_Compare(self, aNode):
+    self.generic_visit(aNode)
+    operands = [aNode.left] + aNode.comparators
+    values = [constant_value(operand) for operand in operands]
+    if not all(isConstant for isConstant, value in values) or not all(type(op) in compareOps for op in aNode.ops):
+      return aNode
+    result = all(compareOps[type(op)](values[i][1], values[i + 1][1]) for i, op in enumerate(aNode.ops))
+    return make_constant(result, aNode)
+
+  def visit_C_BoolOp(self, aNode):
+    self.generic_visit(aNode)
+    isAnd = isinstance(aNode.op, C_And)
+    values = list(aNode.values)
+    # A leading constant either decides the result (false && ..., true || ...)
+    # or can be dropped, as long as the result stays a boolean expression
+    while values:
+      isConstant, value = constant_value(values[0])
+      if not isConstant:
+        break
+      if bool(value) != isAnd:
+        return make_constant(not isAnd, aNode)
+      if len(values) > 2 or (len(values) == 2 and constant_value(values[1])[0]):
+        values.pop(0)
+      elif len(values) == 1:
+        return make_constant(isAnd, aNode)
+      else:
+        break
+    aNode.values = values
+    return aNode
 
-def compile_to_c(filename):
-  if not os.path.exists(filename):
-    if os.path.exists(os.path.join(os.path.dirname(os.path.realpath(__file__)),filename)):
+  def visit_C_IfExp(self, aNode):
+    self.generic_visit(aNode)
+    isConstant, value = constant_value(aNode.test)
+    if isConstant:
+      return aNode.body if value else aNode.orelse
+    return aNode
+
+  def visit_C_If(self, aNode):
+    self.generic_visit(aNode)
+    isConstant, value = constant_value(aNode.test)
+    if isConstant:
+      return branch(aNode.body if value else aNode.orelse, aNode)
+    return aNode
+
+  def visit_C_While(self, aNode):
+    self.generic_visit(aNode)
+    isConstant, value = constant_value(aNode.test)
+    if isConstant and not value:
+      return branch(aNode.orelse, aNode)
+    return aNode
+
+def branch(statements, like):
+  """The statements of the branch a constant test takes, to splice into the
+  enclosing block. A branch that declares variables stays a block of its
+  own, so its declarations cannot clash with the enclosing block's."""
+  if not any(isinstance(statement, ast.AnnAssign) for statement in statements):
+    return statements
+  return ast.copy_location(C_If(test=make_constant(True, like), body=statements, orelse=[]), like)
+
+def is_trivial(aNode):
+  """Whether aNode is cheap and side-effect free enough to evaluate twice."""
+  if isinstance(aNode, C_Attribute):
+    return is_trivial(aNode.value)
+  return isinstance(aNode, C_Name) or constant_value(aNode)[0]
+
+def is_decorated(aNode, name):
+  return any(isinstance(decorator, (C_Name, C_Attribute)) and decorator.print_c() == name
+             for decorator in aNode.decorator_list)
+
+class FunctionInliner(ast.NodeTransformer):
+  """Replaces calls to small pure functions with their return expression.
+
+  A function qualifies if its body is a single return (after any docstring),
+  the expression has at most inlineThreshold nodes, mentions nothing but its
+  parameters and calls only pureFunctions, and it isn't decorated with
+  @vex.noinline. Only functions defined in the module being compiled are
+  inlined, so each module can still be compiled on its own.
+
+  A call is only inlined if each argument already has its parameter's type
+  and the expression already has the return type, since the conversions the
+  call would make (such as 5 to a float parameter) change what the
+  expression computes."""
+
+  def __init__(self, module):
+    self.candidates = {}
+    self.function = None
+    self.types = {}
+    for aNode in module.body:
+      if isinstance(aNode, C_FunctionDef) and self.qualifies(aNode):
+        self.candidates[aNode.name] = aNode
+
+  def qualifies(self, aNode):
+    if is_decorated(aNode, 'vex.noinline') or aNode.args.vararg or aNode.args.kwarg:
+      return False
+    body = aNode.body[1:] if ast.get_docstring(aNode) else aNode.body
+    if len(body) != 1 or not isinstance(body[0], C_Return) or body[0].value is None:
+      return False
+    if aNode.returns is not None and not converts_exactly(expression_type(body[0].value, function_types(aNode)),
+                                                          annotation_type(aNode.returns)):
+      return False
+    params = set(arg.arg for arg in aNode.args.args)
+    size = 0
+    for node in ast.walk(body[0].value):
+      if isinstance(node, ast.expr_context):
+        continue
+      size += 1
+      if isinstance(node, C_Call):
+        if not isinstance(node.func, C_Name) or node.func.id not in pureFunctions or node.keywords:
+          return False
+      elif isinstance(node, C_Name):
+        if node.id not in params and node.id not in pureFunctions and node.id not in ('True', 'False', 'None'):
+          return False
+      elif not isinstance(node, (C_BinOp, C_UnaryOp, C_Compare, C_BoolOp, C_IfExp, ast.operator,
+                                 ast.unaryop, ast.cmpop, ast.boolop)) and not constant_value(node)[0]:
+        return False
+    return size <= inlineThreshold
+
+  def uses(self, expression, param):
+    """How often param is used, and whether any use is conditional."""
+    count = 0
+    conditional = False
+    pending = [(expression, False)]
+    while pending:
+      node, isConditional = pending.pop()
+      if isinstance(node, C_Name) and node.id == param:
+        count += 1
+        conditional = conditional or isConditional
+      elif isinstance(node, C_IfExp):
+        pending += [(node.test, isConditional), (node.body, True), (node.orelse, True)]
+      elif isinstance(node, C_BoolOp):
+        pending += [(value, isConditional or i > 0) for i, value in enumerate(node.values)]
+      else:
+        pending += [(child, isConditional) for child in ast.iter_child_nodes(node)]
+    return count, conditional
+
+  def visit_C_FunctionDef(self, aNode):
+    outer = self.function, self.types
+    self.function, self.types = aNode, None # Only found if a call might be inlined
+    self.generic_visit(aNode)
+    self.function, self.types = outer
+    return aNode
+
+  def caller_types(self):
+    if self.types is None:
+      self.types = function_types(self.function)
+    return self.types
+
+  def visit_C_Call(self, aNode):
+    self.generic_visit(aNode)
+    if not isinstance(aNode.func, C_Name) or aNode.func.id not in self.candidates or aNode.keywords:
+      return aNode
+    function = self.candidates[aNode.func.id]
+    if not function.args.minArgs <= len(aNode.args) <= function.args.maxArgs:
+      return aNode
+    if any(isinstance(arg, ast.Starred) for arg in aNode.args):
+      return aNode
+    expression = function.body[-1].value
+    values = {}
+    for i, param in enumerate(function.args.args):
+      if i < len(aNode.args):
+        value = aNode.args[i]
+      else:
+        value = function.args.defaults[i - function.args.minArgs]
+      if param.annotation is None or not converts_exactly(expression_type(value, self.caller_types()), annotation_type(param.annotation)):
+        return aNode
+      count, conditional = self.uses(expression, param.arg)
+      if not is_trivial(value) and (count != 1 or conditional):
+        return aNode # Inlining would evaluate the argument a different number of times
+      values[param.arg] = value
+    return ast.copy_location(ParameterSubstituter(values).visit(copy.deepcopy(expression)), aNode)
+
+def converts_exactly(fromType, toType):
+  """Whether a value of C type fromType keeps its value as a toType."""
+  if fromType is None:
+    return False
+  return fromType == toType or toType == 'int' and integerPromotions.get(fromType, fromType) in ('int', 'bool')
+
+class ParameterSubstituter(ast.NodeTransformer):
+  def __init__(self, values):
+    self.values = values
+
+  def visit_C_Name(self, aNode):
+    if aNode.id in self.values:
+      return copy.deepcopy(self.values[aNode.id])
+    return aNode
+
+def annotation_type(annotation):
+  if isinstance(annotation, str):
+    return annotation
+  return annotation.print_c()
+
+def function_types(aNode):
+  """The declared types of a function's parameters and annotated locals."""
+  types = {}
+  for arg in aNode.args.args:
+    if arg.annotation is not None:
+      types[arg.arg] = annotation_type(arg.annotation)
+  for node in ast.walk(aNode):
+    if isinstance(node, ast.AnnAssign) and isinstance(node.target, C_Name):
+      types[node.target.id] = annotation_type(node.annotation)
+  return types
+
+def local_types(aNode):
+  """function_types(aNode) for the passes after TypeInference, which has
+  declared every local by then. Found once per function, and each
+  LoweringPass adds the temporaries it declared, so those passes don't
+  walk it again."""
+  if not hasattr(aNode, 'localTypes'):
+    aNode.localTypes = function_types(aNode)
+  return aNode.localTypes
+
+def expression_type(aNode, types):
+  """The C type of an expression, or None if it isn't known."""
+  isConstant, value = constant_value(aNode)
+  if isConstant:
+    return type(value).__name__
+  if isinstance(aNode, C_Name):
+    return types.get(aNode.id, builtinTypes.get(aNode.id))
+  if isinstance(aNode, C_Subscript) and isinstance(aNode.value, C_Name):
+    return hardwareArrays.get(aNode.value.id, localArrays.get(aNode.value.id))
+  if isinstance(aNode, C_Attribute) and isinstance(aNode.value, C_Name) and aNode.value.id not in types:
+    return builtinTypes.get(aNode.value.id)
+  if isinstance(aNode, C_Call) and isinstance(aNode.func, C_Name):
+    if aNode.func.id in ('abs', 'sgn') and len(aNode.args) == 1:
+      return expression_type(aNode.args[0], types)
+    if aNode.func.id in pureFunctions:
+      return 'float'
+    returns = localReturns.get(aNode.func.id) or userFunctions.get(aNode.func.id) or builtinTypes.get(aNode.func.id)
+    return returns if returns not in ('void', 'task') else None
+  if isinstance(aNode, (C_Compare, C_BoolOp)):
+    return 'bool'
+  if isinstance(aNode, C_UnaryOp):
+    return 'bool' if isinstance(aNode.op, C_Not) else expression_type(aNode.operand, types)
+  if isinstance(aNode, (C_BinOp, C_IfExp)):
+    if isinstance(aNode, C_BinOp):
+      operands = [expression_type(aNode.left, types), expression_type(aNode.right, types)]
+    else:
+      operands = [expression_type(aNode.body, types), expression_type(aNode.orelse, types)]
+    operands = [integerPromotions.get(operand, operand) for operand in operands]
+    if None in operands or not set(operands) <= {'int', 'float', 'bool'}:
+      return None
+    return 'float' if 'float' in operands else 'int'
+  return None
+
+class LoweringPass(ast.NodeTransformer):
+  """Base for passes that introduce typed temporaries inside functions.
+  self.types holds the declared types in the current function, or None
+  outside of one."""
+
+  def __init__(self, module):
+    if not hasattr(module, 'usedNames'):
+      module.usedNames = set(node.id for node in ast.walk(module) if isinstance(node, ast.Name))
+    self.usedNames = module.usedNames # Shared, so it holds the temporaries of earlier passes too
+    self.counter = 0
+    self.types = None
+    self.newTypes = None
+
+  def new_temporary(self):
+    while True:
+      self.counter += 1
+      name = '_t{}'.format(self.counter)
+      if name not in self.usedNames:
+        self.usedNames.add(name)
+        return name
+
+  def declare(self, name, cType, value=None):
+    if self.newTypes is not None:
+      self.newTypes[name] = cType
+    return C_AnnAssign(target=C_Name(id=name, ctx=ast.Store()), annotation=C_Name(id=cType, ctx=ast.Load()),
+                       value=value, simple=1)
+
+  def visit_C_FunctionDef(self, aNode):
+    outer = self.types, self.newTypes
+    self.types, self.newTypes = local_types(aNode), {}
+    self.generic_visit(aNode)
+    self.types.update(self.newTypes) # Seen by the passes after this one
+    self.types, self.newTypes = outer
+    return aNode
+
+class TemporaryLowering(LoweringPass):
+  """Makes chains evaluate shared subexpressions once.
+
+  In a chained comparison such as a < f() < b, each middle operand that
+  isn't trivial is stored in a temporary as it is first compared, and the
+  next comparison reads the temporary. A chained assignment such as
+  motor[a] = motor[b] = f() stores the value in a temporary and assigns it
+  to each target in turn. Temporaries are declared just before the
+  statement, with the type of the expression (or, for assignments, of a
+  target), and only inside functions; chains whose type isn't known are
+  left as they are."""
+
+  def generic_visit(self, aNode):
+    aNode = super(TemporaryLowering, self).generic_visit(aNode)
+    if self.types is None or not isinstance(aNode, ast.stmt):
+      return aNode
+    declarations = []
+    for field, value in ast.iter_fields(aNode):
+      if field in ('body', 'orelse') or not isinstance(value, ast.AST):
+        continue
+      for node in ast.walk(value):
+        if isinstance(node, C_Compare) and len(node.ops) > 1:
+          declarations += self.lower_compare(node)
+    if isinstance(aNode, C_Assign) and len(aNode.targets) > 1:
+      statements = self.lower_assign(aNode)
+    else:
+      statements = [aNode]
+    if declarations or len(statements) > 1:
+      return declarations + statements
+    return aNode
+
+  def lower_compare(self, aNode):
+    declarations = []
+    for i, operand in enumerate(aNode.comparators[:-1]):
+      cType = expression_type(operand, self.types)
+      if is_trivial(operand) or cType is None:
+        continue
+      name = self.new_temporary()
+      declarations.append(self.declare(name, cType))
+      aNode.comparators[i] = ast.copy_location(C_TempAssign(target=C_Name(id=name, ctx=ast.Store()), value=operand), operand)
+    return declarations
+
+  def lower_assign(self, aNode):
+    value = aNode.value
+    if is_trivial(value):
+      return [ast.copy_location(C_Assign(targets=[target], value=copy.deepcopy(value)), aNode) for target in aNode.targets]
+    if isinstance(value, C_Call) and value.func.print_c() in classNames:
+      return [aNode]
+    cType = expression_type(value, self.types)
+    for target in aNode.targets:
+      cType = cType or expression_type(target, self.types)
+    if cType is None:
+      return [aNode]
+    name = self.new_temporary()
+    statements = [ast.copy_location(self.declare(name, cType, value), aNode)]
+    for target in aNode.targets:
+      statements.append(ast.copy_location(C_Assign(targets=[target], value=C_Name(id=name, ctx=ast.Load())), aNode))
+    return statements
+
+def assigned_names(statements):
+  """Names that statements (and anything nested in them) assign to."""
+  names = set()
+  for statement in statements:
+    for node in ast.walk(statement):
+      if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+        names.add(node.id)
+      elif isinstance(node, C_TempAssign):
+        names.add(node.target.id)
+  return names
+
+def module_globals(module):
+  """Names a module assigns outside its functions and classes."""
+  names = set()
+  for statement in module.body:
+    if not isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+      names |= assigned_names([statement])
+  return names
+
+def add_globals(names):
+  """Add the module-level variables of the module being compiled to
+  globalNames, in the same order however the module is compiled."""
+  globalNames.extend([name for name in sorted(names) if name not in globalNames])
+
+class LoopInvariantHoisting(LoweringPass):
+  """Moves work that doesn't change between iterations out of range() loops.
+
+  Python evaluates range() arguments once, so any bound or step that isn't
+  a literal or an untouched local is computed into a temporary before the
+  loop. Inside the body, the largest side-effect free expressions over
+  locals that the loop never assigns (arithmetic, comparisons and
+  pureFunctions calls, but nothing that reads hardware, fields or arrays)
+  are computed once before the loop too. Division and modulo by a
+  non-literal are never hoisted, as the loop may guard against zero.
+  Temporaries hoisted out of an inner loop move further out if they can.
+
+  Without invariants (--no-hoist), only a step that isn't a literal or an
+  untouched local is computed before the loop, since the emitted loop
+  would otherwise evaluate it twice per iteration. A loop whose step is 0,
+  which Python rejects, is left out with a warning either way."""
+
+  def __init__(self, module, invariants=True):
+    super(LoopInvariantHoisting, self).__init__(module)
+    self.temporaries = set()
+    self.hoistInvariants = invariants
+
+  def new_temporary(self):
+    name = super(LoopInvariantHoisting, self).new_temporary()
+    self.temporaries.add(name)
+    return name
+
+  def visit_C_For(self, aNode):
+    self.generic_visit(aNode)
+    if self.types is None or not isinstance(aNode.iter, C_Call) or not aNode.iter.args:
+      return aNode
+    args = aNode.iter.args
+    if len(args) > 2 and constant_value(args[2]) == (True, 0):
+      warn(aNode, 'range() step is 0; loop left out')
+      return []
+    assigned = assigned_names(aNode.body) | assigned_names([aNode.target])
+    declarations = []
+    boundsHoisted = False
+    for i in range(len(args) - 1, -1, -1):
+      isLow = i == 0 and len(args) > 1
+      arg = args[i]
+      if constant_value(arg)[0] or (isinstance(arg, C_Name) and arg.id not in assigned):
+        continue
+      if isLow and not boundsHoisted:
+        continue # The initializer is evaluated once anyway
+      if not self.hoistInvariants and i != 2 and not isLow:
+        continue # Left in the condition, as asked
+      name = self.new_temporary()
+      declarations.insert(0, ast.copy_location(self.declare(name, expression_type(arg, self.types) or 'int', arg), aNode))
+      args[i] = C_Name(id=name, ctx=ast.Load())
+      boundsHoisted = True
+    if not self.hoistInvariants:
+      return declarations + [aNode] if declarations else aNode
+    self.invariants = {}
+    self.assigned = assigned
+    body = []
+    for statement in aNode.body:
+      if (isinstance(statement, C_AnnAssign) and statement.target.id in self.temporaries
+          and (self.is_invariant(statement.value) or constant_value(statement.value)[0]
+               or isinstance(statement.value, C_Name) and statement.value.id in self.types
+               and statement.value.id not in assigned)):
+        declarations.append(statement)
+      else:
+        self.hoist_from(statement)
+        body.append(statement)
+    aNode.body = body
+    for name, expression in self.invariants.values():
+      declarations.append(ast.copy_location(self.declare(name, expression_type(expression, self.types), expression), aNode))
+    return declarations + [aNode] if declarations else aNode
+
+  def hoist_from(self, aNode):
+    """Replace the largest invariant expressions under aNode with temporaries."""
+    for field, value in ast.iter_fields(aNode):
+      if field == 'annotation':
+        continue
+      if isinstance(value, list):
+        for i, item in enumerate(value):
+          if isinstance(item, ast.AST):
+            value[i] = self.hoisted(item)
+      elif isinstance(value, ast.AST):
+        setattr(aNode, field, self.hoisted(value))
+
+  def hoisted(self, aNode):
+    if isinstance(aNode, ast.expr) and self.is_invariant(aNode) and expression_type(aNode, self.types):
+      key = aNode.print_c()
+      if key not in self.invariants:
+        self.invariants[key] = (self.new_temporary(), aNode)
+      return ast.copy_location(C_Name(id=self.invariants[key][0], ctx=ast.Load()), aNode)
+    self.hoist_from(aNode)
+    return aNode
+
+  def is_invariant(self, aNode):
+    if not isinstance(aNode, (C_BinOp, C_UnaryOp, C_Compare, C_BoolOp, C_IfExp, C_Call)):
+      return False # Not worth a temporary on its own
+    mentionsLocal = False
+    for node in ast.walk(aNode):
+      if isinstance(node, C_Name):
+        if node.id in self.types and node.id not in self.assigned:
+          mentionsLocal = True
+        elif not node.id in pureFunctions:
+          return False
+      elif isinstance(node, C_Call):
+        if not isinstance(node.func, C_Name) or node.func.id not in pureFunctions or node.keywords:
+          return False
+      elif isinstance(node, C_BinOp) and isinstance(node.op, (C_Div, C_Mod)) and not constant_value(node.right)[0]:
+        return False
+      elif not isinstance(node, (C_BinOp, C_UnaryOp, C_Compare, C_BoolOp, C_IfExp, ast.operator, ast.unaryop,
+                                 ast.cmpop, ast.boolop, ast.expr_context)) and not constant_value(node)[0]:
+        return False
+    return mentionsLocal
+
+def warn(aNode, message):
+  """Report a problem with the module being lowered."""
+  diagnostics.append('line {}: {}'.format(getattr(aNode, 'lineno', '?'), message))
+
+def join_types(first, second):
+  """The narrowest of bool, int and float that holds both types. Anything
+  else (or nothing) joins to whichever type is known first."""
+  if first is None:
+    return second
+  if second is not None and first != second:
+    first, second = integerPromotions.get(first, first), integerPromotions.get(second, second)
+  if second is not None and first != second and {first, second} <= {'bool', 'int', 'float'}:
+    return 'float' if 'float' in (first, second) else 'int'
+  return first
+
+def own_nodes(aNode):
+  """Every node under a function in source order, not counting nested
+  function bodies."""
+  pending = list(ast.iter_child_nodes(aNode))[::-1]
+  while pending:
+    node = pending.pop()
+    yield node
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+      pending.extend(list(ast.iter_child_nodes(node))[::-1])
+
+class TypeInference(object):
+  """Gives every local a C type, and every function a return type.
+
+  Unannotated locals (for loop variables included) are declared with the
+  narrowest of bool, int and float that holds every value assigned to
+  them, and a function without a return annotation returns the type of
+  its return values, or void. Both are found together, as they depend on
+  each other. A local whose first use is a plain assignment at the top of
+  its function is declared there; the rest are declared at the top.
+  Integral float literals in +, - and * arithmetic that is stored in an
+  int are written as ints, so the arithmetic stays integral, and float
+  arithmetic left inside a task's loops is reported, as the Cortex does it
+  in software. Locals of unknown type are declared float, with a warning."""
+
+  def __init__(self, module):
+    self.module = module
+    self.globals = set(globalNames) | module_globals(module)
+    self.functions = []
+    module.usedNames = set() # For the passes after this one, see LoweringPass
+    for node in ast.walk(module):
+      if isinstance(node, ast.Name):
+        module.usedNames.add(node.id)
+      elif isinstance(node, C_FunctionDef):
+        self.functions.append(node)
+    self.declared = {}
+    self.nodes = {}
+    self.inferred = {}
+    self.returns = {}
+    for function in self.functions:
+      self.declared[function] = function_types(function)
+      self.nodes[function] = list(own_nodes(function)) # Unchanged until apply()
+      self.inferred[function] = {name: None for name in self.local_names(function)}
+
+  def local_names(self, aNode):
+    names = set()
+    excluded = self.globals | set(self.declared[aNode]) | set(arg.arg for arg in aNode.args.args)
+    for node in self.nodes[aNode]:
+      if isinstance(node, ast.Global):
+        excluded.update(node.names)
+      elif isinstance(node, C_For) and isinstance(node.target, C_Name):
+        names.add(node.target.id)
+      elif isinstance(node, (C_Assign, C_AugAssign)):
+        targets = node.targets if isinstance(node, C_Assign) else [node.target]
+        constructs = isinstance(node.value, C_Call) and node.value.func.print_c() in classNames
+        for target in targets:
+          if isinstance(target, C_Name):
+            (excluded if constructs else names).add(target.id)
+    return names - excluded
+
+  def run(self):
+    toInfer = [function for function in self.functions if self.inferred[function] or function.returns is None]
+    changed = True
+    while changed:
+      changed = False
+      for function in toInfer:
+        changed = self.infer(function) or changed
+      for function, returns in self.returns.items():
+        localReturns[function.name] = None
+      for function, returns in self.returns.items():
+        localReturns[function.name] = join_types(localReturns[function.name], returns)
+    for function in self.functions:
+      self.apply(function)
+
+  def types(self, aNode):
+    types = dict(self.declared[aNode])
+    types.update((name, cType) for name, cType in self.inferred[aNode].items() if cType is not None)
+    return types
+
+  def infer(self, aNode):
+    """Widen the types of aNode's locals and return value once. Returns
+    True if anything changed."""
+    inferred = self.inferred[aNode]
+    before = (dict(inferred), self.returns.get(aNode))
+    types = self.types(aNode)
+    returns = None
+    hasValue = False
+    for node in self.nodes[aNode]:
+      if isinstance(node, C_For) and isinstance(node.target, C_Name) and node.target.id in inferred:
+        inferred[node.target.id] = join_types(inferred[node.target.id], 'int')
+      elif isinstance(node, C_Assign):
+        for target in node.targets:
+          if isinstance(target, C_Name) and target.id in inferred:
+            inferred[target.id] = join_types(inferred[target.id], expression_type(node.value, types))
+      elif isinstance(node, C_AugAssign) and isinstance(node.target, C_Name) and node.target.id in inferred:
+        value = C_BinOp(left=node.target, op=node.op, right=node.value)
+        inferred[node.target.id] = join_types(inferred[node.target.id], expression_type(value, types))
+      elif isinstance(node, C_Return) and node.value is not None:
+        hasValue = True
+        returns = join_types(returns, expression_type(node.value, types))
+    if aNode.returns is None:
+      self.returns[aNode] = returns if hasValue else 'void'
+    return (inferred, self.returns.get(aNode)) != before
+
+  def apply(self, aNode):
+    inferred = self.inferred[aNode]
+    if aNode.returns is None:
+      if self.returns[aNode] is None:
+        warn(aNode, 'return type of {} not known; declared as float'.format(aNode.name))
+        self.returns[aNode] = localReturns[aNode.name] = 'float'
+      aNode.returns = ast.copy_location(C_Name(id=self.returns[aNode], ctx=ast.Load()), aNode)
+    start = 1 if ast.get_docstring(aNode) else 0
+    declarations = []
+    firstUses = self.first_uses(aNode)
+    for name in sorted(inferred, key=lambda name: firstUses.get(name, (0, 0))):
+      if inferred[name] is None:
+        warn(aNode, 'type of {} in {} not known; declared as float'.format(name, aNode.name))
+        inferred[name] = 'float'
+      declaration = C_AnnAssign(target=C_Name(id=name, ctx=ast.Store()), annotation=C_Name(id=inferred[name], ctx=ast.Load()),
+                                value=None, simple=1)
+      statement = self.first_use_statement(aNode, name, start, firstUses.get(name, (0, 0)))
+      if statement is None:
+        declarations.append(ast.copy_location(declaration, aNode))
+      else:
+        declaration.value = statement.value
+        aNode.body[aNode.body.index(statement)] = ast.copy_location(declaration, statement)
+    aNode.body[start:start] = declarations
+    types = self.types(aNode)
+    loops = []
+    for node in own_nodes(aNode):
+      if isinstance(node, (C_Assign, C_AnnAssign, C_AugAssign)) and node.value is not None:
+        targets = node.targets if isinstance(node, C_Assign) else [node.target]
+        if all(expression_type(target, types) == 'int' for target in targets):
+          node.value = self.narrowed(node.value)
+      elif isinstance(node, C_Return) and node.value is not None and aNode.returns.print_c() == 'int':
+        node.value = self.narrowed(node.value)
+      elif isinstance(node, (C_While, C_For)):
+        loops.append(node)
+    if aNode.returns.print_c() == 'task':
+      reported = set()
+      for node in loops:
+        self.report_float_math(node, types, reported)
+
+  def first_uses(self, aNode):
+    """The (line, column) where each inferred local of aNode is first used."""
+    inferred = self.inferred[aNode]
+    uses = {}
+    for node in self.nodes[aNode]:
+      if isinstance(node, C_Name) and node.id in inferred and hasattr(node, 'lineno'):
+        position = (node.lineno, node.col_offset)
+        if node.id not in uses or position < uses[node.id]:
+          uses[node.id] = position
+    return uses
+
+  def first_use_statement(self, aNode, name, start, first):
+    """The top-level plain assignment that is the first use of name, if any."""
+    for statement in aNode.body[start:]:
+      if (isinstance(statement, C_Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], C_Name)
+          and statement.targets[0].id == name and (statement.lineno, statement.col_offset) == first):
+        return statement
+    return None
+
+  def narrowed(self, aNode):
+    """aNode with integral float literals in +, - and * arithmetic as ints."""
+    isConstant, value = constant_value(aNode)
+    if isConstant and isinstance(value, float) and value.is_integer() and intMin <= value <= intMax:
+      return make_constant(int(value), aNode)
+    if isinstance(aNode, C_BinOp) and isinstance(aNode.op, (C_Add, C_Sub, C_Mult)):
+      aNode.left = self.narrowed(aNode.left)
+      aNode.right = self.narrowed(aNode.right)
+    elif isinstance(aNode, C_UnaryOp) and isinstance(aNode.op, (C_UAdd, C_USub)):
+      aNode.operand = self.narrowed(aNode.operand)
+    elif isinstance(aNode, C_IfExp):
+      aNode.body = self.narrowed(aNode.body)
+      aNode.orelse = self.narrowed(aNode.orelse)
+    return aNode
+
+  def report_float_math(self, aNode, types, reported):
+    """Warn about the outermost float arithmetic under aNode."""
+    if id(aNode) in reported:
+      return
+    reported.add(id(aNode))
+    isMath = (isinstance(aNode, C_BinOp) or isinstance(aNode, C_Call) and isinstance(aNode.func, C_Name)
+              and aNode.func.id in pureFunctions)
+    if isMath and expression_type(aNode, types) == 'float':
+      warn(aNode, 'float arithmetic in a task loop: ' + aNode.print_c())
+      reported.update(id(node) for node in ast.walk(aNode))
+      return
+    if isinstance(aNode, C_AugAssign) and 'float' in (expression_type(aNode.target, types), expression_type(aNode.value, types)):
+      warn(aNode, 'float arithmetic in a task loop: ' + aNode.print_c())
+      reported.update(id(node) for node in ast.walk(aNode))
+      return
+    for child in ast.iter_child_nodes(aNode):
+      self.report_float_math(child, types, reported)
+
+def power_of_two(aNode):
+  """k if aNode is the int literal 2**k for some k >= 1, otherwise None."""
+  isConstant, value = constant_value(aNode)
+  if isConstant and type(value) is int and value > 1 and value & (value - 1) == 0:
+    return value.bit_length() - 1
+  return None
+
+def promoted_type(aNode, types):
+  """The type an expression has in arithmetic, with narrow ints as int."""
+  cType = expression_type(aNode, types)
+  return integerPromotions.get(cType, cType)
+
+def non_negative(aNode, types):
+  """Whether an int expression can be shown never to be negative."""
+  isConstant, value = constant_value(aNode)
+  if isConstant:
+    return value >= 0
+  if isinstance(aNode, C_BinOp):
+    if isinstance(aNode.op, C_BitAnd):
+      return non_negative(aNode.left, types) or non_negative(aNode.right, types)
+    if isinstance(aNode.op, (C_RShift, C_Mod)):
+      return non_negative(aNode.left, types)
+    if isinstance(aNode.op, C_Div):
+      return non_negative(aNode.left, types) and non_negative(aNode.right, types)
+  return expression_type(aNode, types) in ('bool', 'ubyte', 'word')
+
+class StrengthReduction(ast.NodeTransformer):
+  """Rewrites int multiplication, division and modulo by powers of two as
+  shifts and masks.
+
+  x * 2**k becomes x << k. RobotC division truncates towards zero, so
+  x / 2**k only becomes x >> k if x can't be negative; otherwise x is
+  biased by 2**k - 1 when negative, as (x + ((x >> 15) & (2**k - 1))) >> k.
+  Likewise x % 2**k becomes x & (2**k - 1), or
+  x - ((x + ((x >> 15) & (2**k - 1))) & -2**k). The biased forms read x
+  twice, so they are only used when x is trivial. Compound assignments are
+  rewritten the same way. Only operands known to be int (or a narrower
+  integer type, which C promotes to int) are touched, and only inside
+  functions."""
+
+  def __init__(self):
+    self.types = None
+
+  def visit_C_FunctionDef(self, aNode):
+    previousTypes = self.types
+    self.types = local_types(aNode)
+    self.generic_visit(aNode)
+    self.types = previousTypes
+    return aNode
+
+  def visit_C_BinOp(self, aNode):
+    self.generic_visit(aNode)
+    if isinstance(aNode.op, C_Mult) and power_of_two(aNode.left) is not None:
+      reduced = self.reduced(aNode.right, aNode.op, aNode.left, aNode)
+    else:
+      reduced = self.reduced(aNode.left, aNode.op, aNode.right, aNode)
+    return reduced or aNode
+
+  def visit_C_AugAssign(self, aNode):
+    self.generic_visit(aNode)
+    k = power_of_two(aNode.value)
+    if self.types is None or k is None or promoted_type(aNode.target, self.types) != 'int':
+      return aNode
+    if isinstance(aNode.op, C_Mult):
+      aNode.op, aNode.value = C_LShift(), make_constant(k, aNode.value)
+    elif isinstance(aNode.op, (C_Div, C_Mod)) and non_negative(aNode.target, self.types):
+      aNode.op, aNode.value = (C_RShift(), make_constant(k, aNode.value)) if isinstance(aNode.op, C_Div) else \
+                              (C_BitAnd(), make_constant((1 << k) - 1, aNode.value))
+    elif isinstance(aNode.op, (C_Div, C_Mod)) and isinstance(aNode.target, C_Name):
+      value = self.reduced(C_Name(id=aNode.target.id, ctx=ast.Load()), aNode.op, aNode.value, aNode)
+      return ast.copy_location(C_Assign(targets=[aNode.target], value=value), aNode)
+    return aNode
+
+  def reduced(self, left, op, right, like):
+    """The cheaper form of left op right, or None if there isn't one."""
+    k = power_of_two(right)
+    if self.types is None or k is None or promoted_type(left, self.types) != 'int':
+      return None
+    def binop(left, op, right):
+      return ast.copy_location(C_BinOp(left=left, op=op, right=right), like)
+    mask = make_constant((1 << k) - 1, like)
+    if isinstance(op, C_Mult):
+      return binop(left, C_LShift(), make_constant(k, like))
+    if not isinstance(op, (C_Div, C_Mod)):
+      return None
+    if non_negative(left, self.types):
+      return binop(left, C_RShift(), make_constant(k, like)) if isinstance(op, C_Div) else binop(left, C_BitAnd(), mask)
+    if not is_trivial(left):
+      return None
+    sign = binop(copy.deepcopy(left), C_RShift(), make_constant(intMax.bit_length(), like))
+    biased = binop(copy.deepcopy(left), C_Add(), binop(sign, C_BitAnd(), mask))
+    if isinstance(op, C_Div):
+      return binop(biased, C_RShift(), make_constant(k, like))
+    return binop(left, C_Sub(), binop(biased, C_BitAnd(), make_constant(-(1 << k), like)))
+
+class NotConstant(Exception):
+  """Raised when code can't be evaluated at compile time."""
+
+mathFunctions = {'abs': abs, 'sgn': lambda x: (x > 0) - (x < 0), 'sqrt': math.sqrt, 'sin': math.sin,
+                 'cos': math.cos, 'tan': math.tan, 'atan': math.atan, 'exp': math.exp, 'log': math.log,
+                 'round': round, 'floor': math.floor, 'ceil': math.ceil}
+
+def evaluate(aNode, env):
+  """The value of an expression over the constants in env, computed the
+  way RobotC would. Raises NotConstant if that isn't possible."""
+  isConstant, value = constant_value(aNode)
+  if isConstant:
+    return value
+  if isinstance(aNode, C_Name) and aNode.id in env:
+    return env[aNode.id]
+  if isinstance(aNode, C_UnaryOp):
+    operand = evaluate(aNode.operand, env)
+    if isinstance(aNode.op, C_Not):
+      return not operand
+    if isinstance(aNode.op, C_UAdd):
+      return operand
+    if isinstance(aNode.op, C_USub):
+      return c_int_op(C_Sub(), 0, operand) if type(operand) is int else -operand
+    if isinstance(aNode.op, C_Invert) and type(operand) is int:
+      return ~operand
+  elif isinstance(aNode, C_BinOp):
+    left, right = evaluate(aNode.left, env), evaluate(aNode.right, env)
+    if not isinstance(left, float) and not isinstance(right, float):
+      result = c_int_op(aNode.op, int(left), int(right))
+      if result is not None:
+        return result
+    elif isinstance(aNode.op, (C_Add, C_Sub, C_Mult, C_Div)) and (right or not isinstance(aNode.op, C_Div)):
+      return {C_Add: lambda: left + right, C_Sub: lambda: left - right, C_Mult: lambda: left * right,
+              C_Div: lambda: left / right}[type(aNode.op)]()
+  elif isinstance(aNode, C_Compare) and all(type(op) in compareOps for op in aNode.ops):
+    left = evaluate(aNode.left, env)
+    for op, comparator in zip(aNode.ops, aNode.comparators):
+      right = evaluate(comparator, env)
+      if not compareOps[type(op)](left, right):
+        return False
+      left = right
+    return True
+  elif isinstance(aNode, C_BoolOp):
+    isAnd = isinstance(aNode.op, C_And)
+    for value in aNode.values:
+      if bool(evaluate(value, env)) != isAnd:
+        return not isAnd
+    return isAnd
+  elif isinstance(aNode, C_IfExp):
+    return evaluate(aNode.body if evaluate(aNode.test, env) else aNode.orelse, env)
+  elif (isinstance(aNode, C_Call) and isinstance(aNode.func, C_Name) and aNode.func.id in mathFunctions
+        and aNode.func.id in pureFunctions and not aNode.keywords):
+    try:
+      return mathFunctions[aNode.func.id](*[evaluate(arg, env) for arg in aNode.args])
+    except (ValueError, TypeError, OverflowError) as e:
+      raise NotConstant(str(e))
+  raise NotConstant(aNode.print_c() if hasattr(aNode, 'print_c') else type(aNode).__name__)
+
+def execute(statements, env, budget):
+  """Run statements the way RobotC would, over the constants in env.
+  Returns (True, value) for a return statement, or (False, None) at the end
+  of the statements. budget is a one item list of the statements that may
+  still run. Raises NotConstant if that isn't possible."""
+  for statement in statements:
+    budget[0] -= 1
+    if budget[0] < 0:
+      raise NotConstant('too many steps')
+    if isinstance(statement, C_Return):
+      return True, None if statement.value is None else evaluate(statement.value, env)
+    elif isinstance(statement, C_If):
+      returned = execute(statement.body if evaluate(statement.test, env) else statement.orelse, env, budget)
+      if returned[0]:
+        return returned
+    elif isinstance(statement, C_While) and not statement.orelse:
+      while evaluate(statement.test, env):
+        returned = execute(statement.body, env, budget)
+        if returned[0]:
+          return returned
+    elif isinstance(statement, C_Assign) and all(isinstance(target, C_Name) for target in statement.targets):
+      value = evaluate(statement.value, env)
+      for target in statement.targets:
+        env[target.id] = value
+    elif isinstance(statement, C_AnnAssign) and isinstance(statement.target, C_Name) and statement.value is not None:
+      env[statement.target.id] = evaluate(statement.value, env)
+    elif isinstance(statement, C_AugAssign) and isinstance(statement.target, C_Name):
+      env[statement.target.id] = evaluate(C_BinOp(left=statement.target, op=statement.op, right=statement.value), env)
+    elif not isinstance(statement, (C_Pass, C_Expr)):
+      raise NotConstant(type(statement).__name__)
+  return False, None
+
+def make_index(value):
+  """The slice of a subscript reading element value."""
+  if sys.version_info < (3, 9):
+    return C_Index(value=value)
+  return value
+
+class C_Table(ast.stmt):
+  """A const array of a function's results. Only created by TableLowering."""
+  _fields = ('name', 'cType', 'values')
+
+  def prepare(self):
+    pass
+
+  def print_c(self):
+    return emit_to_string(self)
+
+  def emit(self, out):
+    if out.level == 0:
+      out.functions.append({'name': self.name, 'task': False, 'references': [], 'start': out.position,
+                            'table': True, 'entries': len(self.values),
+                            'bytes': len(self.values) * typeSizes[self.cType]})
+    out.write('\nconst {} {}[{}] = {{\n'.format(self.cType, self.name, len(self.values)))
+    values = [make_constant(value, self).print_c() for value in self.values]
+    for start in range(0, len(values), 16):
+      out.write(indent + ', '.join(values[start:start + 16]) + (',\n' if start + 16 < len(values) else '\n'))
+    out.write('};\n')
+    if out.level == 0:
+      out.functions[-1]['end'] = out.position
+
+class TableLowering(ast.NodeTransformer):
+  """Replaces calls to functions decorated with @vex.table(low, high) by
+  reads from a const array of their results.
+
+  The function is run at compile time, with RobotC semantics, for every
+  value of its first parameter from low to high (any others take their
+  defaults), and its results are emitted as a const array just before it.
+  Calls with one argument then index the array, and calls with a constant
+  argument are replaced by the result. A constant argument outside the
+  range, or that isn't an int, is reported and the function called as
+  usual; other arguments outside the range are the caller's
+  responsibility. The function itself is kept for other modules.
+  Functions that can't be run are reported and left alone."""
+
+  def __init__(self, module):
+    self.tables = {}
+    usedNames = None
+    body = []
+    for aNode in module.body:
+      table = self.tabulate(aNode) if isinstance(aNode, C_FunctionDef) else None
+      if table is not None:
+        if usedNames is None:
+          usedNames = set(node.id for node in ast.walk(module) if isinstance(node, ast.Name))
+        name = aNode.name + '_table'
+        while name in usedNames:
+          name += '_'
+        usedNames.add(name)
+        self.tables[aNode.name] = (name, table[0], table[1])
+        localArrays[name] = aNode.returns.print_c()
+        body.append(ast.copy_location(C_Table(name=name, cType=aNode.returns.print_c(), values=table[1]), aNode))
+      body.append(aNode)
+    module.body = body
+
+  def tabulate(self, aNode):
+    """(low, results) for a @vex.table function, or None."""
+    decorators = [decorator for decorator in aNode.decorator_list
+                  if isinstance(decorator, C_Call) and decorator.func.print_c() == 'vex.table']
+    if not decorators:
+      return None
+    try:
+      low, high = [int(evaluate(arg, {})) for arg in decorators[0].args]
+      cType = aNode.returns.print_c() if aNode.returns else None
+      if cType not in typeSizes or not aNode.args.args or aNode.args.minArgs > 1:
+        raise NotConstant('needs one int parameter and a return type of ' + ', '.join(sorted(typeSizes)))
+      if not 0 < high - low + 1 <= 4096:
+        raise NotConstant('the range must hold 1 to 4096 values')
+      env = {}
+      for i, arg in enumerate(aNode.args.args[1:], 1):
+        env[arg.arg] = evaluate(aNode.args.defaults[i - aNode.args.minArgs], {})
+      results = []
+      for value in range(low, high + 1):
+        env[aNode.args.args[0].arg] = value
+        returned, result = execute(aNode.body, dict(env), [10000])
+        if not returned or result is None:
+          raise NotConstant('no value returned for {}'.format(value))
+        if cType == 'float':
+          results.append(float(result))
+        elif cType == 'bool':
+          results.append(bool(result))
+        elif intMin <= int(result) <= intMax:
+          results.append(int(result))
+        else:
+          raise NotConstant('{}({}) is out of range'.format(aNode.name, value))
+      return low, results
+    except (NotConstant, ValueError) as e:
+      warn(aNode, 'could not tabulate {}: {}'.format(aNode.name, e))
+      return None
+
+  def visit_C_Call(self, aNode):
+    self.generic_visit(aNode)
+    if (not isinstance(aNode.func, C_Name) or aNode.func.id not in self.tables or len(aNode.args) != 1
+        or aNode.keywords or isinstance(aNode.args[0], ast.Starred)):
+      return aNode
+    name, low, values = self.tables[aNode.func.id]
+    try:
+      value = evaluate(aNode.args[0], {})
+      if type(value) is int and 0 <= value - low < len(values):
+        return make_constant(values[value - low], aNode)
+      warn(aNode, '{}({!r}) is not in its table of {} to {}; calling it instead'.format(
+        aNode.func.id, value, low, low + len(values) - 1))
+      return aNode
+    except NotConstant:
+      pass
+    index = aNode.args[0]
+    if low:
+      index = ast.copy_location(C_BinOp(left=index, op=C_Sub() if low > 0 else C_Add(), right=make_constant(abs(low), aNode)), aNode)
+    return ast.copy_location(C_Subscript(value=C_Name(id=name, ctx=ast.Load()), slice=make_index(index), ctx=ast.Load()), aNode)
+
+class MotorGroupLowering(ast.NodeTransformer):
+  """Lowers vex.motorGroup declarations and vex.setGroup calls.
+
+  group = vex.motorGroup(a, b, ...) names a group of motor ports, and
+  vex.setGroup(group, speed) becomes the chained assignment
+  motor[a] = motor[b] = ... = speed, so speed is evaluated once. A group
+  of named ports declared inside a function may instead be slaved to its
+  first port where it is declared, so vex.setGroup only writes the first
+  port. That is safe only if no other module mentions its other ports
+  either, so both forms are written (see C_MotorGroup and C_SetGroup) and
+  slave_motor_groups() picks one once every module is compiled. Groups are
+  visible in the scope that declares them, like Python variables."""
+
+  def __init__(self):
+    self.scopes = [{}]
+    self.groups = 0
+
+  def is_call(self, aNode, name):
+    return isinstance(aNode, C_Call) and isinstance(aNode.func, C_Attribute) and aNode.func.print_c() == name
+
+  def visit_C_FunctionDef(self, aNode):
+    self.scopes.append({})
+    self.generic_visit(aNode)
+    self.scopes.pop()
+    return aNode
+
+  def visit_C_Assign(self, aNode):
+    if not self.is_call(aNode.value, 'vex.motorGroup'):
+      return self.generic_visit(aNode)
+    ports = aNode.value.args
+    if len(aNode.targets) != 1 or not isinstance(aNode.targets[0], C_Name) or not ports:
+      warn(aNode, 'vex.motorGroup must be assigned to a single name')
+      return aNode
+    if len(self.scopes) == 1 or len(ports) == 1 or not all(isinstance(port, C_Name) for port in ports):
+      self.scopes[-1][aNode.targets[0].id] = (ports, None)
+      return None
+    self.groups += 1
+    self.scopes[-1][aNode.targets[0].id] = (ports, self.groups)
+    slaved = [ast.copy_location(C_Expr(value=C_Call(func=C_Name(id='slaveMotor', ctx=ast.Load()),
+                                                    args=[port, copy.deepcopy(ports[0])], keywords=[])), aNode)
+              for port in ports[1:]]
+    return C_MotorGroup(slaved=slaved, group=self.groups, ports=[port.id for port in ports], line=aNode.lineno)
+
+  def visit_C_Expr(self, aNode):
+    self.generic_visit(aNode)
+    if not self.is_call(aNode.value, 'vex.setGroup'):
+      return aNode
+    args = aNode.value.args
+    group = None
+    if len(args) == 2 and isinstance(args[0], C_Name):
+      group = next((scope[args[0].id] for scope in reversed(self.scopes) if args[0].id in scope), None)
+    if group is None:
+      warn(aNode, 'vex.setGroup needs a group declared with vex.motorGroup and a speed')
+      return aNode
+    ports, group = group
+    targets = [C_Subscript(value=C_Name(id='motor', ctx=ast.Load()), slice=make_index(copy.deepcopy(port)), ctx=ast.Store())
+               for port in ports]
+    assign = ast.copy_location(C_Assign(targets=targets, value=args[1]), aNode)
+    if group is None:
+      return assign
+    slaved = ast.copy_location(C_Assign(targets=copy.deepcopy(targets[:1]), value=copy.deepcopy(args[1])), aNode)
+    return ast.copy_location(C_SetGroup(body=[assign], slaved=[slaved], group=group, ports=[port.id for port in ports]), aNode)
+
+def optimize_module(module, motorGroups=True):
+  """Run the enabled optimisation passes over a prepared module.
+  motorGroups is False if the module never mentions them."""
+  infer_types(module, motorGroups)
+  if useTemporaries:
+    TemporaryLowering(module).visit(module)
+  LoopInvariantHoisting(module, hoistLoopInvariants).visit(module)
+  if reduceStrength:
+    StrengthReduction().visit(module)
+  if profile:
+    ProfileInstrumentation(module).visit(module)
+
+def infer_types(module, motorGroups=True):
+  """Run the passes up to and including type inference, which decide the
+  types of the module's locals and unannotated functions."""
+  if motorGroups:
+    MotorGroupLowering().visit(module)
+  tables = TableLowering(module)
+  if tables.tables:
+    tables.visit(module)
+  if inlineThreshold > 0:
+    inliner = FunctionInliner(module)
+    if inliner.candidates:
+      inliner.visit(module)
+  if foldConstants:
+    ConstantFolder().visit(module)
+  TypeInference(module).run()
+
+def compiler_digest():
+  """Hash of this compiler's own source, so edits invalidate the cache too."""
+  global _compilerDigest
+  if _compilerDigest is None:
+    with open(os.path.realpath(__file__), 'rb') as f:
+      _compilerDigest = hashlib.sha256(f.read()).hexdigest()
+  return _compilerDigest
+_compilerDigest = None
+
+def compile_options():
+  """Options that change the generated C, and so belong in the cache key.
+  Keys are the names of the module-level settings they come from."""
+  return {'indent': indent, 'sameLineBraces': sameLineBraces, 'foldConstants': foldConstants,
+          'inlineThreshold': inlineThreshold, 'pureFunctions': pureFunctions,
+          'useTemporaries': useTemporaries, 'hardwareArrays': hardwareArrays,
+          'hoistLoopInvariants': hoistLoopInvariants, 'builtinTypes': builtinTypes,
+          'reduceStrength': reduceStrength, 'typeSizes': typeSizes, 'estimateCosts': estimateCosts,
+          'profile': profile, 'packStructs': packStructs}
+
+def cache_key(source):
+  h = hashlib.sha256()
+  h.update(__version__.encode('utf-8'))
+  h.update(compiler_digest().encode('utf-8'))
+  h.update(json.dumps(compile_options(), sort_keys=True).encode('utf-8'))
+  h.update(source.encode('utf-8'))
+  return h.hexdigest()
+
+def cache_load(key):
+  if memoryCache is not None and key in memoryCache:
+    return memoryCache[key]
+  if cacheDir is None:
+    return None
+  try:
+    with open(os.path.join(cacheDir, key + '.json'), 'r') as f:
+      entry = json.load(f)
+  except (OSError, ValueError):
+    return None
+  remember_entry(key, entry)
+  return entry
+
+def remember_entry(key, entry):
+  if memoryCache is not None:
+    memoryCache.pop(key, None)
+    memoryCache[key] = entry
+    while len(memoryCache) > memoryCacheSize:
+      del memoryCache[next(iter(memoryCache))]
+
+def cache_store(key, entry):
+  remember_entry(key, entry)
+  if cacheDir is None:
+    return
+  try:
+    os.makedirs(cacheDir, exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(entry, f)
+    os.replace(tmpName, os.path.join(cacheDir, key + '.json'))
+  except OSError:
+    pass # The cache is only an optimisation
+
+def source_exists(filename):
+  if sources is not None:
+    return os.path.abspath(filename) in sources
+  return os.path.exists(filename)
+
+def read_source(filename):
+  if sources is not None:
+    return sources[os.path.abspath(filename)]
+  with open(filename, 'r') as f:
+    return f.read()
+
+def resolve_path(filename):
+  global mainFile
+  if mainFile is None:
+    mainFile = filename
+  if pathCache is None:
+    return find_source(filename)
+  if (filename, mainFile) not in pathCache:
+    pathCache[filename, mainFile] = find_source(filename)
+  return pathCache[filename, mainFile]
+
+def find_source(filename):
+  """Look for filename as given, next to this compiler, then next to mainFile."""
+  if not source_exists(filename):
+    if source_exists(os.path.join(os.path.dirname(os.path.realpath(__file__)),filename)):
       filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),filename)
     else:
-      if os.path.exists(os.path.join(os.path.dirname(os.path.realpath(sys.argv[1])),filename)):
-        filename = os.path.join(os.path.dirname(os.path.realpath(sys.argv[1])),filename)
+      if source_exists(os.path.join(os.path.dirname(os.path.realpath(mainFile)),filename)):
+        filename = os.path.join(os.path.dirname(os.path.realpath(mainFile)),filename)
       else:
         raise FileNotFoundError(filename)
+  return filename
+
+def compile_from_cache(filename, entry):
+  """Replay a cached module: compile its imports, restore its metadata and
+  generated C. Returns False if the classes, function return types or
+  module-level variables visible to it have changed."""
+  for importPath in entry['imports']:
+    compile_to_c(importPath)
+  visibleClasses = classNames + [name for name in entry['classNames'] if name not in classNames]
+  visibleFunctions = dict(userFunctions)
+  visibleFunctions.update(entry['userFunctions'])
+  visibleGlobals = globalNames + [name for name in entry['globalNames'] if name not in globalNames]
+  if (visibleClasses != entry['visibleClasses'] or visibleFunctions != entry['visibleFunctions']
+      or visibleGlobals != entry['visibleGlobals']):
+    return False
+  userFunctions.update(entry['userFunctions'])
+  classNames[:] = visibleClasses
+  globalNames[:] = visibleGlobals
+  compiled[os.path.abspath(filename)] = entry['c']
+  moduleFunctions[os.path.abspath(filename)] = entry['functions']
+  moduleMemory[os.path.abspath(filename)] = entry['memory']
+  moduleMarks[os.path.abspath(filename)] = entry['marks']
+  return True
+
+def lower_module(source, followImports=True, timings=None, nodeCounts=None):
+  """Parse, transform, prepare and emit one module. Returns its cache entry.
+
+  If timings is a dict, the seconds spent in each phase are added to it
+  under 'parse', 'transform', 'prepare', 'optimize' and 'emit' (not counting imports
+  compiled along the way). If nodeCounts is a Counter, the module's nodes
+  are counted into it by class name."""
+  global localReturns, localArrays, diagnostics
+  started = time.perf_counter()
+  module = ast.parse(source)
+  parsed = time.perf_counter()
+  outer = localReturns, localArrays, diagnostics
+  localReturns, localArrays, diagnostics = {}, {}, []
+  try:
+    transformer = CNodeTransformer(followImports)
+    transformer.visit(module)
+    if nodeCounts is not None:
+      nodeCounts.update(type(node).__name__ for node in ast.walk(module))
+    transformed = time.perf_counter()
+    functionsBefore = dict(userFunctions)
+    classesBefore = len(classNames)
+    globalsBefore = len(globalNames)
+    add_globals(module_globals(module))
+    for nodeToPrepare in transformer.toPrepare:
+      nodeToPrepare.prepare()
+    prepared = time.perf_counter()
+    optimize_module(module, transformer.motorGroups)
+    optimized = time.perf_counter()
+    out = CEmitter()
+    module.emit(out) # Statements that can't be written are reported as warnings
+    warnings = diagnostics
+    inferred = localReturns
+  finally:
+    localReturns, localArrays, diagnostics = outer
+  userFunctions.update(inferred) # Modules compiled later see the inferred return types too
+  out.marks.append([out.position, 0]) # Anything added after this isn't from the module
+  asC = out.getvalue()
+  if timings is not None:
+    for phase, seconds in (('parse', parsed - started), ('transform', transformed - parsed - transformer.importTime),
+                           ('prepare', prepared - transformed), ('optimize', optimized - prepared),
+                           ('emit', time.perf_counter() - optimized)):
+      timings[phase] = timings.get(phase, 0) + seconds
+  return {
+    'c': asC,
+    'functions': out.functions,
+    'memory': {'structs': out.structs, 'globals': out.globals},
+    'marks': out.marks,
+    'imports': transformer.imports,
+    'userFunctions': {name: returns for name, returns in userFunctions.items() if functionsBefore.get(name) != returns},
+    'classNames': classNames[classesBefore:],
+    'visibleClasses': list(classNames),
+    'visibleFunctions': dict(userFunctions),
+    'globalNames': globalNames[globalsBefore:],
+    'visibleGlobals': list(globalNames),
+    'warnings': warnings,
+  }
+
+def new_build_stats():
+  return {'phases': {}, 'modules': {}}
+
+def record_stats(path, timings=None, nodeCounts=None, cached=False):
+  if buildStats is None:
+    return
+  moduleStats = buildStats['modules'].setdefault(path, {})
+  moduleStats['cached'] = cached
+  moduleStats.update(timings or {})
+  moduleStats['nodes'] = dict(nodeCounts or {})
+
+def format_stats(asJson=False):
+  """Summarise buildStats per phase, per module and per node type."""
+  phases = ['parse', 'transform', 'prepare', 'optimize', 'emit', 'write']
+  common = commonprefix([os.path.dirname(path) for path in buildStats['modules']])
+  modules = {}
+  totals = dict(buildStats['phases'])
+  nodeTotals = collections.Counter()
+  for path, moduleStats in buildStats['modules'].items():
+    report = {phase: moduleStats.get(phase, 0) for phase in phases}
+    report['total'] = sum(report.values())
+    report['cached'] = moduleStats['cached']
+    report['output_bytes'] = len(compiled.get(path, ''))
+    report['nodes'] = moduleStats['nodes']
+    modules[os.path.relpath(path, common)] = report
+    for phase in phases:
+      totals[phase] = totals.get(phase, 0) + report[phase]
+    nodeTotals.update(moduleStats['nodes'])
+  totals['total'] = sum(totals.values())
+  if asJson:
+    return json.dumps({'totals': totals, 'modules': modules, 'nodes': dict(nodeTotals)}, indent=2)
+  lines = ['Phase totals:']
+  for phase, seconds in totals.items():
+    lines.append('  {:<10} {:8.1f} ms'.format(phase, seconds * 1000))
+  lines.append('Modules (slowest first):')
+  lines.append('  ' + ' '.join('{:>10}'.format(phase) for phase in phases + ['total', 'bytes']) + '  module')
+  for name, report in sorted(modules.items(), key=lambda item: -item[1]['total']):
+    lines.append('  ' + ' '.join('{:10.1f}'.format(report[phase] * 1000) for phase in phases + ['total'])
+                 + ' {:>10}  {}{}'.format(report['output_bytes'], name, ' (cached)' if report['cached'] else ''))
+  if nodeTotals:
+    lines.append('Nodes:')
+    for nodeType, count in nodeTotals.most_common():
+      lines.append('  {:<16} {:>8}'.format(nodeType, count))
+  return '\n'.join(lines)
+
+def report_warnings(filename, warnings):
+  for warning in warnings:
+    message = '{}: warning: {}'.format(os.path.relpath(filename), warning)
+    if warningLog is None:
+      print(message, file=sys.stderr)
+    else:
+      warningLog.append(message)
+
+def compile_to_c(filename):
+  filename = resolve_path(filename)
   if not os.path.abspath(filename) in compiled:
-    module = ast.parse(open(filename, 'r').read())
+    source = read_source(filename)
     compiled[os.path.abspath(filename)] = '' # At least fill it in
-    transformer = CNodeTransformer()
+    key = cache_key(source)
+    entry = cache_load(key)
+    if entry is not None and compile_from_cache(filename, entry):
+      report_warnings(filename, entry['warnings'])
+      record_stats(os.path.abspath(filename), cached=True)
+      return
+    timings = {}
+    nodeCounts = collections.Counter() if buildStats is not None else None
+    entry = lower_module(source, timings=timings, nodeCounts=nodeCounts)
+    report_warnings(filename, entry['warnings'])
+    compiled[os.path.abspath(filename)] = entry['c']
+    moduleFunctions[os.path.abspath(filename)] = entry['functions']
+    moduleMemory[os.path.abspath(filename)] = entry['memory']
+    moduleMarks[os.path.abspath(filename)] = entry['marks']
+    cache_store(key, entry)
+    record_stats(os.path.abspath(filename), timings, nodeCounts)
+
+class ImportScanner(ast.NodeVisitor):
+  """Finds a raw module's imports, class names, module-level variables and
+  annotated return types in the order that CNodeTransformer would reach
+  them. Unannotated functions that never return a value return void; if
+  any other function is unannotated, inferReturns is set, as only lowering
+  knows its type."""
+
+  def __init__(self):
+    self.imports = []
+    self.classNames = []
+    self.globalNames = []
+    self.userFunctions = {}
+    self.inferReturns = False
+    self.currentClass = None
+
+  def visit_Module(self, aNode):
+    self.globalNames = sorted(module_globals(aNode))
+    self.generic_visit(aNode)
+
+  def visit_Import(self, aNode):
+    self.imports.append('/'.join(aNode.names[0].name.split('.')) + '.py')
+
+  def visit_ClassDef(self, aNode):
+    self.classNames.append(aNode.name)
+    previousClass = self.currentClass
+    self.currentClass = aNode
+    self.generic_visit(aNode)
+    self.currentClass = previousClass
+
+  def visit_AsyncFunctionDef(self, aNode):
+    self.userFunctions[aNode.name] = 'task'
+    self.generic_visit(aNode)
+
+  def visit_FunctionDef(self, aNode):
+    name = aNode.name
+    if self.currentClass and name == '__init__':
+      name = self.currentClass.name + '_' + name
+    if aNode.returns:
+      returns = copy.deepcopy(aNode.returns)
+      CNodeTransformer(False).visit(returns)
+      self.userFunctions[name] = returns.print_c()
+    elif any(isinstance(node, ast.Return) and node.value is not None for node in own_nodes(aNode)):
+      self.inferReturns = True
+    else:
+      self.userFunctions[name] = 'void'
+    self.generic_visit(aNode)
+
+def discover_modules(filename, known=None):
+  """Walk the import graph from filename without lowering anything.
+
+  Returns (discovered, order): discovered maps each absolute path to its
+  source, imports, class names and annotated return types (and whether
+  others must be inferred) in the order a serial build would first reach it; order lists the paths in the order a serial build finishes them.
+  Entries of a previous result passed as known are reused as-is (the same
+  object) when their file has not been modified since."""
+  discovered = {}
+  order = []
+  known = known or {}
+  def visit(filename):
+    filename = resolve_path(filename)
+    path = os.path.abspath(filename)
+    if path in discovered:
+      return
+    mtime = os.stat(filename).st_mtime_ns if sources is None else None
+    if path in known and known[path]['mtime'] == mtime:
+      discovered[path] = known[path]
+    else:
+      source = read_source(filename)
+      scanner = ImportScanner()
+      scanner.visit(ast.parse(source))
+      discovered[path] = {'source': source, 'imports': scanner.imports, 'classNames': scanner.classNames,
+                          'globalNames': scanner.globalNames, 'userFunctions': scanner.userFunctions,
+                          'inferReturns': scanner.inferReturns, 'mtime': mtime}
+    for importPath in discovered[path]['imports']:
+      visit(importPath)
+    order.append(path)
+  visit(filename)
+  return discovered, order
+
+class ProfileInstrumentation(LoweringPass):
+  """Times every function and loop with nSysTime, for --profile.
+
+  Each function counts its calls and the milliseconds spent in them, and
+  each loop its iterations and the milliseconds spent in its body, in long
+  globals that C_FunctionDef.emit declares (see aNode.profile). Returns
+  stop the function's clock and those of the loops they leave, and break
+  and continue stop their loop's clock. Times are wall clock, so they
+  include time other tasks ran."""
+
+  def visit_C_FunctionDef(self, aNode):
+    name = aNode.name
+    self.function = name
+    self.newTypes = {}
+    self.loops = []
+    self.hasResult = False
+    self.returns = aNode.returns.print_c()
+    self.stopFunction = self.stop('profileTime_' + name, 'profileStart')
+    start = 1 if ast.get_docstring(aNode) else 0
+    body = self.instrument(aNode.body[start:], [])
+    if not body or not isinstance(body[-1], C_Return):
+      body += [ast.copy_location(stop, aNode) for stop in self.stopFunction()]
+    entry = [self.declare('profileStart', 'long', C_Name(id='nSysTime', ctx=ast.Load())), self.count('profileCalls_' + name)]
+    if self.hasResult:
+      entry.append(self.declare('profileResult', self.returns))
+    entry += [self.declare('profileLoopStart{}'.format(index + 1), 'long') for index in range(len(self.loops))]
+    aNode.body[start:] = [ast.copy_location(statement, aNode) for statement in entry] + body
+    local_types(aNode).update(self.newTypes)
+    aNode.profile = {'calls': 'profileCalls_' + name, 'time': 'profileTime_' + name,
+                     'loops': [{'line': line, 'iterations': 'profileIterations_{}_{}'.format(name, index + 1),
+                                'time': 'profileLoopTime_{}_{}'.format(name, index + 1)}
+                               for index, line in enumerate(self.loops)]}
+    return aNode
+
+  def count(self, counter):
+    return C_AugAssign(target=C_Name(id=counter, ctx=ast.Store()), op=C_Add(), value=C_Constant(value=1))
+
+  def stop(self, counter, start):
+    """A function making the statements that add the time since start to counter."""
+    def statements():
+      elapsed = C_BinOp(left=C_Name(id='nSysTime', ctx=ast.Load()), op=C_Sub(), right=C_Name(id=start, ctx=ast.Load()))
+      return [C_AugAssign(target=C_Name(id=counter, ctx=ast.Store()), op=C_Add(), value=elapsed)]
+    return statements
+
+  def instrument(self, statements, loops):
+    """Instrument a list of statements inside the given enclosing loops
+    (innermost last), returning the new list."""
+    result = []
+    for statement in statements:
+      if isinstance(statement, C_Return):
+        stops = [ast.copy_location(stop, statement) for loop in reversed(loops) for stop in loop()]
+        stops += [ast.copy_location(stop, statement) for stop in self.stopFunction()]
+        if statement.value is not None and not is_trivial(statement.value):
+          self.hasResult = True
+          result.append(ast.copy_location(C_Assign(targets=[C_Name(id='profileResult', ctx=ast.Store())], value=statement.value), statement))
+          statement.value = C_Name(id='profileResult', ctx=ast.Load())
+        result += stops + [statement]
+        continue
+      if isinstance(statement, (C_Break, C_Continue)) and loops:
+        result += [ast.copy_location(stop, statement) for stop in loops[-1]()]
+      elif isinstance(statement, (C_While, C_For)):
+        self.loops.append(getattr(statement, 'lineno', 0))
+        index = len(self.loops)
+        name = self.function
+        start = 'profileLoopStart{}'.format(index)
+        stopLoop = self.stop('profileLoopTime_{}_{}'.format(name, index), start)
+        body = self.instrument(statement.body, loops + [stopLoop])
+        if not body or not isinstance(body[-1], (C_Return, C_Break, C_Continue)):
+          body += [ast.copy_location(stop, statement) for stop in stopLoop()]
+        entry = [C_Assign(targets=[C_Name(id=start, ctx=ast.Store())], value=C_Name(id='nSysTime', ctx=ast.Load())),
+                 self.count('profileIterations_{}_{}'.format(name, index))]
+        statement.body = [ast.copy_location(child, statement) for child in entry] + body
+      elif isinstance(statement, C_If):
+        statement.body = self.instrument(statement.body, loops)
+        statement.orelse = self.instrument(statement.orelse, loops)
+      result.append(statement)
+    return result
+
+def infer_returns(source, visibleClasses, visibleFunctions, visibleGlobals):
+  """The return types lower_module would infer for source's unannotated
+  functions, given the class names, return types and module-level
+  variables visible to it."""
+  global userFunctions, classNames, globalNames, localReturns, localArrays, diagnostics
+  outer = userFunctions, classNames, globalNames, localReturns, localArrays, diagnostics
+  userFunctions, classNames, globalNames = dict(visibleFunctions), list(visibleClasses), list(visibleGlobals)
+  localReturns, localArrays, diagnostics = {}, {}, []
+  try:
+    module = ast.parse(source)
+    transformer = CNodeTransformer(False)
     transformer.visit(module)
     for nodeToPrepare in transformer.toPrepare:
       nodeToPrepare.prepare()
-    compiled[os.path.abspath(filename)] = module.print_c()
+    infer_types(module, transformer.motorGroups)
+    return localReturns
+  finally:
+    userFunctions, classNames, globalNames, localReturns, localArrays, diagnostics = outer
+
+def _lower_in_worker(source, visibleClasses, visibleFunctions, visibleGlobals, options, countNodes=False):
+  global userFunctions, classNames, globalNames
+  globals().update(options)
+  userFunctions = dict(visibleFunctions)
+  classNames = list(visibleClasses)
+  globalNames = list(visibleGlobals)
+  timings = {}
+  nodeCounts = collections.Counter() if countNodes else None
+  return lower_module(source, False, timings, nodeCounts), timings, nodeCounts
+
+def compile_parallel(filename, jobs=None):
+  """Compile filename and its imports in a process pool.
+
+  The import graph is discovered first, so every module's visible class
+  names, return types and module-level variables are known up front and
+  modules can be lowered independently.
+  Return types that must be inferred are taken from the module's cache
+  entry, or inferred here in build order, which runs the passes up to type
+  inference once more for those modules. The
+  results are merged in serial build order, so the output is identical."""
+  started = time.perf_counter()
+  discovered, order = discover_modules(filename)
+  if buildStats is not None:
+    buildStats['phases']['discover'] = time.perf_counter() - started
+  alreadyCompiled = set(compiled)
+  for path in discovered:
+    compiled.setdefault(path, '')
+  entries = {}
+  keys = {}
+  visibleClasses = list(classNames)
+  visibleFunctions = dict(userFunctions)
+  visibleGlobals = list(globalNames)
+  pending = {}
+  with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+    for path in order:
+      if path in alreadyCompiled:
+        continue # Compiled earlier in this process; its classes are known
+      module = discovered[path]
+      visibleBefore = list(visibleClasses)
+      functionsBefore = dict(visibleFunctions)
+      globalsBefore = list(visibleGlobals)
+      visibleClasses += module['classNames']
+      visibleGlobals += [name for name in module['globalNames'] if name not in visibleGlobals]
+      keys[path] = cache_key(module['source'])
+      entry = cache_load(keys[path])
+      if entry is not None:
+        visibleFunctions.update(entry['userFunctions'])
+      if (entry is not None and entry['visibleClasses'] == visibleClasses and entry['visibleFunctions'] == visibleFunctions
+          and entry['visibleGlobals'] == visibleGlobals):
+        entries[path] = entry
+        record_stats(path, cached=True)
+      else:
+        visibleFunctions = dict(functionsBefore)
+        visibleFunctions.update(module['userFunctions'])
+        if module['inferReturns']:
+          visibleFunctions.update(infer_returns(module['source'], visibleBefore, functionsBefore, globalsBefore))
+        pending[path] = pool.submit(_lower_in_worker, module['source'], visibleBefore, functionsBefore, globalsBefore,
+                                    compile_options(), buildStats is not None)
+    for path, future in pending.items():
+      entries[path], timings, nodeCounts = future.result()
+      cache_store(keys[path], entries[path])
+      record_stats(path, timings, nodeCounts)
+  for path in order:
+    if path in entries:
+      report_warnings(path, entries[path]['warnings'])
+      userFunctions.update(entries[path]['userFunctions'])
+      classNames.extend(entries[path]['classNames'])
+      globalNames.extend(entries[path]['globalNames'])
+      compiled[path] = entries[path]['c']
+      moduleFunctions[path] = entries[path]['functions']
+      moduleMemory[path] = entries[path]['memory']
+      moduleMarks[path] = entries[path]['marks']
+
+def watch(filename, interval=0.1):
+  """Recompile whenever a source file changes, until interrupted.
+
+  Every module's discovery info and lowered output stay in memory. A module
+  is lowered again only if its own source changed or the class names,
+  return types or module-level variables visible to it did (so only it and
+  the modules affected by it), and only the files that were lowered again
+  are rewritten under output/."""
+  global userFunctions, classNames, globalNames
+  known = {}
+  lowered = {}
+  written = {}
+  outputNames = {}
+  lastError = None
+  while True:
+    started = time.time()
+    try:
+      discovered, order = discover_modules(filename, known)
+    except (OSError, SyntaxError) as e:
+      if str(e) != lastError:
+        lastError = str(e)
+        print(e)
+      time.sleep(interval)
+      continue
+    lastError = None
+    changed = []
+    visibleClasses = []
+    visibleFunctions = {}
+    visibleGlobals = []
+    for path in order:
+      visibleBefore = (list(visibleClasses), dict(visibleFunctions), list(visibleGlobals))
+      visibleClasses += discovered[path]['classNames']
+      visibleGlobals += [name for name in discovered[path]['globalNames'] if name not in visibleGlobals]
+      if path in lowered and discovered[path] is known.get(path) and lowered[path][0] == visibleBefore:
+        visibleFunctions.update(lowered[path][1]['userFunctions'])
+        continue
+      key = cache_key(discovered[path]['source'])
+      entry = cache_load(key)
+      if entry is not None:
+        visibleFunctions.update(entry['userFunctions'])
+      if (entry is None or entry['visibleClasses'] != visibleClasses or entry['visibleFunctions'] != visibleFunctions
+          or entry['visibleGlobals'] != visibleGlobals):
+        userFunctions = dict(visibleBefore[1])
+        classNames = list(visibleBefore[0])
+        globalNames = list(visibleBefore[2])
+        try:
+          entry = lower_module(discovered[path]['source'], followImports=False)
+        except Exception as e:
+          # Keep the last good output until the file is edited again
+          print(traceback.format_exc())
+          if path in lowered:
+            lowered[path] = (visibleBefore, lowered[path][1])
+          else:
+            lowered[path] = (visibleBefore, {'c': '', 'functions': [], 'memory': {'structs': {}, 'globals': []},
+                                             'marks': [], 'userFunctions': discovered[path]['userFunctions']})
+          visibleFunctions = dict(visibleBefore[1])
+          visibleFunctions.update(lowered[path][1]['userFunctions'])
+          continue
+        cache_store(key, entry)
+        visibleFunctions = dict(visibleBefore[1])
+        visibleFunctions.update(entry['userFunctions'])
+      report_warnings(path, entry['warnings'])
+      lowered[path] = (visibleBefore, entry)
+      changed.append(path)
+    known = discovered
+    lowered = {path: lowered[path] for path in discovered if path in lowered}
+    compiled.clear()
+    moduleFunctions.clear()
+    moduleMemory.clear()
+    moduleMarks.clear()
+    userFunctions = {}
+    for path in discovered:
+      if path in lowered:
+        compiled[path] = lowered[path][1]['c']
+        moduleFunctions[path] = lowered[path][1]['functions']
+        moduleMemory[path] = lowered[path][1]['memory']
+        moduleMarks[path] = lowered[path][1]['marks']
+    for path in order:
+      if path in lowered:
+        userFunctions.update(lowered[path][1]['userFunctions'])
+    classNames = visibleClasses
+    globalNames = visibleGlobals
+    slave_motor_groups()
+    if eliminateDeadFunctions:
+      eliminate_dead_functions()
+    if profile:
+      add_profile_dump()
+    if output_filenames() != outputNames:
+      outputNames = output_filenames()
+      written = {}
+    if amalgamateOutput:
+      unit = amalgamate(order)
+      toWrite = [order[-1]] if written.get(order[-1]) != unit else []
+      if toWrite:
+        write_amalgamation(unit, order)
+        written[order[-1]] = unit
+    else:
+      toWrite = [path for path in compiled if written.get(path) != compiled[path]]
+      write_outputs(toWrite)
+      written.update((path, compiled[path]) for path in toWrite)
+    if changed or toWrite:
+      print('Compiled {} of {} modules in {:.0f} ms'.format(len(changed), len(order), (time.time() - started) * 1000))
+    time.sleep(interval)
+
+def eliminate_dead_functions():
+  """Remove every function that no task can reach from the compiled C.
+
+  Reachability starts at the functions returning task and at module-level
+  code, and follows every name a function mentions, across all modules.
+  Returns (removed function names, bytes removed); nothing is removed if
+  the program has no task."""
+  functions = collections.defaultdict(list)
+  for path, infos in moduleFunctions.items():
+    for info in infos:
+      functions[info['name']].append(info)
+  pending = [name for name, infos in functions.items() if any(info['task'] for info in infos)]
+  if not pending:
+    return [], 0
+  for path, infos in moduleFunctions.items():
+    # Code outside functions always runs, so whatever it mentions is reachable
+    text = compiled[path]
+    previous = 0
+    for info in sorted(infos, key=lambda info: info['start']):
+      pending.extend(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', text[previous:info['start']]))
+      previous = info['end']
+    pending.extend(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', text[previous:]))
+  reachable = set()
+  while pending:
+    name = pending.pop()
+    if name in reachable:
+      continue
+    reachable.add(name)
+    if name in classNames:
+      pending.append(name + '___init__')
+    for info in functions.get(name, []):
+      pending.extend(info['references'])
+  removed = []
+  removedBytes = 0
+  for path, infos in moduleFunctions.items():
+    dead = [info for info in infos if info['name'] not in reachable]
+    if not dead:
+      continue
+    text = compiled[path]
+    kept = []
+    previous = 0
+    spans = []
+    for info in sorted(dead, key=lambda info: info['start']):
+      kept.append(text[previous:info['start']])
+      previous = info['end']
+      spans.append((info['start'], info['end']))
+      removed.append(info['name'])
+      removedBytes += info['end'] - info['start']
+    kept.append(text[previous:])
+    compiled[path] = ''.join(kept)
+    if path in moduleMarks:
+      moduleMarks[path] = remove_marks(moduleMarks[path], spans)
+    moduleFunctions[path] = [info for info in infos if info['name'] in reachable]
+  return removed, removedBytes
+
+def slave_motor_groups():
+  """Slave each motor group that MotorGroupLowering left open to its first
+  port, if its other ports are in no other such group and nothing in the
+  compiled program mentions them outside its setGroup writes and #pragma
+  lines. Returns the ports of the groups slaved."""
+  groups = [(path, group) for path, infos in moduleFunctions.items() for info in infos
+            for group in info.get('motorGroups', ())]
+  if not groups:
+    return []
+  declared = collections.Counter(port for path, group in groups for port in group['ports'])
+  spans = collections.defaultdict(list)
+  for path, group in groups:
+    spans[path] += [(start, end) for start, end, text in group['sets']]
+  mentions = collections.Counter()
+  for path, text in compiled.items():
+    previous = 0
+    for start, end in sorted(spans[path]) + [(len(text), len(text))]:
+      for line in text[previous:start].split('\n'):
+        if not line.lstrip().startswith('#pragma'):
+          mentions.update(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', line))
+      previous = end
+  edits = collections.defaultdict(list)
+  slaved = []
+  for path, group in groups:
+    if group['declaration'] is None or any(declared[port] > 1 or mentions[port] for port in group['ports'][1:]):
+      continue
+    position, lineno, text = group['declaration']
+    edits[path].append((position, position, text, lineno))
+    edits[path] += [(start, end, text, None) for start, end, text in group['sets']]
+    slaved.append(group['ports'])
+  for path in edits:
+    edit_module(path, sorted(edits[path]))
+  return slaved
+
+def edit_module(path, edits):
+  """Replace the sorted (start, end, text, Python line) spans of a compiled
+  module, moving its marks and functions to match. Text with a line is
+  marked as coming from it."""
+  text = compiled[path]
+  parts = []
+  added = []
+  previous = 0
+  shift = 0
+  for start, end, replacement, lineno in edits:
+    parts += [text[previous:start], replacement]
+    if lineno:
+      added.append([start + shift, lineno])
+    shift += len(replacement) - (end - start)
+    previous = end
+  parts.append(text[previous:])
+  compiled[path] = ''.join(parts)
+  def moved(position):
+    return position + sum(len(replacement) - (end - start) for start, end, replacement, lineno in edits if end <= position)
+  if path in moduleMarks:
+    marks = [[moved(position), lineno] for position, lineno in moduleMarks[path]
+             if not any(start < position < end for start, end, replacement, line in edits)]
+    moduleMarks[path] = sorted(marks + added, key=lambda mark: mark[0])
+  moduleFunctions[path] = [dict(info, start=moved(info['start']), end=moved(info['end'])) for info in moduleFunctions[path]]
+
+def remove_marks(marks, spans):
+  """The marks of a text after the sorted (start, end) spans are cut out."""
+  result = []
+  removed = 0
+  index = 0
+  for position, lineno in marks:
+    while index < len(spans) and spans[index][1] <= position:
+      removed += spans[index][1] - spans[index][0]
+      index += 1
+    if index < len(spans) and spans[index][0] <= position:
+      continue
+    result.append([position - removed, lineno])
+  return result
+
+class CostEstimator(object):
+  """Counts the operations one call to a function performs in the worst
+  case: int and float arithmetic, calls, array accesses, branches,
+  assignments and milliseconds waited. Costs are Counters of those
+  categories, plus 'call:name' for each function called, so calls into
+  other modules can be priced once every module is compiled (see
+  function_costs). Of two branches, the larger count of each category is
+  taken. A loop whose trip count isn't known counts once, and adds to
+  'unbounded'. The cost of one iteration of each while loop is kept in
+  self.loops."""
+
+  def __init__(self, function):
+    self.function = function
+    self.types = local_types(function)
+    self.loops = []
+
+  def estimate(self):
+    return self.statements(self.function.body)
+
+  def statements(self, statements):
+    cost = collections.Counter()
+    for statement in statements:
+      cost += self.statement(statement)
+    return cost
+
+  def statement(self, aNode):
+    cost = collections.Counter()
+    if isinstance(aNode, C_If):
+      cost = self.expression(aNode.test) + collections.Counter(branch=1)
+      return cost + (self.statements(aNode.body) | self.statements(aNode.orelse))
+    if isinstance(aNode, C_While):
+      iteration = self.expression(aNode.test) + collections.Counter(branch=1) + self.statements(aNode.body)
+      self.loops.append({'line': getattr(aNode, 'lineno', 0), 'cost': dict(iteration)})
+      return iteration + collections.Counter(unbounded=1)
+    if isinstance(aNode, C_For):
+      args = aNode.iter.args if isinstance(aNode.iter, C_Call) else []
+      cost = sum((self.expression(arg) for arg in args), collections.Counter(assign=1))
+      iteration = self.statements(aNode.body) + collections.Counter(int=1, branch=1, assign=1)
+      bounds = [constant_value(arg) for arg in args]
+      if args and all(isConstant for isConstant, value in bounds):
+        count = len(range(*[int(value) for isConstant, value in bounds]))
+        return cost + collections.Counter({key: value * count for key, value in iteration.items()})
+      return cost + iteration + collections.Counter(unbounded=1)
+    if isinstance(aNode, (C_Assign, C_AnnAssign)):
+      targets = aNode.targets if isinstance(aNode, C_Assign) else [aNode.target]
+      if aNode.value is None:
+        return cost
+      if isinstance(aNode.value, C_Call) and aNode.value.func.print_c() in classNames:
+        cost['call:' + aNode.value.func.print_c() + '___init__'] += 1
+      for target in targets:
+        cost += self.target(target)
+      return cost + self.expression(aNode.value) + collections.Counter(assign=len(targets))
+    if isinstance(aNode, C_AugAssign):
+      kind = 'float' if 'float' in (expression_type(aNode.target, self.types), expression_type(aNode.value, self.types)) else 'int'
+      cost = self.target(aNode.target) + self.target(aNode.target) + self.expression(aNode.value)
+      return cost + collections.Counter({kind: 1, 'assign': 1})
+    if isinstance(aNode, (C_Expr, C_Return)) and aNode.value is not None:
+      return self.expression(aNode.value)
+    if isinstance(aNode, C_SetGroup):
+      return self.statements(aNode.body) # Slaving only makes it cheaper
+    return cost
+
+  def target(self, aNode):
+    """The cost of writing to (or reading) aNode, besides the assignment."""
+    if isinstance(aNode, C_Subscript):
+      return self.expression(aNode)
+    return collections.Counter()
+
+  def expression(self, aNode):
+    cost = collections.Counter()
+    if isinstance(aNode, C_Call):
+      name = aNode.func.print_c() if isinstance(aNode.func, (C_Name, C_Attribute)) else ''
+      for arg in aNode.args:
+        cost += self.expression(arg)
+      if name == 'vex.pragma':
+        return collections.Counter()
+      if name in blockingCalls:
+        isConstant, value = constant_value(aNode.args[0]) if aNode.args else (False, 0)
+        cost['wait'] += value * (10 if name == 'wait10Msec' else 1) if isConstant else 0
+        cost['unbounded'] += 0 if isConstant else 1
+      elif name in ('vex.motor', 'vex.motorReversed'):
+        cost['array'] += 1
+        cost['assign'] += 1
+        return cost
+      elif name == 'vex.slaveMotors':
+        cost['call'] += len(aNode.args) - 1
+        return cost
+      elif name in ('abs', 'sgn'):
+        cost['int'] += 1
+        return cost
+      elif name in pureFunctions:
+        cost['float'] += 1
+      elif isinstance(aNode.func, C_Attribute) and name not in renames:
+        cost['call:' + aNode.func.attr] += 1
+      else:
+        cost['call:' + name] += 1
+      cost['call'] += 1
+      return cost
+    if isinstance(aNode, C_Subscript):
+      index = aNode.slice.value if isinstance(aNode.slice, C_Index) else aNode.slice
+      return self.expression(index) + collections.Counter(array=1)
+    if isinstance(aNode, C_IfExp):
+      cost = self.expression(aNode.test) + collections.Counter(branch=1)
+      return cost + (self.expression(aNode.body) | self.expression(aNode.orelse))
+    if isinstance(aNode, C_BoolOp):
+      cost['branch'] += len(aNode.values) - 1
+    elif isinstance(aNode, C_TempAssign):
+      cost['assign'] += 1
+    elif isinstance(aNode, (C_BinOp, C_UnaryOp, C_Compare)):
+      operands = [child for child in ast.iter_child_nodes(aNode) if isinstance(child, ast.expr)]
+      isFloat = any(expression_type(operand, self.types) == 'float' for operand in operands)
+      cost['float' if isFloat else 'int'] += len(aNode.ops) if isinstance(aNode, C_Compare) else 1
+    for child in ast.iter_child_nodes(aNode):
+      if isinstance(child, ast.expr) and not isinstance(aNode, C_TempAssign) or child is getattr(aNode, 'value', None):
+        cost += self.expression(child)
+    return cost
+
+def function_costs():
+  """The worst-case cost of one call to each compiled function, in
+  microseconds, priced with operationCosts. A call that would recurse
+  counts as free."""
+  infos = {}
+  for path, functions in moduleFunctions.items():
+    for info in functions:
+      if 'cost' in info:
+        infos.setdefault(info['name'], info)
+  totals = {}
+  def price(cost, stack):
+    total = 0
+    for key, count in cost.items():
+      if key.startswith('call:'):
+        name = key[5:]
+        if name in infos and name not in stack:
+          if name not in totals:
+            totals[name] = price(infos[name]['cost'], stack | {name})
+          total += count * totals[name]
+      else:
+        total += count * operationCosts.get(key, 0)
+    return total
+  for name in infos:
+    if name not in totals:
+      totals[name] = price(infos[name]['cost'], {name})
+  return totals, price
+
+def format_cost_report():
+  """The estimated cost of every function, and of one iteration of every
+  while loop in a task, flagging loops over loopBudget."""
+  totals, price = function_costs()
+  lines = ['Estimated worst-case cost (us):']
+  for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+    lines.append('  {:<32} {:>10.0f}'.format(name, total))
+  lines.append('Task loops, one iteration (us):')
+  for path, functions in moduleFunctions.items():
+    for info in functions:
+      if not info['task']:
+        continue
+      for loop in info.get('loops', []):
+        cost = loop['cost']
+        total = price(cost, {info['name']})
+        counts = ', '.join('{} {}'.format(key, cost[key]) for key in ('int', 'float', 'call', 'array', 'branch', 'wait')
+                           if cost.get(key))
+        line = '  {} ({}:{}) {:>10.0f}  [{}]'.format(info['name'], os.path.basename(path), loop['line'], total, counts)
+        if total > loopBudget * 1000:
+          line += '  over the {} ms budget'.format(loopBudget)
+        if cost.get('unbounded'):
+          line += '  (contains loops or waits of unknown length)'
+        lines.append(line)
+  return '\n'.join(lines)
+
+def format_ram_report():
+  """The size of every struct (and what it would be with its fields in
+  source order), and the static RAM each module's globals and profile
+  counters take. Sizes that aren't known are left out, and marked '+'."""
+  structs = {}
+  for memory in moduleMemory.values():
+    structs.update(memory['structs'])
+  lines = ['Structs (bytes):']
+  for path, memory in moduleMemory.items():
+    for name, struct in memory['structs'].items():
+      size = struct_layout(struct['fields'], structs)[0]
+      fieldTypes = dict(struct['fields'])
+      written = struct_layout([[field, fieldTypes[field]] for field in struct['sourceOrder']], structs)[0]
+      line = '  {:<32} {:>6}'.format(name, '?' if size is None else size)
+      if written != size:
+        line += '  ({} as written)'.format(written)
+      lines.append(line)
+  lines.append('Static RAM (bytes):')
+  for path, memory in moduleMemory.items():
+    total = 0
+    unknown = False
+    for name, cType in memory['globals']:
+      size = type_layout(cType, structs)[0]
+      unknown = unknown or size is None
+      total += size or 0
+    for info in moduleFunctions.get(path, []):
+      if 'profile' in info:
+        total += typeSizes['long'] * (2 + 2 * len(info['profile']['loops']))
+    lines.append('  {:<32} {:>6}{}'.format(os.path.basename(path), total, '+' if unknown else ''))
+  return '\n'.join(lines)
+
+def profile_dump_routine():
+  """RobotC that writes the counters of every profiled function and loop
+  to the debug stream: profileDump(), and a profileReport task that calls
+  it every profileInterval ms. pyRobotProfile.py reads the dumps back,
+  taking the counts from the right, as module names may contain spaces."""
+  out = CEmitter()
+  out.write('\nvoid profileDump()')
+  out.open_block()
+  out.write('writeDebugStreamLine("profile begin %ld", nPgmTime);\n')
+  for path, infos in moduleFunctions.items():
+    for info in infos:
+      counters = info.get('profile')
+      if not counters:
+        continue
+      module = os.path.basename(path).replace('%', '%%')
+      line = 'profile function {} {} %ld %ld'.format(module, info['name'])
+      out.write('writeDebugStreamLine({}, {}, {});\n'.format(escape_string(line), counters['calls'], counters['time']))
+      for loop in counters['loops']:
+        line = 'profile loop {} {} {} %ld %ld'.format(module, info['name'], loop['line'])
+        out.write('writeDebugStreamLine({}, {}, {});\n'.format(escape_string(line), loop['iterations'], loop['time']))
+  out.write('writeDebugStreamLine("profile end");\n')
+  out.close_block()
+  out.write('\n\ntask profileReport()')
+  out.open_block()
+  out.write('while (true)')
+  out.open_block()
+  out.write('wait1Msec({});\nprofileDump();\n'.format(profileInterval))
+  out.close_block()
+  out.write('\n')
+  out.close_block()
+  out.write('\n')
+  return out.getvalue()
+
+def add_profile_dump():
+  """Append profile_dump_routine() to the main module, which includes
+  every other module first."""
+  compiled[os.path.abspath(resolve_path(mainFile))] += profile_dump_routine()
 
 def commonprefix(l):
   # this unlike the os.path.commonprefix version
@@ -819,15 +3300,400 @@ def commonprefix(l):
     cp.append(s.pop())
   return os.path.sep.join(cp)
 
-if __name__ == '__main__':
-  if len(sys.argv) < 2:
-    print(f"Usage: {__file__} [file]")
-    sys.exit(1)
-  compile_to_c(sys.argv[1])
-  common = commonprefix(compiled)
-  withRelNames = {os.path.relpath(abspath,common):contents for abspath,contents in compiled.items()}
-  for file,contents in withRelNames.items():
-    filename = os.path.join(os.path.dirname(os.path.realpath(sys.argv[1])),os.path.join('output',os.path.splitext(file)[0] + '.c'))
+def output_filenames():
+  """Map each compiled module to the .c file it is written to."""
+  common = commonprefix([os.path.dirname(abspath) for abspath in compiled])
+  outputDir = os.path.join(os.path.dirname(os.path.realpath(mainFile)),'output')
+  return {abspath: os.path.join(outputDir, os.path.splitext(os.path.relpath(abspath,common))[0] + '.c') for abspath in compiled}
+
+def write_outputs(paths=None):
+  """Write the compiled modules in paths (default: all of them) to output/."""
+  filenames = output_filenames()
+  for abspath in (compiled if paths is None else paths):
+    started = time.perf_counter()
+    filename = filenames[abspath]
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename,'w') as c_file:
-      c_file.write(contents)
+      c_file.write(compiled[abspath])
+    if sourceMaps:
+      with open(filename + '.map', 'w') as f:
+        json.dump(module_source_map(abspath, filename), f, separators=(',', ':'))
+    if buildStats is not None and abspath in buildStats['modules']:
+      buildStats['modules'][abspath]['write'] = time.perf_counter() - started
+
+def amalgamate(order):
+  """Every module in order (imports first) as one translation unit. The
+  #includes of modules that are part of it are left out, any other
+  #include is only kept the first time it appears, and the #pragma lines
+  of every module are moved to the top, as RobotC expects, once each."""
+  return ''.join(line for line, path, index in amalgamated_lines(order))
+
+def amalgamated_lines(order):
+  """The lines of amalgamate(order), each with the module it comes from
+  and its index among that module's lines (or None, None)."""
+  common = commonprefix([os.path.dirname(path) for path in order])
+  modules = set(order)
+  seen = set()
+  pragmas = []
+  parts = []
+  for path in order:
+    parts.append(('/*** Module: {} ***/\n'.format(os.path.relpath(path, common)), None, None))
+    for index, line in enumerate(compiled[path].splitlines(True)):
+      directive = line.strip()
+      if directive.startswith('#include ') and directive.endswith('.c'):
+        try:
+          if os.path.abspath(resolve_path(directive[len('#include '):-2] + '.py')) in modules:
+            continue
+        except FileNotFoundError:
+          pass
+      if directive.startswith(('#include ', '#pragma ')):
+        if directive in seen:
+          continue
+        seen.add(directive)
+        if directive.startswith('#pragma '):
+          pragmas.append((line, path, index))
+          continue
+      parts.append((line, path, index))
+  return pragmas + parts
+
+def write_amalgamation(unit, order):
+  """Write amalgamate(order)'s unit where the main module's C would go."""
+  filename = output_filenames()[os.path.abspath(resolve_path(mainFile))]
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with open(filename, 'w') as c_file:
+    c_file.write(unit)
+  if sourceMaps:
+    with open(filename + '.map', 'w') as f:
+      json.dump(amalgamation_source_map(order, filename), f, separators=(',', ':'))
+
+def line_table(path):
+  """The Python line that each line of compiled[path] was written for,
+  or 0. A line belongs to the last statement started before its first
+  character that isn't a space."""
+  marks = moduleMarks.get(path, [])
+  table = []
+  index = 0
+  lineno = 0
+  offset = 0
+  for line in compiled[path].splitlines(True):
+    first = offset + len(line) - len(line.lstrip())
+    while index < len(marks) and marks[index][0] <= first:
+      lineno = marks[index][1]
+      index += 1
+    table.append(lineno)
+    offset += len(line)
+  return table
+
+def source_map(origins, filename):
+  """A source map for the C file filename, given the (module path, Python
+  line) of each of its lines. 'lines' holds a [C line, source, Python line]
+  for each run of lines from the same Python line, where source indexes
+  'sources' (paths relative to the map), or just [C line] for a run that
+  comes from no Python line. Lines are numbered from 1."""
+  sources = []
+  lines = []
+  previous = None
+  for number, (path, lineno) in enumerate(origins, 1):
+    origin = (path, lineno) if lineno else None
+    if number > 1 and origin == previous:
+      continue
+    previous = origin
+    if origin is None:
+      lines.append([number])
+      continue
+    source = os.path.relpath(path, os.path.dirname(filename))
+    if source not in sources:
+      sources.append(source)
+    lines.append([number, sources.index(source), lineno])
+  return {'version': 1, 'file': os.path.basename(filename), 'sources': sources, 'lines': lines}
+
+def module_source_map(path, filename):
+  return source_map([(path, lineno) for lineno in line_table(path)], filename)
+
+def amalgamation_source_map(order, filename):
+  tables = {path: line_table(path) for path in order}
+  return source_map([(path, tables[path][index] if path else 0) for line, path, index in amalgamated_lines(order)],
+                    filename)
+
+compilerLock = threading.RLock() # Held while a Compiler's state is in the module globals
+settingNames = ['indent', 'sameLineBraces', 'foldConstants', 'eliminateDeadFunctions', 'inlineThreshold',
+                'useTemporaries', 'hoistLoopInvariants', 'reduceStrength', 'packStructs', 'hardwareArrays',
+                'pureFunctions', 'builtinTypes', 'estimateCosts', 'operationCosts', 'loopBudget', 'typeSizes',
+                'amalgamateOutput', 'sourceMaps', 'profile', 'profileInterval']
+
+class Compiler(object):
+  """A compiler with state of its own, so several programs can be compiled
+  in one process, or the compiler used as a library.
+
+  sources maps filenames (relative to root, or absolute) to source code,
+  which is compiled instead of reading files; options overrides any of
+  the module-level settings in settingNames for this compiler only. With
+  keepWarm, compiled modules and resolved import paths are also kept in
+  memory between compiles. Used as a context manager, a compiler swaps its state into the module globals
+  for the functions above, and back out afterwards. The swap holds
+  compilerLock, so compilers used from several threads take turns."""
+
+  def __init__(self, sources=None, options=None, cacheDir=None, root=None, keepWarm=False):
+    unknown = set(options or {}) - set(settingNames)
+    if unknown:
+      raise ValueError('unknown option(s): ' + ', '.join(sorted(unknown)))
+    self.root = os.path.abspath(root or os.getcwd())
+    self.state = {name: copy.deepcopy(globals()[name]) for name in settingNames}
+    self.state.update(options or {})
+    self.state.update(userFunctions={}, classNames=[], globalNames=[], compiled={}, moduleFunctions={}, moduleMemory={}, moduleMarks={},
+                      mainFile=None, cacheDir=cacheDir, buildStats=None, warningLog=[],
+                      memoryCache={} if keepWarm else None, pathCache={} if keepWarm else None)
+    self.set_sources(sources)
+    self.outer = []
+
+  def set_sources(self, sources):
+    """Compile sources (see above) from now on, or files if None."""
+    self.state['sources'] = None if sources is None else {os.path.join(self.root, name): source
+                                                          for name, source in sources.items()}
+    if self.state['pathCache'] is not None:
+      self.state['pathCache'] = {}
+
+  def __enter__(self):
+    compilerLock.acquire()
+    self.outer.append({name: globals()[name] for name in self.state})
+    globals().update(self.state)
+    return self
+
+  def __exit__(self, *exc):
+    for name in self.state:
+      self.state[name] = globals()[name]
+    globals().update(self.outer.pop())
+    compilerLock.release()
+
+  def compile(self, filename, jobs=1, write=False):
+    """Compile filename and everything it imports, and link them. Returns
+    a dict of 'outputs' (each output file's path under output/, and its C),
+    'warnings', the 'removed' functions and how many 'modules' there were
+    and were 'lowered' rather than taken from the cache, and with
+    sourceMaps, the 'maps' of the outputs by filename. With write, the
+    outputs are also written to output/. Earlier results are forgotten,
+    but the cache is kept."""
+    global mainFile, buildStats
+    with self:
+      for state in (userFunctions, compiled, moduleFunctions, moduleMemory, moduleMarks):
+        state.clear()
+      classNames[:] = []
+      globalNames[:] = []
+      warningLog[:] = []
+      filename = os.path.join(self.root, filename)
+      mainFile = filename
+      buildStats = new_build_stats()
+      if jobs > 1:
+        compile_parallel(filename, jobs)
+      else:
+        compile_to_c(filename)
+      slave_motor_groups()
+      removed = eliminate_dead_functions()[0] if eliminateDeadFunctions else []
+      if profile:
+        add_profile_dump()
+      outputDir = os.path.join(os.path.dirname(os.path.realpath(mainFile)), 'output')
+      filenames = output_filenames()
+      order = list(moduleFunctions)
+      maps = {}
+      if amalgamateOutput:
+        filename = filenames[os.path.abspath(resolve_path(mainFile))]
+        texts = {filename: amalgamate(order)}
+        if sourceMaps:
+          maps[filename + '.map'] = amalgamation_source_map(order, filename)
+        if write:
+          write_amalgamation(texts[filename], order)
+      else:
+        texts = {filenames[path]: text for path, text in compiled.items()}
+        if sourceMaps:
+          maps = {filenames[path] + '.map': module_source_map(path, filenames[path]) for path in compiled}
+        if write:
+          write_outputs()
+      modules = buildStats['modules'].values()
+      result = {'outputs': {os.path.relpath(path, outputDir): text for path, text in texts.items()},
+                'warnings': list(warningLog), 'removed': removed, 'modules': len(modules),
+                'lowered': sum(not module['cached'] for module in modules)}
+      if sourceMaps:
+        result['maps'] = {os.path.relpath(path, outputDir): sourceMap for path, sourceMap in maps.items()}
+      return result
+
+def _compile_program(program):
+  return Compiler(program.get('sources'), program.get('options'), program.get('cacheDir'),
+                  program.get('root')).compile(program['main'])
+
+def compile_many(programs, jobs=None, processes=True):
+  """Compile independent programs concurrently, each with its own Compiler.
+
+  Each program is a dict with the 'main' file to compile and, optionally,
+  the 'sources', 'options', 'cacheDir' and 'root' to give its Compiler.
+  Returns their Compiler.compile() results in the same order. With
+  processes, the programs run on a pool of jobs processes; otherwise on
+  a thread pool, where they take turns holding compilerLock."""
+  if processes:
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+  else:
+    executor = concurrent.futures.ThreadPoolExecutor(jobs)
+  with executor:
+    return list(executor.map(_compile_program, programs))
+
+def check_params(params):
+  """Raise ValueError unless params are the right types for 'compile'."""
+  def is_sources(value):
+    return isinstance(value, dict) and all(isinstance(name, str) and isinstance(source, str)
+                                           for name, source in value.items())
+  if not isinstance(params.get('file'), str):
+    raise ValueError('file is required')
+  for name, isValid, expected in (('root', lambda value: isinstance(value, str), 'a string'),
+                                  ('options', lambda value: isinstance(value, dict), 'an object'),
+                                  ('sources', is_sources, 'an object of file names to sources'),
+                                  ('jobs', lambda value: type(value) is int and value > 0, 'a positive integer'),
+                                  ('write', lambda value: isinstance(value, bool), 'true or false')):
+    if params.get(name) is not None and not isValid(params[name]):
+      raise ValueError('{} must be {}'.format(name, expected))
+
+def serve(requests=None, responses=None):
+  """Answer JSON-RPC 2.0 requests, one JSON object per line, until
+  'shutdown' or the end of requests (default stdin; responses go to
+  stdout). The 'compile' method takes the 'file' to compile and,
+  optionally, its 'sources', 'options' and 'root' (see Compiler), 'jobs'
+  and 'write', and returns Compiler.compile()'s result and the
+  milliseconds it took. A warm Compiler is kept for each set of options,
+  so unchanged modules are neither read from disk cache nor lowered
+  again. Anything the compiler prints goes to stderr."""
+  requests = requests or sys.stdin
+  responses = responses or sys.stdout
+  compilers = {}
+  def respond(requestId, result=None, error=None):
+    response = {'jsonrpc': '2.0', 'id': requestId}
+    if error is None:
+      response['result'] = result
+    else:
+      response['error'] = {'code': error[0], 'message': error[1]}
+    responses.write(json.dumps(response) + '\n')
+    responses.flush()
+  for line in requests:
+    if not line.strip():
+      continue
+    started = time.perf_counter()
+    try:
+      request = json.loads(line)
+    except ValueError as e:
+      respond(None, error=(-32700, 'parse error: {}'.format(e)))
+      continue
+    if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+      respond(None, error=(-32600, 'invalid request'))
+      continue
+    requestId = request.get('id')
+    params = request.get('params')
+    if params is None:
+      params = {}
+    if request['method'] == 'shutdown':
+      respond(requestId)
+      break
+    if request['method'] != 'compile':
+      respond(requestId, error=(-32601, 'unknown method: ' + request['method']))
+      continue
+    if not isinstance(params, dict):
+      respond(requestId, error=(-32602, 'invalid params: params must be an object'))
+      continue
+    key = json.dumps([params.get('options'), params.get('root')], sort_keys=True)
+    try:
+      check_params(params)
+      if key not in compilers:
+        compilers[key] = Compiler(options=params.get('options'), cacheDir=cacheDir, root=params.get('root'), keepWarm=True)
+    except ValueError as e:
+      respond(requestId, error=(-32602, 'invalid params: {}'.format(e)))
+      continue
+    try:
+      with contextlib.redirect_stdout(sys.stderr):
+        compilers[key].set_sources(params.get('sources'))
+        result = compilers[key].compile(params['file'], params.get('jobs') or 1, params.get('write') or False)
+    except (OSError, SyntaxError) as e:
+      error = (-32000, '{}: {}'.format(type(e).__name__, e))
+    except Exception as e:
+      traceback.print_exc()
+      error = (-32603, 'internal error: {}: {}'.format(type(e).__name__, e))
+    else:
+      result['ms'] = (time.perf_counter() - started) * 1000
+      error = None
+    if requestId is not None:
+      respond(requestId, None if error else result, error)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compile Python to RobotC.')
+  parser.add_argument('file', nargs='?', help='the Python file to compile')
+  parser.add_argument('--cache-dir', help='where to keep compiled modules between runs (default: .pyrobotc_cache next to file)')
+  parser.add_argument('--no-cache', action='store_true', help='always recompile every module')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='compile imported modules on this many processes')
+  parser.add_argument('--server', action='store_true', help='answer JSON-RPC compile requests on stdin, keeping compiled modules in memory')
+  parser.add_argument('--watch', action='store_true', help='keep running and recompile modules as they change')
+  parser.add_argument('--no-fold-constants', action='store_true', help='emit constant expressions as written')
+  parser.add_argument('--keep-dead-functions', action='store_true', help='emit functions that no task can reach')
+  parser.add_argument('--no-temporaries', action='store_true', help='emit chained comparisons and assignments as written')
+  parser.add_argument('--no-hoist', action='store_true', help='leave range() bounds and loop-invariant expressions inside loops')
+  parser.add_argument('--no-strength-reduction', action='store_true', help='emit multiplication, division and modulo by powers of two as written')
+  parser.add_argument('--no-pack-structs', action='store_true', help='emit struct fields in the order they are assigned')
+  parser.add_argument('--inline-threshold', type=int, default=inlineThreshold, help='inline pure single-expression functions of up to this many nodes (0 disables inlining)')
+  parser.add_argument('--cost-report', action='store_true', help='estimate the cost of every function and task loop iteration')
+  parser.add_argument('--loop-budget', type=float, default=loopBudget, help='flag task loops whose iterations may take longer than this many ms')
+  parser.add_argument('--ram-report', action='store_true', help='report the size of every struct and the static RAM of every module')
+  parser.add_argument('--amalgamate', action='store_true', help='write every module into a single .c file, in dependency order')
+  parser.add_argument('--source-maps', action='store_true', help='write a .map of the Python line behind each line of C next to every output file')
+  parser.add_argument('--profile', action='store_true', help='time every function and loop, and dump the counters to the debug stream')
+  parser.add_argument('--stats', action='store_const', const='text', help='report time per phase and module, output sizes and node counts')
+  parser.add_argument('--stats-json', dest='stats', action='store_const', const='json', help='the same as --stats, as JSON')
+  args = parser.parse_args()
+  if args.file is None and not args.server:
+    parser.error('the following arguments are required: file')
+  mainFile = args.file
+  foldConstants = not args.no_fold_constants
+  eliminateDeadFunctions = not args.keep_dead_functions
+  inlineThreshold = args.inline_threshold
+  useTemporaries = not args.no_temporaries
+  hoistLoopInvariants = not args.no_hoist
+  reduceStrength = not args.no_strength_reduction
+  packStructs = not args.no_pack_structs
+  loopBudget = args.loop_budget
+  estimateCosts = args.cost_report
+  profile = args.profile
+  amalgamateOutput = args.amalgamate
+  sourceMaps = args.source_maps
+  if args.server:
+    cacheDir = None if args.no_cache else args.cache_dir
+    serve()
+    sys.exit()
+  if not args.no_cache:
+    cacheDir = args.cache_dir or os.path.join(os.path.dirname(os.path.realpath(mainFile)), '.pyrobotc_cache')
+  if args.watch:
+    try:
+      watch(mainFile)
+    except KeyboardInterrupt:
+      pass
+  else:
+    if args.stats:
+      buildStats = new_build_stats()
+    if args.jobs > 1:
+      compile_parallel(mainFile, args.jobs)
+    else:
+      compile_to_c(mainFile)
+    slave_motor_groups()
+    if eliminateDeadFunctions:
+      removed, removedBytes = eliminate_dead_functions()
+      if removed:
+        print('Removed {} unreachable function(s), {} bytes of C: {}'.format(len(removed), removedBytes, ', '.join(removed)))
+    for infos in moduleFunctions.values():
+      for info in infos:
+        if info.get('table'):
+          print('Lookup table {}: {} entries, {} bytes of flash'.format(info['name'], info['entries'], info['bytes']))
+    if profile:
+      add_profile_dump()
+    if amalgamateOutput:
+      order = list(moduleFunctions) # Filled in as modules finish, imports first
+      write_amalgamation(amalgamate(order), order)
+    else:
+      write_outputs()
+    if args.cost_report:
+      print(format_cost_report())
+    if args.ram_report:
+      print(format_ram_report())
+    if args.stats:
+      print(format_stats(args.stats == 'json'))
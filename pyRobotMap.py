@@ -0,0 +1,70 @@
+"""Find the Python line behind a line of generated C, using the .map file
+that pyRobotC.py --source-maps writes next to each output file.
+
+    python pyRobotMap.py output/robot.c 120 [121 ...]
+    python pyRobotMap.py output/robot.c --python robot.py:14
+
+The first form prints the Python file and line that each C line was
+written for; the second prints the C lines written for a Python line.
+Lookups are a binary search over the map's runs of lines, so they stay
+fast for large outputs.
+"""
+import argparse
+import bisect
+import json
+import os
+
+class SourceMap(object):
+  """A loaded source map. See pyRobotC.source_map for the format."""
+
+  def __init__(self, data, directory='.'):
+    self.sources = [os.path.normpath(os.path.join(directory, source)) for source in data['sources']]
+    self.starts = [entry[0] for entry in data['lines']]
+    self.entries = data['lines']
+
+  @classmethod
+  def load(cls, filename):
+    """Load the map of a C file, or a .map file itself."""
+    if not filename.endswith('.map'):
+      filename += '.map'
+    with open(filename, 'r') as f:
+      return cls(json.load(f), os.path.dirname(filename))
+
+  def lookup(self, cLine):
+    """The (Python file, line) that C line cLine came from, or None."""
+    index = bisect.bisect_right(self.starts, cLine) - 1
+    if index < 0 or len(self.entries[index]) < 3:
+      return None
+    return self.sources[self.entries[index][1]], self.entries[index][2]
+
+  def c_lines(self, source, lineno):
+    """The (first, last) C lines written for a Python line, in order. The
+    last run of the file has no known end, so its last is None."""
+    source = os.path.normpath(source)
+    runs = []
+    for index, entry in enumerate(self.entries):
+      if len(entry) == 3 and entry[2] == lineno and same_file(self.sources[entry[1]], source):
+        end = self.starts[index + 1] - 1 if index + 1 < len(self.starts) else None
+        runs.append((entry[0], end))
+    return runs
+
+def same_file(path, query):
+  """Whether a path in the map is the file the user asked about, which may
+  be given by a shorter relative path."""
+  return path == query or path.endswith(os.sep + query) or os.path.abspath(query) == os.path.abspath(path)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Map lines of generated C back to Python, and back.')
+  parser.add_argument('file', help='a generated C file, or its .map')
+  parser.add_argument('lines', type=int, nargs='*', help='C lines to look up')
+  parser.add_argument('--python', action='append', default=[], metavar='FILE:LINE', help='find the C lines written for a Python line')
+  args = parser.parse_args()
+  sourceMap = SourceMap.load(args.file)
+  for cLine in args.lines:
+    origin = sourceMap.lookup(cLine)
+    print('{}: {}'.format(cLine, '{}:{}'.format(*origin) if origin else 'not from Python'))
+  for query in args.python:
+    source, lineno = query.rsplit(':', 1)
+    runs = sourceMap.c_lines(source, int(lineno))
+    print('{}: {}'.format(query, ', '.join('{}-{}'.format(first, '' if last is None else last) if last != first
+                                           else str(first) for first, last in runs) or 'no C lines'))
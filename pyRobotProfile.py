@@ -0,0 +1,101 @@
+"""Read the profile of a program compiled with pyRobotC.py --profile back
+from a captured debug stream log.
+
+The profiled program's profileDump() (called directly, or every second by
+the profileReport task) writes every function's calls and milliseconds,
+and every loop's iterations and milliseconds, between a "profile begin"
+and a "profile end" line. Counters only grow, so the last complete dump in
+the log is reported, or with --since-previous, the difference between the
+last two. Other output in the log is ignored.
+
+    python pyRobotProfile.py debug.txt [--since-previous] [--json]
+
+The report has the same form as pyRobotSim.py's, so a run on the robot can
+be compared with a simulated one.
+"""
+import argparse
+import json
+import re
+
+dumpLine = re.compile(r'profile (begin|function|loop|end)\b(.*)')
+
+def parse_log(lines):
+  """Return the complete dumps in lines, oldest first. Each dump is a dict
+  with the program time in ms when it was written ('ms'), 'functions'
+  mapping (module, name) to [calls, ms] and 'loops' mapping
+  (module, name, line) to [iterations, ms]."""
+  dumps = []
+  dump = None
+  for line in lines:
+    match = dumpLine.search(line)
+    if not match:
+      continue
+    kind, fields = match.group(1), match.group(2).strip()
+    try:
+      if kind == 'begin':
+        dump = {'ms': int(fields.split()[0]), 'functions': {}, 'loops': {}}
+      elif dump is None:
+        continue
+      elif kind == 'end':
+        dumps.append(dump)
+        dump = None
+      elif kind == 'function':
+        module, name, calls, ms = fields.rsplit(None, 3) # The module name may contain spaces
+        dump['functions'][(module, name)] = [int(calls), int(ms)]
+      else:
+        module, name, lineno, iterations, ms = fields.rsplit(None, 4)
+        dump['loops'][(module, name, int(lineno))] = [int(iterations), int(ms)]
+    except (IndexError, ValueError):
+      dump = None # A garbled line spoils the whole dump
+  return dumps
+
+def profile_report(dump, previous=None):
+  """The profile of dump, or of what happened between previous and dump."""
+  def since(now, before, key):
+    if key not in before:
+      return now[key]
+    return [count - earlier for count, earlier in zip(now[key], before[key])]
+  before = previous or {'ms': 0, 'functions': {}, 'loops': {}}
+  seconds = (dump['ms'] - before['ms']) / 1000
+  loops = {}
+  for key in sorted(dump['loops']):
+    iterations, ms = since(dump['loops'], before['loops'], key)
+    loops['{}:{} in {}'.format(key[0], key[2], key[1])] = {
+      'iterations': iterations, 'hz': iterations / seconds if seconds else 0,
+      'ms': ms, 'msPerIteration': ms / iterations if iterations else 0}
+  functions = {}
+  for key in sorted(dump['functions']):
+    calls, ms = since(dump['functions'], before['functions'], key)
+    functions[key[1]] = {'calls': calls, 'ms': ms, 'module': key[0]}
+  return {'seconds': seconds, 'loops': loops, 'functions': functions}
+
+def read_profile(filename, sincePrevious=False):
+  """Parse a log file and return the profile of its last dump."""
+  with open(filename, 'r', errors='replace') as f:
+    dumps = parse_log(f)
+  if not dumps:
+    raise ValueError('no complete profile dump in {}'.format(filename))
+  previous = dumps[-2] if sincePrevious and len(dumps) > 1 else None
+  return profile_report(dumps[-1], previous)
+
+def format_report(report, asJson=False):
+  if asJson:
+    return json.dumps(report, indent=2, sort_keys=True)
+  lines = ['Profiled {:.3f} s'.format(report['seconds'])]
+  if report['loops']:
+    lines.append('{:<40} {:>10} {:>10} {:>10}'.format('loop', 'iterations', 'Hz', 'ms each'))
+    for key, loop in report['loops'].items():
+      lines.append('{:<40} {:>10} {:>10.1f} {:>10.2f}'.format(key, loop['iterations'], loop['hz'], loop['msPerIteration']))
+  if report['functions']:
+    lines.append('{:<40} {:>10} {:>10}'.format('function', 'calls', 'ms'))
+    for name, function in sorted(report['functions'].items(), key=lambda item: -item[1]['ms']):
+      lines.append('{:<40} {:>10} {:>10}'.format(name, function['calls'], function['ms']))
+  return '\n'.join(lines)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Report the profile dumped by a program compiled with --profile.')
+  parser.add_argument('log', help='a captured debug stream log')
+  parser.add_argument('--since-previous', action='store_true', help='only count what happened since the dump before the last')
+  parser.add_argument('--json', action='store_true', help='print the report as JSON')
+  args = parser.parse_args()
+  print(format_report(read_profile(args.log, args.since_previous), args.json))
@@ -0,0 +1,457 @@
+"""Run a PyRobotC program on the host, against a simulated robot.
+
+The program and its imports run as Python in one shared namespace, the way
+the generated C is #included into one program, with simulated motor[],
+SensorValue[], vexRT[] and nMotorEncoder[] arrays, joystick and vex
+module. Tasks run on a virtual clock: wait1Msec and vex.sleep advance it,
+and every line executed costs --line-cost microseconds, so loop rates and
+the time spent in each function can be measured without a robot. Division
+and modulo truncate like RobotC's.
+
+    python pyRobotSim.py program.py [--seconds 10] [--joystick script.json] [--line-cost 10] [--json]
+
+A joystick script is a JSON list of events, each applied when the clock
+reaches its time in ms:
+
+    [{"time": 0, "joystick": {"joy1_y1": 127}, "joy1Btn": {"6": 1}, "SensorValue": {"in1": 300}}]
+"""
+import argparse
+import ast
+import builtins
+import collections
+import copy
+import json
+import math
+import os
+import sys
+import traceback
+import types
+
+import pyRobotC
+
+blockingCalls = {'wait1Msec': 1, 'wait10Msec': 10, 'vex.sleep': 1} # Calls that wait, and their unit in ms
+taskCalls = ['vex.start', 'vex.stop', 'startTask', 'stopTask']
+
+class Symbol(str):
+  """A RobotC name the program doesn't define, such as a port, a sensor
+  type or a function from a C header. Calling it does nothing and
+  returns 0."""
+
+  def __call__(self, *args, **kwargs):
+    return 0
+
+class Namespace(dict):
+  """The program's globals. Builtins are found as usual, and any other
+  unknown name is a Symbol."""
+
+  def __missing__(self, name):
+    if hasattr(builtins, name):
+      return getattr(builtins, name)
+    return Symbol(name)
+
+class SimArray(dict):
+  """A RobotC array indexed by port. Unset elements read as 0, and writes
+  to a master motor are copied to its slaves."""
+
+  def __init__(self):
+    super(SimArray, self).__init__()
+    self.slaves = collections.defaultdict(list)
+
+  def __missing__(self, key):
+    return 0
+
+  def __setitem__(self, key, value):
+    super(SimArray, self).__setitem__(key, value)
+    for slave in self.slaves.get(key, ()):
+      super(SimArray, self).__setitem__(slave, value)
+
+class Joystick(object):
+  """The joystick struct. Fields that were never set read as 0."""
+
+  def __getattr__(self, name):
+    return 0
+
+class SimVex(object):
+  """The vex pseudo-module."""
+
+  def __init__(self, simulation):
+    self.simulation = simulation
+
+  def pragma(self, *args):
+    # config(Motor, port1, name, ...) and config(Sensor, in1, name, ...) name ports
+    if len(args) > 3 and args[0] == 'config' and args[1] in ('Motor', 'Sensor') and args[3] != '_':
+      self.simulation.namespace[args[3]] = args[2]
+
+  def motor(self, port, speed):
+    self.simulation.motor[port] = speed
+
+  def slaveMotors(self, master, *slaves):
+    for slave in slaves:
+      self.simulation.slave_motor(slave, master)
+
+  def motorReversed(self, port, isReversed):
+    self.simulation.namespace['bMotorReflected'][port] = isReversed
+
+  def motorGroup(self, *ports):
+    return ports
+
+  def setGroup(self, group, speed):
+    for port in group:
+      self.simulation.motor[port] = speed
+
+  def sleep(self, ms):
+    self.simulation.busy_wait(ms)
+
+  def start(self, task, priority=None):
+    self.simulation.start_task(task)
+
+  def stop(self, task):
+    self.simulation.stop_task(task)
+
+  def table(self, low, high):
+    return lambda function: function
+
+  def noinline(self, function):
+    return function
+
+def dotted_name(aNode):
+  if isinstance(aNode, ast.Name):
+    return aNode.id
+  if isinstance(aNode, ast.Attribute):
+    return dotted_name(aNode.value) + '.' + aNode.attr
+  return ''
+
+def snippet(source, like):
+  """The first statement of source, placed at like's position."""
+  statement = ast.parse(source).body[0]
+  for node in ast.walk(statement):
+    ast.copy_location(node, like)
+  return statement
+
+def is_task(aNode):
+  return isinstance(aNode, ast.AsyncFunctionDef) or dotted_name(aNode.returns) == 'task'
+
+def blocking_functions(modules):
+  """Names of the functions that must run as generators: tasks, and
+  functions that wait or call functions that do."""
+  functions = {}
+  for module in modules:
+    for node in ast.walk(module):
+      if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        functions[node.name] = node
+  blocking = set(name for name, node in functions.items() if is_task(node))
+  changed = True
+  while changed:
+    changed = False
+    for name, node in functions.items():
+      if name in blocking:
+        continue
+      for call in ast.walk(node):
+        if isinstance(call, ast.Call) and (dotted_name(call.func) in blockingCalls or dotted_name(call.func) in blocking):
+          blocking.add(name)
+          changed = True
+          break
+  return blocking
+
+class SimRewriter(ast.NodeTransformer):
+  """Instruments a module for the simulation.
+
+  Every function reports its calls, every loop its iterations, and loops
+  in functions that run as generators yield to the scheduler once per
+  iteration. In those functions, waits become yields and calls to other
+  such functions become yield from. async def becomes def, await is
+  dropped, and / and % truncate like RobotC's. Annotations are dropped too,
+  as RobotC types such as void mean nothing to Python (and class bodies
+  don't look names up in the simulated namespace)."""
+
+  def __init__(self, filename, blocking):
+    self.filename = os.path.basename(filename)
+    self.blocking = blocking
+    self.function = None
+    self.inGenerator = False
+
+  def visit_AsyncFunctionDef(self, aNode):
+    function = ast.copy_location(ast.FunctionDef(**dict(ast.iter_fields(aNode))), aNode)
+    return self.visit_FunctionDef(function)
+
+  def visit_FunctionDef(self, aNode):
+    outer = self.function, self.inGenerator
+    self.function, self.inGenerator = aNode.name, aNode.name in self.blocking
+    aNode.returns = None
+    self.generic_visit(aNode)
+    start = 1 if ast.get_docstring(aNode) else 0
+    like = aNode.body[start] if len(aNode.body) > start else aNode
+    aNode.body.insert(start, snippet('_sim.called({!r})'.format(aNode.name), like))
+    self.function, self.inGenerator = outer
+    return aNode
+
+  def visit_arg(self, aNode):
+    aNode.annotation = None
+    return aNode
+
+  def visit_AnnAssign(self, aNode):
+    self.generic_visit(aNode)
+    if aNode.value is None:
+      return ast.copy_location(ast.Pass(), aNode)
+    return ast.copy_location(ast.Assign(targets=[aNode.target], value=aNode.value), aNode)
+
+  def visit_While(self, aNode):
+    self.generic_visit(aNode)
+    key = '{}:{} in {}'.format(self.filename, aNode.lineno, self.function or '<module>')
+    statements = [snippet('_sim.iterate({!r})'.format(key), aNode.body[0])]
+    if self.inGenerator:
+      statements.append(snippet("yield ('slice', 0)", aNode.body[0]))
+    aNode.body[0:0] = statements
+    return aNode
+
+  visit_For = visit_While
+
+  def visit_Await(self, aNode):
+    return self.visit(aNode.value)
+
+  def visit_Call(self, aNode):
+    name = dotted_name(aNode.func)
+    if name in taskCalls and aNode.args and isinstance(aNode.args[0], ast.Call) and not aNode.args[0].args:
+      aNode.args[0] = aNode.args[0].func # vex.start(poll()) starts the task poll
+    self.generic_visit(aNode)
+    if not self.inGenerator:
+      return aNode
+    if name in blockingCalls and len(aNode.args) == 1:
+      wait = snippet("(yield ('sleep', 0 * {}))".format(blockingCalls[name]), aNode).value
+      wait.value.elts[1].left = aNode.args[0]
+      return wait
+    if name in self.blocking:
+      return ast.copy_location(ast.YieldFrom(value=aNode), aNode)
+    return aNode
+
+  def visit_BinOp(self, aNode):
+    self.generic_visit(aNode)
+    if isinstance(aNode.op, (ast.Div, ast.Mod)):
+      call = snippet('_sim.div(0, 0)' if isinstance(aNode.op, ast.Div) else '_sim.mod(0, 0)', aNode).value
+      call.args = [aNode.left, aNode.right]
+      return call
+    return aNode
+
+  def visit_AugAssign(self, aNode):
+    self.generic_visit(aNode)
+    if isinstance(aNode.op, (ast.Div, ast.Mod)):
+      target = copy.deepcopy(aNode.target)
+      target.ctx = ast.Load()
+      value = self.visit_BinOp(ast.copy_location(ast.BinOp(left=target, op=aNode.op, right=aNode.value), aNode))
+      return ast.copy_location(ast.Assign(targets=[aNode.target], value=value), aNode)
+    return aNode
+
+class Simulation(object):
+  """A simulated robot running one program on a virtual clock, in
+  microseconds."""
+
+  def __init__(self, lineCost=10, joystickScript=None):
+    self.clock = 0.0
+    self.lineCost = lineCost
+    self.events = sorted(joystickScript or [], key=lambda event: event.get('time', 0))
+    self.tasks = [] # [name, generator, wake time] for each running task
+    self.loops = collections.Counter()
+    self.calls = collections.Counter()
+    self.functionTime = collections.Counter()
+    self.programFiles = set()
+    self.motor = SimArray()
+    self.joystick = Joystick()
+    self.buttons = {'joy1Btn': {}, 'joy2Btn': {}}
+    namespace = self.namespace = Namespace()
+    namespace.update({
+      '_sim': self, 'vex': SimVex(self), 'motor': self.motor, 'SensorValue': SimArray(), 'vexRT': SimArray(),
+      'nMotorEncoder': SimArray(), 'bMotorReflected': SimArray(), 'joystick': self.joystick,
+      'getJoystickSettings': lambda joystick: None,
+      'joy1Btn': lambda button: self.buttons['joy1Btn'].get(str(button), 0),
+      'joy2Btn': lambda button: self.buttons['joy2Btn'].get(str(button), 0),
+      'wait1Msec': self.busy_wait, 'wait10Msec': lambda ticks: self.busy_wait(10 * ticks),
+      'startTask': lambda task, priority=None: self.start_task(task), 'stopTask': self.stop_task,
+      'slaveMotor': self.slave_motor, 'writeDebugStream': self.debug, 'writeDebugStreamLine': self.debug,
+      'sgn': lambda x: (x > 0) - (x < 0), 'sqrt': math.sqrt, 'sin': math.sin, 'cos': math.cos,
+      'tan': math.tan, 'atan': math.atan, 'exp': math.exp, 'log': math.log, 'floor': math.floor,
+      'ceil': math.ceil, 'nSysTime': 0, 'nPgmTime': 0,
+    })
+
+  # Called by the program
+
+  def called(self, name):
+    self.calls[name] += 1
+
+  def iterate(self, key):
+    self.loops[key] += 1
+
+  def div(self, left, right):
+    if isinstance(left, int) and isinstance(right, int):
+      quotient = abs(left) // abs(right)
+      return -quotient if (left < 0) != (right < 0) else quotient
+    return left / right
+
+  def mod(self, left, right):
+    if isinstance(left, int) and isinstance(right, int):
+      return left - right * self.div(left, right)
+    return math.fmod(left, right)
+
+  def busy_wait(self, ms):
+    """A wait outside of a task's own code, which can't yield."""
+    self.clock += ms * 1000
+    self.update_clock()
+
+  def slave_motor(self, slave, master):
+    self.motor.slaves[master].append(slave)
+
+  def debug(self, text, *args):
+    try:
+      print(text % args if args else text)
+    except TypeError:
+      print(text, *args)
+
+  def start_task(self, task):
+    if not isinstance(task, types.FunctionType) or any(running[0] == task.__name__ for running in self.tasks):
+      return
+    generator = task()
+    if isinstance(generator, types.GeneratorType):
+      self.tasks.append([task.__name__, generator, self.clock])
+
+  def stop_task(self, task):
+    name = getattr(task, '__name__', task)
+    self.tasks = [running for running in self.tasks if running[0] != name]
+
+  # Running
+
+  def trace(self, frame, event, arg):
+    if frame.f_code.co_filename not in self.programFiles:
+      return None
+    if event == 'line':
+      self.clock += self.lineCost
+      self.functionTime[frame.f_code.co_name] += self.lineCost
+    return self.trace
+
+  def update_clock(self):
+    self.namespace['nSysTime'] = self.namespace['nPgmTime'] = int(self.clock // 1000)
+    while self.events and self.events[0].get('time', 0) * 1000 <= self.clock:
+      event = self.events.pop(0)
+      for name, value in event.get('joystick', {}).items():
+        setattr(self.joystick, name, value)
+      for name in self.buttons:
+        self.buttons[name].update((str(button), value) for button, value in event.get(name, {}).items())
+      for name in ('SensorValue', 'vexRT', 'nMotorEncoder'):
+        for port, value in event.get(name, {}).items():
+          self.namespace[name][port] = value
+
+  def load(self, filename):
+    """Run filename and its imports, in the order a build includes them."""
+    pyRobotC.mainFile = filename
+    modules = []
+    seen = set()
+    def visit(filename):
+      try:
+        filename = pyRobotC.resolve_path(filename)
+      except FileNotFoundError:
+        print('Skipping import {} (not found)'.format(filename), file=sys.stderr)
+        return
+      path = os.path.abspath(filename)
+      if path in seen:
+        return
+      seen.add(path)
+      with open(filename, 'r') as f:
+        module = ast.parse(f.read(), filename=path)
+      scanner = pyRobotC.ImportScanner()
+      scanner.visit(module)
+      for importPath in scanner.imports:
+        visit(importPath)
+      modules.append((path, module))
+    visit(filename)
+    blocking = blocking_functions([module for path, module in modules])
+    for path, module in modules:
+      module.body = [statement for statement in module.body if not isinstance(statement, ast.Import)]
+      SimRewriter(path, blocking).visit(module)
+      ast.fix_missing_locations(module)
+      self.programFiles.add(path)
+    self.update_clock()
+    sys.settrace(self.trace)
+    try:
+      for path, module in modules:
+        exec(compile(module, path, 'exec'), self.namespace)
+    finally:
+      sys.settrace(None)
+
+  def run(self, seconds):
+    """Start the main task and run until every task has ended or the
+    clock reaches seconds."""
+    self.start_task(self.namespace.get('main'))
+    end = seconds * 1e6
+    sys.settrace(self.trace)
+    try:
+      while self.tasks and self.clock < end:
+        ready = [task for task in self.tasks if task[2] <= self.clock]
+        if not ready:
+          self.clock = min(task[2] for task in self.tasks)
+          self.update_clock()
+          continue
+        for task in ready:
+          if task not in self.tasks:
+            continue # Stopped by a task that ran before it
+          try:
+            request = next(task[1])
+          except StopIteration:
+            self.tasks.remove(task)
+          except Exception:
+            print('Task {} failed:\n{}'.format(task[0], traceback.format_exc()), file=sys.stderr)
+            self.tasks.remove(task)
+          else:
+            if request[0] == 'sleep':
+              task[2] = self.clock + request[1] * 1000
+          self.update_clock()
+          if self.clock >= end:
+            break
+    finally:
+      sys.settrace(None)
+
+  def report(self):
+    seconds = self.clock / 1e6
+    return {
+      'seconds': seconds,
+      'lineCost': self.lineCost,
+      'loops': {key: {'iterations': count, 'hz': count / seconds if seconds else 0}
+                for key, count in sorted(self.loops.items())},
+      'functions': {name: {'calls': self.calls[name], 'ms': self.functionTime[name] / 1000}
+                    for name in sorted(set(self.calls) | set(self.functionTime))},
+      'tasks': [task[0] for task in self.tasks],
+    }
+
+def simulate(filename, seconds=10, joystickScript=None, lineCost=10):
+  """Run filename for seconds of virtual time and return the report."""
+  simulation = Simulation(lineCost, joystickScript)
+  simulation.load(filename)
+  simulation.run(seconds)
+  return simulation.report()
+
+def format_report(report, asJson=False):
+  if asJson:
+    return json.dumps(report, indent=2, sort_keys=True)
+  lines = ['Simulated {:.3f} s at {} us per line'.format(report['seconds'], report['lineCost'])]
+  if report['loops']:
+    lines.append('{:<40} {:>10} {:>10}'.format('loop', 'iterations', 'Hz'))
+    for key, loop in report['loops'].items():
+      lines.append('{:<40} {:>10} {:>10.1f}'.format(key, loop['iterations'], loop['hz']))
+  if report['functions']:
+    lines.append('{:<40} {:>10} {:>10}'.format('function', 'calls', 'ms'))
+    for name, function in sorted(report['functions'].items(), key=lambda item: -item[1]['ms']):
+      lines.append('{:<40} {:>10} {:>10.1f}'.format(name, function['calls'], function['ms']))
+  if report['tasks']:
+    lines.append('Still running: ' + ', '.join(report['tasks']))
+  return '\n'.join(lines)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run a PyRobotC program against a simulated robot.')
+  parser.add_argument('file', help='the Python file to run')
+  parser.add_argument('--seconds', type=float, default=10, help='how long to run for, in virtual time')
+  parser.add_argument('--joystick', help='a JSON script of joystick and sensor values over time')
+  parser.add_argument('--line-cost', type=float, default=10, help='virtual microseconds each executed line takes')
+  parser.add_argument('--json', action='store_true', help='print the report as JSON')
+  args = parser.parse_args()
+  script = None
+  if args.joystick:
+    with open(args.joystick) as f:
+      script = json.load(f)
+  print(format_report(simulate(args.file, args.seconds, script, args.line_cost), args.json))
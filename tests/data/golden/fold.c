@@ -0,0 +1,16 @@
+
+task main() {
+  int half = 63;
+  int back = 63;
+  int wrap = -3;
+  int rest = -1;
+  bool flag = true;
+  int pick = 10;
+  if (true) {
+    int half = 64;
+    motor[port4] = half;
+  }
+  while (true) {
+    motor[port3] = (63 * SensorValue[in1]);
+  }
+}
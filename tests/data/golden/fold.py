@@ -0,0 +1,16 @@
+def main() -> task:
+  half: int = 127 / 2
+  back: int = -(-63)
+  wrap: int = -7 / 2
+  rest: int = -7 % 2
+  flag: bool = 3 > 2 and not False
+  pick: int = 10 if 1 < 2 else 20
+  if 2 > 1:
+    half: int = 64 # Declared again, so kept in a block of its own
+    motor[port4] = half
+  if False:
+    motor[port1] = 127
+  while False:
+    motor[port2] = 127
+  while True:
+    motor[port3] = (127 / 2) * SensorValue[in1]
@@ -0,0 +1,16 @@
+
+task main() {
+  int i;
+  int limit = 10;
+  while (true) {
+    int _t2 = (limit << 1);
+    int _t3 = (limit << 2);
+    for (i = 0; i < _t2; i++) {
+      motor[port1] = (i + _t3);
+    }
+    int _t1;
+    if ((0 < (_t1 = SensorValue[in1])) && (_t1 < 100)) {
+      motor[port2] = 0;
+    }
+  }
+}
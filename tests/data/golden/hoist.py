@@ -0,0 +1,7 @@
+def main() -> task:
+  limit: int = 10
+  while True:
+    for i in range(limit * 2):
+      motor[port1] = i + limit * 4
+    if 0 < SensorValue[in1] < 100:
+      motor[port2] = 0
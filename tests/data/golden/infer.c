@@ -0,0 +1,14 @@
+
+float ratio(int x) {
+  return (x / 2.0);
+}
+
+task main() {
+  int x = 3;
+  float y = ratio(x);
+  int count = 0;
+  while (true) {
+    count += 1;
+    motor[port1] = count;
+  }
+}
@@ -0,0 +1,13 @@
+def get():
+  return 3
+
+def ratio(x: int):
+  return x / 2.0
+
+def main() -> task:
+  x = get()
+  y = ratio(x)
+  count = 0
+  while True:
+    count += 1
+    motor[port1] = count
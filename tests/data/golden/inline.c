@@ -0,0 +1,18 @@
+
+float half(float x) {
+  return (x / 2);
+}
+
+int scale(int x) {
+  return (x * 1.5);
+}
+
+task main() {
+  float a = half(5);
+  float b = (5.0 / 2);
+  int c = scale(3);
+  int d = 8;
+  while (true) {
+    motor[port1] = (SensorValue[in1] << 1);
+  }
+}
@@ -0,0 +1,16 @@
+def half(x: float) -> float:
+  return x / 2
+
+def scale(x: int) -> int:
+  return x * 1.5
+
+def twice(x: int) -> int:
+  return x * 2
+
+def main() -> task:
+  a: float = half(5)
+  b: float = half(5.0)
+  c: int = scale(3)
+  d: int = twice(4)
+  while True:
+    motor[port1] = twice(SensorValue[in1])
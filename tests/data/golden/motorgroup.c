@@ -0,0 +1,20 @@
+
+void drive(int speed) {
+  motor[frontLeftMotor] = speed;
+  motor[rearLeftMotor] = speed;
+  int _t1 = (speed << 1);
+  motor[port1] = _t1;
+  motor[port2] = _t1;
+  motor[port3] = _t1;
+}
+
+task main() {
+  slaveMotor(armSlave, armMotor);
+  while (true) {
+    drive(joystick.joy1_y2);
+    motor[armMotor] = ((joystick.joy2_y1 + ((joystick.joy2_y1 >> 15) & 1)) >> 1);
+    int _t3 = abs(joystick.joy1_y1);
+    motor[frontLeftMotor] = _t3;
+    motor[rearLeftMotor] = _t3;
+  }
+}
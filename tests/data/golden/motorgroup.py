@@ -0,0 +1,13 @@
+left = vex.motorGroup(frontLeftMotor, rearLeftMotor)
+right = vex.motorGroup(port1, port2, port3)
+
+def drive(speed: int) -> void:
+  vex.setGroup(left, speed)
+  vex.setGroup(right, speed * 2)
+
+def main() -> task:
+  arm = vex.motorGroup(armMotor, armSlave)
+  while True:
+    drive(joystick.joy1_y2)
+    vex.setGroup(arm, joystick.joy2_y1 / 2)
+    vex.setGroup(left, abs(joystick.joy1_y1))
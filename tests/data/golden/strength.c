@@ -0,0 +1,18 @@
+
+int drive(int x, float f) {
+  int a = (x << 1);
+  int b = (x << 3);
+  int c = ((x + ((x >> 15) & 3)) >> 2);
+  int d = (x - ((x + ((x >> 15) & 7)) & -8));
+  int e = ((x & 255) >> 4);
+  int g = ((x & 255) & 15);
+  float h = (f * 2);
+  int i = ((x + 1) / 4);
+  int j = ((joystick.joy1_y2 + ((joystick.joy1_y2 >> 15) & 3)) >> 2);
+  x <<= 2;
+  x = ((x + ((x >> 15) & 1)) >> 1);
+  x = (x - ((x + ((x >> 15) & 31)) & -32));
+  motor[port1] /= 2;
+  motor[port2] <<= 1;
+  return (((((((a + b) + c) + d) + e) + g) + i) + j);
+}
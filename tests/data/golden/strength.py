@@ -0,0 +1,16 @@
+def drive(x: int, f: float) -> int:
+  a: int = x * 2
+  b: int = 8 * x
+  c: int = x / 4
+  d: int = x % 8
+  e: int = (x & 255) / 16
+  g: int = (x & 255) % 16
+  h: float = f * 2
+  i: int = (x + 1) / 4
+  j: int = joystick.joy1_y2 / 4
+  x *= 4
+  x /= 2
+  x %= 32
+  motor[port1] /= 2
+  motor[port2] *= 2
+  return a + b + c + d + e + g + i + j
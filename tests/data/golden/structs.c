@@ -0,0 +1,23 @@
+/*** Class: Arm ***/
+typedef struct {
+  float speed;
+  int port;
+  bool up;
+  bool down;
+} Arm;
+
+void Arm___init__(Arm self, int port) {
+  self.up = false;
+  self.speed = 0.0;
+  self.down = false;
+  self.port = port;
+}
+
+/*** End Class: Arm ***/
+int level = 0;
+Arm arm;
+Arm___init__(arm, port1);
+
+task main() {
+  motor[arm.port] = level;
+}
@@ -0,0 +1,12 @@
+class Arm:
+  def __init__(self, port: int) -> void:
+    self.up: bool = False
+    self.speed: float = 0.0
+    self.down: bool = False
+    self.port: int = port
+
+level: int = 0
+arm: Arm = Arm(port1)
+
+def main() -> task:
+  motor[arm.port] = level
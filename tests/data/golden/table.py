@@ -0,0 +1,7 @@
+@vex.table(-127, 127)
+def threshold(number: int, minNumber: int = 20) -> int:
+  return number if abs(number) >= minNumber else 0
+
+def main() -> task:
+  while True:
+    motor[port1] = threshold(joystick.joy1_y2)
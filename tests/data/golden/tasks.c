@@ -0,0 +1,22 @@
+
+task poll() {
+  while (true) {
+    motor[port2] = SensorValue[in1];
+    wait1Msec(20);
+  }
+}
+
+task drive() {
+  while (true) {
+    motor[port1] = joystick.joy1_y2;
+    wait1Msec(10);
+  }
+}
+
+task main() {
+  startTask(poll);
+  startTask(drive, 7);
+  wait1Msec(1000);
+  stopTask(poll);
+  stopTask(drive);
+}
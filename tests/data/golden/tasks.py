@@ -0,0 +1,16 @@
+async def poll():
+  while True:
+    motor[port2] = SensorValue[in1]
+    await vex.sleep(20)
+
+def drive() -> task:
+  while True:
+    motor[port1] = joystick.joy1_y2
+    wait1Msec(10)
+
+async def main():
+  vex.start(poll)
+  vex.start(drive, priority=7)
+  await vex.sleep(1000)
+  vex.stop(poll)
+  vex.stop(drive)
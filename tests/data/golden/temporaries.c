@@ -0,0 +1,17 @@
+
+task main() {
+  int a = 0;
+  int b = 0;
+  while (true) {
+    int _t1 = (SensorValue[in1] * 3);
+    a = _t1;
+    b = _t1;
+    int _t2;
+    if ((0 < (_t2 = SensorValue[in2])) && (_t2 < 100)) {
+      motor[port1] = a;
+    }
+    if ((0 < b) && (b < 100)) {
+      motor[port2] = b;
+    }
+  }
+}
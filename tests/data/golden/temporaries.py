@@ -0,0 +1,9 @@
+def main() -> task:
+  a: int = 0
+  b: int = 0
+  while True:
+    a = b = SensorValue[in1] * 3
+    if 0 < SensorValue[in2] < 100:
+      motor[port1] = a
+    if 0 < b < 100: # A plain name is read twice instead
+      motor[port2] = b
@@ -0,0 +1,324 @@
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pyRobotC
+
+golden = os.path.join(os.path.dirname(__file__), 'data', 'golden')
+update = os.environ.get('PYROBOTC_UPDATE_GOLDEN') # Set to rewrite the expected C after a deliberate change
+
+def compile_sources(sources, main='robot.py', options=None, **kwargs):
+  return pyRobotC.Compiler(sources, options, root='/virtual/robot').compile(main, **kwargs)
+
+@pytest.mark.parametrize('program', sorted(os.path.basename(path) for path in glob.glob(os.path.join(golden, '*.py'))))
+def test_golden(program):
+  """Each program in data/golden compiles to the .c next to it, with no warnings."""
+  result = pyRobotC.Compiler(root=golden).compile(program)
+  name = program[:-3] + '.c'
+  if update:
+    with open(os.path.join(golden, name), 'w') as f:
+      f.write(result['outputs'][name])
+  with open(os.path.join(golden, name)) as f:
+    assert result['outputs'] == {name: f.read()}
+  assert result['warnings'] == []
+
+def test_inlining_keeps_conversions():
+  result = compile_sources({'robot.py': 'def scale(x: int) -> int:\n  return x * 1.5\n\n'
+                                        'def main() -> task:\n  while True:\n    motor[port1] = scale(SensorValue[in1])\n'})
+  assert 'motor[port1] = scale(SensorValue[in1]);' in result['outputs']['robot.c']
+  assert result['warnings'] == [] # No float math was moved into the loop
+
+def test_folding_follows_options():
+  result = compile_sources({'robot.py': 'def main() -> task:\n  motor[port1] = 127 + 1\n'}, options={'foldConstants': False})
+  assert 'motor[port1] = (127 + 1);' in result['outputs']['robot.c']
+
+def test_chains_without_temporaries():
+  result = compile_sources({'robot.py': 'def main() -> task:\n  a: int = 0\n  b: int = 0\n  a = b = SensorValue[in1]\n'
+                                        '  if 0 < SensorValue[in2] < 100:\n    motor[port1] = a\n'},
+                           options={'useTemporaries': False})
+  assert '  a = b = SensorValue[in1];\n' in result['outputs']['robot.c']
+  assert 'if ((0 < SensorValue[in2]) && (SensorValue[in2] < 100)) {' in result['outputs']['robot.c']
+
+steps = {'robot.py': 'def main() -> task:\n  for i in range(10, 0, 0):\n    motor[port1] = i\n  n: int = 3\n'
+                      '  for j in range(0, n * 4, joystick.joy1_y1 / 10):\n    motor[port2] = j\n'}
+
+@pytest.mark.parametrize('hoist', [True, False])
+def test_range_steps(hoist):
+  result = compile_sources(steps, options={'hoistLoopInvariants': hoist})
+  warning, = result['warnings']
+  assert warning.endswith('robot.py: warning: line 2: range() step is 0; loop left out')
+  assert 'motor[port1]' not in result['outputs']['robot.c']
+  high = '_t2' if hoist else '(n << 2)'
+  assert ('  int _t1 = (joystick.joy1_y1 / 10);\n  for (j = 0; ((_t1 > 0) ? (j < {0}) : (j > {0})); j += _t1) {{\n'.format(high)
+          in result['outputs']['robot.c']) # The step is evaluated once either way
+
+def test_table_arguments_outside_the_range():
+  result = compile_sources({'robot.py': '@vex.table(-3, 3)\ndef curve(x: int) -> int:\n  return x * x\n\n'
+                                        'def main() -> task:\n  motor[port1] = curve(7)\n  motor[port2] = curve(2)\n'},
+                           options={'inlineThreshold': 0})
+  assert [warning.split(': warning: ')[1] for warning in result['warnings']] == [
+    'line 6: curve(7) is not in its table of -3 to 3; calling it instead']
+  assert result['removed'] == ['curve_table'] # But not curve, which is still called
+  assert '  motor[port1] = curve(7);\n  motor[port2] = 4;\n' in result['outputs']['robot.c']
+
+awaits = {'lib.py': 'async def blink():\n  while True:\n    motor[port9] = 1\n    await vex.sleep(100)\n',
+          'robot.py': 'import lib\n\nasync def poll(period):\n  while True:\n    await wait1Msec(20)\n\n'
+                      'def helper() -> int:\n  return SensorValue[in1]\n\n'
+                      'async def main():\n  await poll()\n  await blink()\n  await helper()\n'}
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_awaiting_tasks(jobs):
+  result = compile_sources(awaits, jobs=jobs)
+  assert [warning.split(': warning: ')[1] for warning in result['warnings']] == [
+    'line 3: task poll cannot take parameters; they are left out',
+    'line 11: a task cannot be awaited; poll is started with startTask(poll) and runs alongside',
+    'line 12: a task cannot be awaited; blink is started with startTask(blink) and runs alongside',
+    'line 13: only vex.sleep, wait1Msec and wait10Msec can be awaited; helper does not wait']
+  assert '  startTask(poll);\n  startTask(blink);\n' in result['outputs']['robot.c']
+
+def test_cost_report():
+  compiler = pyRobotC.Compiler({'robot.py': 'def scaled(x: int) -> float:\n  return x * 0.5\n\n'
+                                            'def main() -> task:\n  while True:\n    motor[port1] = scaled(SensorValue[in1]) + 1\n'
+                                            '    wait1Msec(10)\n\ndef slow() -> task:\n  while True:\n'
+                                            '    for i in range(1000):\n      motor[port2] = sqrt(i) * 2.5\n'},
+                               {'estimateCosts': True, 'inlineThreshold': 0}, root='/virtual/robot')
+  compiler.compile('robot.py')
+  with compiler:
+    report = pyRobotC.format_cost_report().splitlines()
+  assert report[1:4] == ['  slow                                  79003', '  main                                  10089',
+                         '  scaled                                   30']
+  assert report[5:] == [
+    '  main (robot.py:5)      10089  [float 1, call 2, array 2, branch 1, wait 10]',
+    '  slow (robot.py:10)      79003  [int 1000, float 2000, call 1000, array 1000, branch 1001]  over the 20 ms budget']
+
+@pytest.mark.parametrize('pack, report', [
+  (True, ['Structs (bytes):', '  Arm                                   8  (12 as written)',
+          'Static RAM (bytes):', '  structs.py                           10']),
+  (False, ['Structs (bytes):', '  Arm                                  12',
+           'Static RAM (bytes):', '  structs.py                           14'])])
+def test_ram_report(pack, report):
+  compiler = pyRobotC.Compiler(options={'packStructs': pack}, root=golden)
+  result = compiler.compile('structs.py')
+  with compiler:
+    assert pyRobotC.format_ram_report().splitlines() == report
+  if not pack:
+    assert 'typedef struct {\n  bool up;\n  float speed;\n  bool down;\n  int port;\n} Arm;' in result['outputs']['structs.c']
+
+library = {'lib.py': 'def get():\n  return 5\n\ndef ratio(x: int):\n  return x / 2.0\n',
+           'robot.py': 'import lib\n\ndef main() -> task:\n  x = get()\n  y = ratio(x)\n'
+                       '  motor[port1] = x\n  motor[port2] = y\n'}
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_inferred_returns_cross_modules(jobs):
+  result = compile_sources(library, jobs=jobs)
+  assert result['warnings'] == []
+  assert 'int get() {' in result['outputs']['lib.c']
+  assert 'float ratio(int x) {' in result['outputs']['lib.c']
+  assert '  int x = get();\n  float y = ratio(x);\n' in result['outputs']['robot.c']
+
+shared = {'lib.py': 'speed: int = 0\n\ndef show() -> void:\n  motor[port1] = speed\n',
+          'robot.py': 'import lib\n\ndef main() -> task:\n  speed = 5\n  show()\n'}
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_imported_globals_are_assigned(jobs):
+  result = compile_sources(shared, jobs=jobs)
+  assert '  speed = 5;\n' in result['outputs']['robot.c'] # Not a local hiding lib's speed
+
+def test_imported_globals_in_cache(tmp_path):
+  pyRobotC.Compiler(shared, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  local = dict(shared, **{'lib.py': 'def show() -> void:\n  motor[port1] = 0\n'})
+  again = pyRobotC.Compiler(local, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py', jobs=2)
+  assert again['lowered'] == 2
+  assert '  int speed = 5;\n' in again['outputs']['robot.c']
+
+def test_cache(tmp_path):
+  first = pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  again = pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py', jobs=2)
+  assert (first['lowered'], again['lowered']) == (2, 0)
+  assert again['outputs'] == first['outputs'] # Including the return types that only inference knew
+
+def test_cache_only_lowers_changed_modules(tmp_path):
+  pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  changed = dict(library, **{'robot.py': library['robot.py'] + '  motor[port3] = 1\n'})
+  again = pyRobotC.Compiler(changed, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  assert again['lowered'] == 1
+  assert again['outputs'] == compile_sources(changed)['outputs']
+
+def test_cache_keyed_by_options(tmp_path):
+  pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  options = {'indent': '    '}
+  again = pyRobotC.Compiler(library, options, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  assert again['lowered'] == 2
+  assert again['outputs'] == compile_sources(library, options=options)['outputs']
+
+def test_corrupt_cache_entries_are_ignored(tmp_path):
+  first = pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  for entry in tmp_path.iterdir():
+    entry.write_text('{')
+  again = pyRobotC.Compiler(library, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  assert again['lowered'] == 2
+  assert again['outputs'] == first['outputs']
+
+def test_warm_compiler():
+  compiler = pyRobotC.Compiler(library, root='/virtual/robot', keepWarm=True)
+  first = compiler.compile('robot.py')
+  again = compiler.compile('robot.py')
+  assert again['lowered'] == 0
+  assert again['outputs'] == first['outputs']
+
+reachable = {'lib.py': 'def used(x: int) -> int:\n  return helper(x) + 1\n\ndef helper(x: int) -> int:\n'
+                        '  return x * 3 + SensorValue[in1]\n\ndef unused() -> void:\n  motor[port2] = 0\n',
+             'robot.py': 'import lib\n\ndef main() -> task:\n  while True:\n    motor[port1] = used(SensorValue[in2])\n'}
+
+def test_dead_functions_across_modules():
+  result = compile_sources(reachable, options={'inlineThreshold': 0})
+  assert result['removed'] == ['unused']
+  assert 'int used(int x) {' in result['outputs']['lib.c']
+  assert 'int helper(int x) {' in result['outputs']['lib.c'] # Only reached through another module's function
+  assert 'unused' not in result['outputs']['lib.c']
+
+def test_dead_functions_kept():
+  result = compile_sources(reachable, options={'inlineThreshold': 0, 'eliminateDeadFunctions': False})
+  assert result['removed'] == []
+  assert 'void unused() {' in result['outputs']['lib.c']
+  without = compile_sources(reachable, main='lib.py')
+  assert without['removed'] == [] # Nothing is removed from a program with no task
+
+def wait_for(condition, timeout=20):
+  deadline = time.time() + timeout
+  while not condition():
+    assert time.time() < deadline, 'timed out'
+    time.sleep(0.05)
+
+def test_watch_relowers_changed_modules(tmp_path):
+  for name, source in library.items():
+    (tmp_path / name).write_text(source)
+  log = tmp_path / 'watch.log'
+  with open(str(log), 'w') as out:
+    watcher = subprocess.Popen([sys.executable, '-u', pyRobotC.__file__, '--watch', '--no-cache', 'robot.py'],
+                               cwd=str(tmp_path), stdout=out, stderr=subprocess.STDOUT)
+  try:
+    wait_for(lambda: 'Compiled 2 of 2 modules' in log.read_text())
+    assert (tmp_path / 'output' / 'lib.c').read_text() == compile_sources(library)['outputs']['lib.c']
+    time.sleep(0.05) # So the edit gets a later mtime
+    (tmp_path / 'robot.py').write_text(library['robot.py'] + '  motor[port3] = 1\n')
+    wait_for(lambda: 'Compiled 1 of 2 modules' in log.read_text())
+    assert 'motor[port3] = 1;' in (tmp_path / 'output' / 'robot.c').read_text()
+  finally:
+    watcher.kill()
+    watcher.wait()
+
+arm = {'arm.py': 'def lift(power: int) -> void:\n  arm = vex.motorGroup(armMotor, armSlave)\n'
+                 '  vex.setGroup(arm, power)\n  wait1Msec(10)\n',
+       'robot.py': 'vex.pragma("config", Motor, port2, armSlave, tmotorVex393_MC29, openLoop)\nimport arm\n\n'
+                   'def main() -> task:\n  while True:\n    lift(joystick.joy2_y1)\n'}
+
+def test_motor_group_slaved_despite_pragma():
+  lift = compile_sources(arm)['outputs']['arm.c']
+  assert 'slaveMotor(armSlave, armMotor);' in lift
+  assert 'motor[armSlave]' not in lift
+
+def test_motor_group_written_from_another_module(tmp_path):
+  sources = dict(arm, **{'robot.py': arm['robot.py'] + '    motor[armSlave] = 0\n'})
+  lift = compile_sources(sources)['outputs']['arm.c']
+  assert 'slaveMotor' not in lift
+  assert '  motor[armMotor] = power;\n  motor[armSlave] = power;\n' in lift
+  cached = pyRobotC.Compiler(arm, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  again = pyRobotC.Compiler(sources, cacheDir=str(tmp_path), root='/virtual/robot').compile('robot.py')
+  assert 'slaveMotor' in cached['outputs']['arm.c']
+  assert again['outputs']['arm.c'] == lift # arm.py came from the cache, but the rest of the program changed
+
+def test_source_maps():
+  result = compile_sources({'robot.py': 'def main() -> task:\n  x: int = 1\n  while True:\n    motor[port1] = x\n'},
+                           options={'sourceMaps': True})
+  assert result['maps']['robot.c.map'] == {'version': 1, 'file': 'robot.c', 'sources': ['../robot.py'],
+                                           'lines': [[1, 0, 1], [3, 0, 2], [4, 0, 3], [5, 0, 4]]}
+
+def test_compile_many():
+  programs = [{'main': 'robot.py', 'root': '/virtual/robot{}'.format(i), 'options': {'amalgamateOutput': i % 2 == 1},
+               'sources': {'robot.py': 'import helpers\ndef main() -> task:\n  while True:\n'
+                                       '    motor[port1] = speed{}(SensorValue[in1])\n'.format(i),
+                           'helpers.py': 'def speed{0}(x: int) -> int:\n  return x * {1}\n'.format(i, 2 ** i)}}
+              for i in range(4)]
+  serial = [pyRobotC.Compiler(program['sources'], program['options'], root=program['root']).compile('robot.py')
+            for program in programs]
+  assert pyRobotC.compile_many(programs, 3, processes=False) == serial
+  assert pyRobotC.compile_many(programs, 2) == serial
+  assert serial[3]['outputs'] == {'robot.c': '/*** Module: helpers.py ***/\n\nint speed3(int x) {\n  return (x << 3);\n}\n'
+                                             '/*** Module: robot.py ***/\n\ntask main() {\n  while (true) {\n'
+                                             '    motor[port1] = speed3(SensorValue[in1]);\n  }\n}\n'}
+  assert pyRobotC.compiled == {} and pyRobotC.amalgamateOutput is False # The module state is untouched
+
+amalgamated = {'lib.py': 'def get():\n  return 5\n\ndef unused() -> void:\n  motor[port2] = 0\n',
+               'robot.py': 'vex.pragma("config", Motor, port2, armSlave, tmotorVex393_MC29, openLoop)\nimport lib\n\n'
+                           'def main() -> task:\n  motor[port1] = get()\n'}
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_amalgamation(jobs):
+  result = compile_sources(amalgamated, options={'amalgamateOutput': True, 'inlineThreshold': 0, 'sourceMaps': True}, jobs=jobs)
+  assert result['outputs'] == {'robot.c': '#pragma config(Motor, port2, armSlave, tmotorVex393_MC29, openLoop)\n'
+                                          '/*** Module: lib.py ***/\n\nint get() {\n  return 5;\n}\n'
+                                          '/*** Module: robot.py ***/\n\ntask main() {\n  motor[port1] = get();\n}\n'}
+  assert result['removed'] == ['unused']
+  assert result['maps']['robot.c.map']['sources'] == ['../robot.py', '../lib.py']
+  assert result['maps']['robot.c.map']['lines'] == [[1, 0, 1], [2], [3, 1, 1], [5, 1, 2], [7], [8, 0, 4], [10, 0, 5]]
+
+def serve(*requests):
+  responses = io.StringIO()
+  pyRobotC.serve(io.StringIO(''.join(json.dumps(request) + '\n' for request in requests)), responses)
+  return [json.loads(line) for line in responses.getvalue().splitlines()]
+
+def test_server_compiles():
+  response, = serve({'jsonrpc': '2.0', 'id': 1, 'method': 'compile',
+                     'params': {'file': 'robot.py', 'sources': library, 'root': '/virtual/robot'}})
+  assert response['result']['outputs'] == compile_sources(library)['outputs']
+
+def test_server_rejects_array_params():
+  responses = serve({'jsonrpc': '2.0', 'id': 1, 'method': 'compile', 'params': ['robot.py']},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'shutdown'})
+  assert responses[0]['error']['code'] == -32602
+  assert responses[1] == {'jsonrpc': '2.0', 'id': 2, 'result': None} # Still serving
+
+@pytest.mark.parametrize('params, message', [
+  ({'file': 5}, 'file is required'),
+  ({'file': 'robot.py', 'root': 5}, 'root must be a string'),
+  ({'file': 'robot.py', 'options': 5}, 'options must be an object'),
+  ({'file': 'robot.py', 'options': {'nope': 1}}, 'unknown option(s): nope'),
+  ({'file': 'robot.py', 'sources': ['robot.py']}, 'sources must be an object of file names to sources'),
+  ({'file': 'robot.py', 'sources': {'robot.py': 5}}, 'sources must be an object of file names to sources'),
+  ({'file': 'robot.py', 'jobs': 'two'}, 'jobs must be a positive integer'),
+  ({'file': 'robot.py', 'jobs': 0}, 'jobs must be a positive integer'),
+  ({'file': 'robot.py', 'write': 'yes'}, 'write must be true or false')])
+def test_server_rejects_bad_params(params, message):
+  responses = serve({'jsonrpc': '2.0', 'id': 1, 'method': 'compile', 'params': params},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'shutdown'})
+  assert responses[0]['error'] == {'code': -32602, 'message': 'invalid params: ' + message}
+  assert responses[1] == {'jsonrpc': '2.0', 'id': 2, 'result': None} # Still serving
+
+def test_server_reports_emit_failures():
+  sources = {'robot.py': 'vex.pragma(config, Motor, port2, leftMotor, tmotorVex393_MC29, openLoop)\n\n'
+                         'def main() -> task:\n  motor[port1] = 1\n'}
+  response, = serve({'jsonrpc': '2.0', 'id': 1, 'method': 'compile',
+                     'params': {'file': 'robot.py', 'sources': sources, 'root': '/virtual/robot'}})
+  warning, = response['result']['warnings']
+  assert 'line 1: could not write Expr' in warning
+
+def test_statements_after_an_emit_failure():
+  result = compile_sources({'robot.py': 'count: int = 0\n\ndef bump() -> void:\n  global count\n  count += 1\n\n'
+                                        'def f(x):\n  return 1\n\ndef main() -> task:\n  bump()\n  motor[port1] = count\n'},
+                           options={'inlineThreshold': 0})
+  failures = [warning.split(': warning: ')[1] for warning in result['warnings']]
+  assert [failure.split(':')[0] for failure in failures] == ['line 4', 'line 7']
+  assert failures[0].startswith('line 4: could not write Global: ')
+  assert failures[1].startswith('line 7: could not write FunctionDef: ')
+  assert all(failure.endswith('; it is left out') for failure in failures)
+  output = result['outputs']['robot.c']
+  assert 'void bump() {\n  count += 1;\n}' in output # Written past the failed statement
+  assert 'f(' not in output # Nothing of the failed function is left for the link step
+  assert 'motor[port1] = count;' in output
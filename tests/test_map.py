@@ -0,0 +1,19 @@
+import os
+
+import pyRobotMap
+
+data = {'version': 1, 'file': 'robot.c', 'sources': ['../robot.py'],
+        'lines': [[1, 0, 1], [3, 0, 2], [4, 0, 3], [5, 0, 4], [7]]}
+robot = os.path.normpath('/robot/robot.py')
+
+def test_lookup():
+  sourceMap = pyRobotMap.SourceMap(data, '/robot/output')
+  assert sourceMap.lookup(4) == (robot, 3)
+  assert sourceMap.lookup(6) == (robot, 4) # Inside a run
+  assert sourceMap.lookup(7) is None # Not from Python
+  assert sourceMap.lookup(0) is None
+
+def test_c_lines():
+  sourceMap = pyRobotMap.SourceMap(data, '/robot/output')
+  assert sourceMap.c_lines('robot.py', 4) == [(5, 6)]
+  assert sourceMap.c_lines(robot, 9) == []
@@ -0,0 +1,24 @@
+import os
+
+import pyRobotProfile
+
+data = os.path.join(os.path.dirname(__file__), 'data')
+module = 'FantasticBox - Tank Control.py'
+
+def test_module_names_with_spaces():
+  with open(os.path.join(data, 'profile.log')) as f:
+    dumps = pyRobotProfile.parse_log(f)
+  assert len(dumps) == 2 # The third dump never ends
+  assert dumps[-1]['functions'] == {(module, 'drive'): [198, 396], (module, 'main'): [1, 0]}
+  assert dumps[-1]['loops'] == {(module, 'main', 15): [163, 1980]}
+
+def test_since_previous():
+  report = pyRobotProfile.read_profile(os.path.join(data, 'profile.log'), sincePrevious=True)
+  assert report['seconds'] == 1
+  assert report['functions']['drive'] == {'calls': 100, 'ms': 200, 'module': module}
+  assert report['loops'][module + ':15 in main']['iterations'] == 82
+
+def test_garbled_lines_spoil_their_dump():
+  dumps = pyRobotProfile.parse_log(['profile begin 10', 'profile function a.py f x 1', 'profile end',
+                                    'profile begin', 'profile end'])
+  assert dumps == []
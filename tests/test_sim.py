@@ -0,0 +1,21 @@
+import pyRobotSim
+
+def test_class_annotations(tmp_path):
+  """RobotC annotations, which are not Python names, run in classes too."""
+  program = tmp_path / 'robot.py'
+  program.write_text('class Arm:\n  def __init__(self, port: int) -> void:\n    self.port: int = port\n    self.speed: word\n'
+                     '  def lift(self, power: int) -> void:\n    level: int = power\n    motor[self.port] = level\n\n'
+                     'def main() -> task:\n  arm: Arm = Arm(port1)\n  while True:\n    arm.lift(50)\n    wait1Msec(10)\n')
+  simulation = pyRobotSim.Simulation()
+  simulation.load(str(program))
+  simulation.run(1)
+  assert simulation.namespace['motor']['port1'] == 50
+  assert simulation.report()['functions']['lift']['calls'] == 100
+
+def test_division_truncates(tmp_path):
+  program = tmp_path / 'robot.py'
+  program.write_text('def main() -> task:\n  motor[port1] = -7 / 2\n  motor[port2] = -7 % 2\n')
+  simulation = pyRobotSim.Simulation()
+  simulation.load(str(program))
+  simulation.run(1)
+  assert (simulation.namespace['motor']['port1'], simulation.namespace['motor']['port2']) == (-3, -1)